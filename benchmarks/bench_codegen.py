@@ -0,0 +1,60 @@
+"""
+Compares the peak memory of generating a Nautilus extension in one string and streaming it to the file.
+
+    python benchmarks/bench_codegen.py
+"""
+from __future__ import annotations
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_menu import linux_menus, menus
+
+SIZES = [1_000, 10_000, 50_000]
+
+
+def build_menu(size: int) -> menus.ContextMenu:
+    root = menus.ContextMenu("Bench", type="FILES")
+    for i in range(size // 10):
+        sub_menu = menus.ContextMenu(f"Menu {i}")
+        sub_menu.add_items(
+            [menus.ContextCommand(f"Command {j}", command=f"echo {j}") for j in range(10)]
+        )
+        root.add_items([sub_menu])
+    return root
+
+
+def peak(func) -> int:
+    tracemalloc.start()
+    func()
+    result = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "Bench.py")
+        for size in SIZES:
+            root = build_menu(size)
+
+            def in_memory() -> None:
+                nm = linux_menus.NautilusMenu(root.name, root.sub_items, root.type)
+                linux_menus.write_file_atomic(path, nm.build_script())
+
+            def streamed() -> None:
+                nm = linux_menus.NautilusMenu(root.name, root.sub_items, root.type)
+                linux_menus.write_file_atomic(path, nm.iter_script())
+
+            print(
+                f"{size:>6} items: in memory {peak(in_memory) / 1e6:7.2f} MB, "
+                f"streamed {peak(streamed) / 1e6:7.2f} MB, "
+                f"file {os.path.getsize(path) / 1e6:6.2f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
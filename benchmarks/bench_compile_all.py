@@ -0,0 +1,60 @@
+"""
+Measures how compile_all scales with the number of workers.
+
+The registry is replaced by the in-memory one of slow_registry.py, where each
+call takes LATENCY seconds.
+
+    python benchmarks/bench_compile_all.py
+"""
+from __future__ import annotations
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slow_registry import SlowRegistry
+
+from context_menu import index, menus, windows_menus
+
+MENUS = 200
+WORKERS = [1, 2, 4, 8, 16]
+
+
+def build_menus() -> list[menus.ContextMenu]:
+    items = []
+    for i in range(MENUS):
+        cm = menus.ContextMenu(f"Menu {i}", type="FILES")
+        cm.add_items(
+            [menus.ContextCommand(f"Command {j}", command="echo hello") for j in range(3)]
+        )
+        items.append(cm)
+    return items
+
+
+def main() -> None:
+    registry = SlowRegistry()
+    # compile_all records the menus in the index, kept out of the user's data like in the tests
+    index_dir = tempfile.TemporaryDirectory()
+    with index_dir, patch.dict(
+        os.environ, {index.INDEX_ENV_VAR: os.path.join(index_dir.name, "index.jsonl")}
+    ), patch("context_menu.menus.platform.system", lambda: "Windows"), patch.object(
+        windows_menus, "create_key", registry.create_key
+    ), patch.object(windows_menus, "set_key_value", registry.set_key_value):
+        baseline = None
+        for workers in WORKERS:
+            items = build_menus()
+            start = time.perf_counter()
+            results = menus.compile_all(items, workers=workers)
+            elapsed = time.perf_counter() - start
+            assert all(result.ok for result in results)
+            baseline = baseline or elapsed
+            print(
+                f"workers={workers:<3} {elapsed:7.3f}s  speedup x{baseline / elapsed:.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
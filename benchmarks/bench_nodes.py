@@ -0,0 +1,81 @@
+"""
+Measures the memory used per menu node, and compiles cascades deeper than the recursion limit.
+
+    python benchmarks/bench_nodes.py
+"""
+from __future__ import annotations
+import os
+import sys
+import time
+import tracemalloc
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_menu import linux_menus, menus, windows_menus
+
+NODES = 50_000
+
+
+# Gives the attribute values of the comparison nodes
+PROTOTYPE = menus.ContextCommand("Command", command="echo hello")
+
+
+class DictCommand:
+    """ContextCommand as it was before __slots__, with the same attributes, for comparison."""
+
+    def __init__(self, name: str, command: str) -> None:
+        # Taken from __slots__, so the comparison follows the attributes ContextCommand gains
+        for attribute in menus.ContextCommand.__slots__:
+            setattr(self, attribute, getattr(PROTOTYPE, attribute))
+        self.name = name
+        self.command = command
+
+
+def measure(factory) -> float:
+    """Returns the bytes allocated per node created by factory."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = [factory(i) for i in range(NODES)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del nodes
+    return (after - before) / NODES
+
+
+def deep_menu(depth: int) -> menus.ContextMenu:
+    root = menus.ContextMenu("Root", type="FILES")
+    menu = root
+    for level in range(depth):
+        sub_menu = menus.ContextMenu(f"Level {level}")
+        menu.add_items([sub_menu])
+        menu = sub_menu
+    menu.add_items([menus.ContextCommand("Leaf", command="echo hello")])
+    return root
+
+
+def main() -> None:
+    # The names are shared, only the nodes themselves are measured
+    names = [f"Command {i}" for i in range(NODES)]
+    dict_size = measure(lambda i: DictCommand(names[i], "echo hello"))
+    slots_size = measure(lambda i: menus.ContextCommand(names[i], command="echo hello"))
+    print(f"__dict__ node: {dict_size:6.1f} bytes")
+    print(f"__slots__ node: {slots_size:6.1f} bytes ({slots_size / dict_size:.0%})")
+
+    depth = sys.getrecursionlimit() * 3
+    root = deep_menu(depth)
+
+    start = time.perf_counter()
+    linux_menus.NautilusMenu(root.name, root.sub_items, root.type).build_script()
+    print(f"Nautilus, depth {depth}: {time.perf_counter() - start:.3f}s")
+
+    with patch.object(windows_menus, "create_key", lambda path: None), patch.object(
+        windows_menus, "set_key_value", lambda path, name, value: None
+    ):
+        start = time.perf_counter()
+        windows_menus.RegistryMenu(root.name, root.sub_items, root.type).compile()
+        print(f"Registry, depth {depth}: {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Measures how writing the subtrees of a single large menu scales with the number of workers.
+
+The registry is replaced by the in-memory one of slow_registry.py, where each
+call takes LATENCY seconds.
+
+    python benchmarks/bench_registry.py
+"""
+from __future__ import annotations
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from slow_registry import SlowRegistry
+
+from context_menu import menus, windows_menus
+
+SUB_MENUS = 50
+COMMANDS = 5
+WORKERS = [1, 2, 4, 8, 16]
+
+
+def build_items() -> list[menus.ContextMenu]:
+    items = []
+    for i in range(SUB_MENUS):
+        sub_menu = menus.ContextMenu(f"Sub {i}")
+        sub_menu.add_items(
+            [
+                menus.ContextCommand(f"Command {j}", command="echo hello")
+                for j in range(COMMANDS)
+            ]
+        )
+        items.append(sub_menu)
+    return items
+
+
+def main() -> None:
+    baseline = None
+    expected = None
+    for workers in WORKERS:
+        registry = SlowRegistry()
+        with patch.object(windows_menus, "create_key", registry.create_key), patch.object(
+            windows_menus, "set_key_value", registry.set_key_value
+        ):
+            menu = windows_menus.RegistryMenu(
+                "Menu", build_items(), "FILES", workers=workers
+            )
+            start = time.perf_counter()
+            menu.compile()
+            elapsed = time.perf_counter() - start
+        # Same keys and same hash whatever the number of workers
+        expected = expected or (registry.keys, menu.content_hash)
+        assert (registry.keys, menu.content_hash) == expected
+        baseline = baseline or elapsed
+        print(f"workers={workers:<3} {elapsed:7.3f}s  speedup x{baseline / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+An in-memory registry where each call takes LATENCY seconds, as it does on
+machines with registry virtualization or AV hooks. Shared by the benchmarks.
+"""
+from __future__ import annotations
+import time
+
+LATENCY = 0.001
+
+
+class SlowRegistry:
+    """In-memory registry adding LATENCY to each call."""
+
+    def __init__(self) -> None:
+        self.keys: dict[str, dict[str, str]] = {}
+
+    def create_key(self, path: str) -> None:
+        time.sleep(LATENCY)
+        self.keys.setdefault(path, {})
+
+    def set_key_value(self, key_path: str, subkey_name: str, value: str) -> None:
+        time.sleep(LATENCY)
+        self.keys.setdefault(key_path, {})[subkey_name] = value
@@ -0,0 +1,139 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+import argparse
+import json
+import sys
+
+from context_menu import launcher, manifest, memory_report
+
+# __main__.py -------------------------------------
+#
+# Command line tools, for example 'python -m context_menu trace-summary'.
+
+
+def trace_summary(args: argparse.Namespace) -> int:
+    """
+    Prints the latency of each stage of the traced invocations, per entry.
+    """
+    summary = launcher.summarize_traces(launcher.read_traces(args.path))
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    elif not summary:
+        print("No traced invocations, pass trace=True to a command to record them.")
+    else:
+        print(launcher.format_trace_summary(summary))
+    return 0
+
+
+def memory_report_command(args: argparse.Namespace) -> int:
+    """
+    Prints the memory each installed Nautilus extension adds to Nautilus, largest first.
+
+    Returns 1 if an extension is over the budget.
+    """
+    budget = int(args.budget * 1024 * 1024)
+    records = memory_report.build_report(args.paths or None, budget, args.calls)
+    if args.json:
+        print(json.dumps(records, indent=2))
+    elif not records:
+        print("No Nautilus extensions installed.")
+    else:
+        print(memory_report.format_report(records, budget))
+    return 1 if any(record["over_budget"] for record in records) else 0
+
+
+def deploy_command(args: argparse.Namespace) -> int:
+    """
+    Deploys the menus of a manifest, printing what is done to each of them.
+
+    Returns 1 if the manifest is invalid or a menu failed to compile.
+    """
+    try:
+        deployed = manifest.deploy(args.manifest, args.workers, dry_run=args.check)
+    except manifest.ManifestError as e:
+        for error in e.errors:
+            print(f"error: {error}", file=sys.stderr)
+        return 1
+
+    if args.json:
+        print(
+            json.dumps(
+                [
+                    {
+                        "name": result.name,
+                        "type": result.type,
+                        "action": action,
+                        "error": None if result.ok else str(result.error),
+                    }
+                    for action, result in deployed
+                ],
+                indent=2,
+            )
+        )
+    else:
+        for action, result in deployed:
+            status = "ok" if result.ok else f"failed: {result.error}"
+            print(f"{action}\t{result.name}\t{result.type}\t{status}")
+        if args.check:
+            print("Checked only, nothing was written.")
+    return 0 if all(result.ok for _, result in deployed) else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m context_menu")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    summary_parser = commands.add_parser(
+        "trace-summary",
+        help="show the latency of each stage of the traced invocations",
+    )
+    summary_parser.add_argument(
+        "--path", default=None, help="trace file, the one of the launcher by default"
+    )
+    summary_parser.add_argument("--json", action="store_true")
+    summary_parser.set_defaults(run=trace_summary)
+
+    memory_parser = commands.add_parser(
+        "memory-report",
+        help="rank the Nautilus extensions by the memory they retain",
+    )
+    memory_parser.add_argument(
+        "paths", nargs="*", help="extensions, all the installed ones by default"
+    )
+    memory_parser.add_argument(
+        "--budget",
+        type=float,
+        default=memory_report.DEFAULT_BUDGET / 1024 / 1024,
+        help="retained MiB above which an extension fails the report",
+    )
+    memory_parser.add_argument(
+        "--calls",
+        type=int,
+        default=memory_report.DEFAULT_CALLS,
+        help="right clicks simulated on each extension",
+    )
+    memory_parser.add_argument("--json", action="store_true")
+    memory_parser.set_defaults(run=memory_report_command)
+
+    deploy_parser = commands.add_parser(
+        "deploy", help="compile the menus and commands of a JSON or TOML manifest"
+    )
+    deploy_parser.add_argument("manifest")
+    deploy_parser.add_argument(
+        "--check",
+        action="store_true",
+        help="validate and compile the manifest without writing anything",
+    )
+    deploy_parser.add_argument(
+        "--workers", type=int, default=1, help="menus compiled at the same time"
+    )
+    deploy_parser.add_argument("--json", action="store_true")
+    deploy_parser.set_defaults(run=deploy_command)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,161 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import ast
+import os
+import re
+import threading
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+    from context_menu.menus import MethodInfo
+
+# callbacks.py -------------------------------------
+#
+# Python functions referenced by import path, such as 'tools.images:resize',
+# instead of being passed as function objects. The file of the module is found
+# without importing it, and only parsed to check that it defines the function,
+# so menus can be compiled without running user code or its dependencies.
+
+REFERENCE_PATTERN = re.compile(
+    r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*:[A-Za-z_][A-Za-z0-9_]*$"
+)
+
+
+def split_reference(reference: str) -> tuple[str, str]:
+    """
+    Splits a reference into the name of the module and the name of the function.
+
+    For example, 'tools.images:resize' -> ('tools.images', 'resize')
+    """
+    if not REFERENCE_PATTERN.match(reference):
+        raise ValueError(
+            f"invalid python reference {reference!r}, expected 'module:function'"
+        )
+    module_name, func_name = reference.split(":")
+    return module_name, func_name
+
+
+def find_module_file(module_name: str) -> tuple[str, str]:
+    """
+    Returns the source file of a module and the directory of sys.path its top-level package is in, without importing
+    it or the packages it is in.
+
+    The packages are looked up one after the other on sys.path, so their __init__ files aren't run either.
+    """
+    from importlib.machinery import PathFinder
+
+    parts = module_name.split(".")
+    search_path = None
+    root = None
+    for index, part in enumerate(parts):
+        spec = PathFinder.find_spec(part, search_path)
+        found = ".".join(parts[: index + 1])
+        if spec is None:
+            raise ValueError(f"can't find the module '{found}'")
+        if root is None:
+            locations = list(spec.submodule_search_locations or [])
+            root = os.path.dirname(locations[0] if locations else spec.origin)
+        if index + 1 < len(parts):
+            if spec.submodule_search_locations is None:
+                raise ValueError(f"'{found}' isn't a package")
+            search_path = list(spec.submodule_search_locations)
+    if spec.origin is None or not spec.origin.endswith(".py"):
+        raise ValueError(f"the module '{module_name}' isn't a python source file")
+    return spec.origin, root
+
+
+def find_defined_names(tree: ast.Module) -> set[str]:
+    """
+    Returns the names a module defines at its top level: functions, classes, assignments and imports.
+
+    The statements under if, try and with are included, not the bodies of the functions and classes.
+    """
+    names: set[str] = set()
+    statements = list(tree.body)
+    while statements:
+        statement = statements.pop()
+        if isinstance(
+            statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+        ):
+            names.add(statement.name)
+        elif isinstance(statement, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = (
+                statement.targets
+                if isinstance(statement, ast.Assign)
+                else [statement.target]
+            )
+            for target in targets:
+                names.update(
+                    node.id for node in ast.walk(target) if isinstance(node, ast.Name)
+                )
+        elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+            names.update(
+                (alias.asname or alias.name).split(".")[0] for alias in statement.names
+            )
+        elif isinstance(statement, (ast.If, ast.Try, ast.With)):
+            statements.extend(statement.body)
+            statements.extend(getattr(statement, "orelse", []))
+            statements.extend(getattr(statement, "finalbody", []))
+            for handler in getattr(statement, "handlers", []):
+                statements.extend(handler.body)
+    return names
+
+
+class DefinedNamesCache:
+    """
+    The names defined by each module file, parsed again only when the file changes.
+
+    Menus often reference many functions of the same module, which is then only parsed once.
+    """
+
+    def __init__(self) -> None:
+        self.names: dict[str, tuple[tuple[int, int], set[str]]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> set[str]:
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.names.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path, "rb") as module_file:
+            names = find_defined_names(ast.parse(module_file.read(), path))
+        with self.lock:
+            self.names[path] = (signature, names)
+        return names
+
+
+_defined_names = DefinedNamesCache()
+
+
+def resolve_reference(reference: str) -> MethodInfo:
+    """
+    Returns the method info of a referenced function, like get_method_info does for a function object.
+
+    The module keeps its dotted name, imported from the directory its top-level package is in, so its relative
+    imports work and it can't shadow a module of the same name.
+
+    Raises a ValueError if the module can't be found or doesn't define the function, and a SyntaxError if it can't
+    be parsed.
+
+    Returns a tuple (function name, module name, path to the directory of its top-level package)
+    """
+    module_name, func_name = split_reference(reference)
+    func_file_path, root = find_module_file(module_name)
+    if func_name not in _defined_names.get(os.path.abspath(func_file_path)):
+        raise ValueError(f"the module '{module_name}' has no function '{func_name}'")
+
+    return (func_name, module_name, os.path.abspath(root).replace("\\", "/"))
+
+
+def import_reference(reference: str) -> Callable[..., Any]:
+    """
+    Imports a referenced function. Used when the function runs in the current process, as the dynamic items do.
+    """
+    import importlib
+
+    module_name, func_name = split_reference(reference)
+    return getattr(importlib.import_module(module_name), func_name)
@@ -0,0 +1,339 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from context_menu import callbacks, launcher, templates, tree
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Tuple
+
+    from context_menu.menus import ItemType
+
+    CacheEntry = Tuple[float, list]
+    ItemsProvider = Callable[[list], list]
+
+# dynamic.py -------------------------------------
+#
+# Menus whose items are computed by a python function when the menu is opened,
+# instead of when it is compiled. On Linux, the generated extension calls
+# append_items() on every right click, so everything here has to stay fast.
+
+# Seconds a computed list of items is served before being refreshed
+DEFAULT_TTL = 30.0
+
+# Number of selections whose items are cached, the least recently used are evicted
+MAX_ENTRIES = 64
+
+# Seconds a right click waits for a provider before showing PLACEHOLDER_LABEL instead of its items
+DEFAULT_BUDGET = 0.03
+
+PLACEHOLDER_LABEL = "Loading..."
+
+
+def get_unquoted_paths(files: list[Any]) -> list[str]:
+    """
+    Returns the paths of the Nautilus files.
+    """
+    from urllib.parse import unquote
+
+    return [unquote(file.get_uri()[7:]) for file in files]
+
+
+def selection_signature(provider: ItemsProvider, filenames: list[str]) -> str:
+    """
+    Returns the key of the items of a provider for a selection.
+    """
+    parts = [getattr(provider, "__module__", ""), getattr(provider, "__qualname__", "")]
+    return launcher.command_key(*parts, *filenames)
+
+
+class ItemCache:
+    """
+    Caches the items returned by the providers, for ttl seconds and at most max_entries selections.
+
+    Once expired, an entry is still served while it is refreshed in the background.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        # Set once the items being computed are cached
+        self.refreshing: dict[str, threading.Event] = {}
+        # Called once the items being computed are cached, if computing them succeeded
+        self.callbacks: dict[str, list[Callable[[], None]]] = {}
+        self.lock = threading.Lock()
+
+    def get(
+        self,
+        key: str,
+        compute: Callable[[], list],
+        ttl: float,
+        budget: float | None = None,
+        on_ready: Callable[[], None] | None = None,
+    ) -> list | None:
+        """
+        Returns the cached items of key, computing them if they aren't cached.
+
+        With a budget, the items are computed in the background, and None is returned if they aren't
+        ready after budget seconds. on_ready is then called once they are.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None:
+            if time.monotonic() - entry[0] > ttl:
+                self.refresh(key, compute)
+            return entry[1]
+
+        if budget is None:
+            items = compute()
+            self.put(key, items)
+            return items
+        ready = self.refresh(key, compute)
+        if ready.wait(budget):
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None:
+                return entry[1]
+        if on_ready is not None:
+            with self.lock:
+                if key in self.refreshing:
+                    self.callbacks.setdefault(key, []).append(on_ready)
+                    return None
+            # Became ready in the meantime
+            on_ready()
+        return None
+
+    def put(self, key: str, items: list) -> None:
+        """
+        Caches the items of key, evicting the least recently used entries if needed.
+        """
+        with self.lock:
+            self.entries[key] = (time.monotonic(), items)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def refresh(self, key: str, compute: Callable[[], list]) -> threading.Event:
+        """
+        Computes the items of key again in a background thread, unless it is already being done.
+
+        Returns an event set once it is done.
+        """
+        with self.lock:
+            if key in self.refreshing:
+                return self.refreshing[key]
+            ready = self.refreshing[key] = threading.Event()
+
+        def run() -> None:
+            try:
+                self.put(key, compute())
+                succeeded = True
+            except Exception:
+                traceback.print_exc()
+                # The failure is cached too, so a broken provider isn't called again on every redraw:
+                # the stale items are kept if any, otherwise there are no items
+                with self.lock:
+                    entry = self.entries.get(key)
+                self.put(key, entry[1] if entry is not None else [])
+                succeeded = False
+            with self.lock:
+                del self.refreshing[key]
+                callbacks = self.callbacks.pop(key, [])
+            ready.set()
+            # Nautilus queries the items again when called back, only worth it if there are new ones
+            if succeeded:
+                for callback in callbacks:
+                    callback()
+
+        threading.Thread(target=run, daemon=True).start()
+        return ready
+
+
+_cache = ItemCache()
+
+
+def get_items(
+    provider: ItemsProvider,
+    filenames: list[str],
+    ttl: float = DEFAULT_TTL,
+    budget: float | None = None,
+    on_ready: Callable[[], None] | None = None,
+) -> list[ItemType] | None:
+    """
+    Returns the items of a provider for the selected files, through the cache.
+
+    With a budget, returns None if the items aren't ready after budget seconds, see ItemCache.get.
+    A failing provider gives no items rather than breaking the whole menu.
+    """
+    try:
+        return _cache.get(
+            selection_signature(provider, filenames),
+            lambda: list(provider(filenames)),
+            ttl,
+            budget,
+            on_ready,
+        )
+    except Exception:
+        traceback.print_exc()
+        return []
+
+
+# nautilus -------------------------------------
+
+
+def activate(item: ItemType, filenames: list[str]) -> None:
+    """
+    Runs a command item built at right click time, the same way as the handlers of the generated extensions.
+    """
+    if item.python != None:
+        launch_options = item.get_launch_options()
+        if not launch_options:
+            python = item.python
+            if isinstance(python, str):
+                python = callbacks.import_reference(python)
+            python(filenames, item.params)
+            return
+        func_name, func_file_name, func_dir_path = item.get_method_info()
+        launch_code = launcher.build_launch_code(
+            func_name,
+            func_file_name,
+            func_dir_path,
+            item.params,
+            "sys.argv[1:]",
+            launch_options,
+        )
+        launcher.spawn(
+            sys.executable,
+            launch_code,
+            filenames,
+            launch_options.get("trace", False),
+            launch_options.get("headless", False),
+        )
+        return
+
+    template = templates.CommandTemplate.from_command(item.command, item.command_vars)
+    if item.per_file:
+        per_file_code = launcher.build_per_file_code(
+            template.tokens, template.quote, "sys.argv[1:]", item.max_parallel
+        )
+        launcher.spawn(sys.executable, per_file_code, filenames)
+        return
+    templates.run_command(template, filenames)
+
+
+def build_nautilus_items(
+    Nautilus: Any, items: list[ItemType], filenames: list[str], prefix: str
+) -> list[Any]:
+    """
+    Creates the Nautilus menu items of the items, with their sub menus, running the commands on filenames.
+    """
+    top_items: list[Any] = []
+    open_menus = [top_items.append]
+    for event, item in tree.walk(items):
+        if event == tree.EXIT:
+            open_menus.pop()
+            continue
+        menu_item = Nautilus.MenuItem(
+            name=f"{prefix}::{item.name}", label=item.name, tip="", icon=""
+        )
+        open_menus[-1](menu_item)
+        if event == tree.ENTER:
+            sub_menu = Nautilus.Menu()
+            menu_item.set_submenu(sub_menu)
+            open_menus.append(sub_menu.append_item)
+        else:
+            menu_item.connect(
+                "activate", lambda menu_item, item=item: activate(item, filenames)
+            )
+    return top_items
+
+
+def emit_items_updated(menu_provider: Any) -> None:
+    """
+    Tells Nautilus to query the items of the extension again, from the main loop.
+    """
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        menu_provider.emit_items_updated_signal()
+        return
+
+    def emit() -> bool:
+        menu_provider.emit_items_updated_signal()
+        return False
+
+    GLib.idle_add(emit)
+
+
+def append_items(
+    Nautilus: Any,
+    menu: Any,
+    files: list[Any],
+    provider: ItemsProvider,
+    ttl: float = DEFAULT_TTL,
+    budget: float | None = DEFAULT_BUDGET,
+    menu_provider: Any = None,
+) -> None:
+    """
+    Appends the items of a provider for the selected files to a Nautilus menu. Called by the generated extensions.
+
+    If the provider takes more than budget seconds, a placeholder is shown instead, and the items-updated
+    signal of menu_provider is emitted once the items are ready, so Nautilus shows them.
+    """
+    filenames = get_unquoted_paths(files)
+    prefix = "ContextMenuDynamic::" + selection_signature(provider, [])
+    on_ready = None
+    if menu_provider is not None:
+        on_ready = lambda: emit_items_updated(menu_provider)
+    items = get_items(provider, filenames, ttl, budget, on_ready)
+    if items is None:
+        placeholder = Nautilus.MenuItem(
+            name=f"{prefix}::placeholder", label=PLACEHOLDER_LABEL, tip="", icon=""
+        )
+        placeholder.set_property("sensitive", False)
+        menu.append_item(placeholder)
+        return
+    for menu_item in build_nautilus_items(Nautilus, items, filenames, prefix):
+        menu.append_item(menu_item)
+
+
+# windows -------------------------------------
+
+
+def snapshot(items: list[ItemType]) -> list[ItemType]:
+    """
+    Returns the items with the items of the providers added to their menus, computed once with no selection.
+
+    Used on Windows, where the registry can't call python when a menu opens. The menus are copied, so the
+    items themselves aren't changed.
+    """
+    if not any(
+        event == tree.ENTER and item.items_provider != None
+        for event, item in tree.walk(items)
+    ):
+        return items
+
+    from context_menu.menus import ContextMenu
+
+    top_items: list[ItemType] = []
+    open_menus = [top_items]
+    for event, item in tree.walk(items):
+        if event == tree.ENTER:
+            copy = ContextMenu(item.name)
+            open_menus[-1].append(copy)
+            open_menus.append(copy.sub_items)
+        elif event == tree.EXIT:
+            sub_items = open_menus.pop()
+            if item.items_provider != None:
+                sub_items.extend(item.items_provider([]))
+        else:
+            open_menus[-1].append(item)
+    return top_items
@@ -0,0 +1,253 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+if TYPE_CHECKING:
+    from typing import Any, Iterator
+
+    from context_menu.menus import ActivationType
+
+    IndexEntry = dict[str, Any]
+
+# index.py -------------------------------------
+#
+# A small local record of the menus compiled on this machine, so they can be
+# listed and removed without walking the registry or the extensions directory.
+#
+# The index is a log of JSON lines, each setting or removing the entry of one
+# menu, so recording a menu appends a line instead of rewriting the file. The
+# log is read incrementally, and compacted once it is mostly superseded lines.
+
+# Overrides the location of the index, mostly for testing
+INDEX_ENV_VAR = "CONTEXT_MENU_INDEX"
+
+# Number of lines under which the log is never compacted
+COMPACT_MIN_LINES = 256
+
+# A lock file older than this many seconds is left over by a crashed process and can be taken over
+STALE_LOCK_AGE = 10.0
+
+_lock = threading.Lock()
+# Entries of the log read so far, with the file they were read from and how far
+_cache: dict[str, Any] = {
+    "path": None,
+    "inode": None,
+    "offset": 0,
+    "lines": 0,
+    "entries": {},
+}
+
+
+def get_index_path() -> str:
+    """
+    Returns the path of the index file.
+
+    %APPDATA%\\context_menu\\index.jsonl on Windows, ~/.local/share/context_menu/index.jsonl otherwise.
+    """
+    if os.environ.get(INDEX_ENV_VAR):
+        return os.environ[INDEX_ENV_VAR]
+    if os.name == "nt" and os.environ.get("APPDATA"):
+        data_dir = os.environ["APPDATA"]
+    else:
+        data_dir = os.environ.get("XDG_DATA_HOME") or os.path.join(
+            os.path.expanduser("~"), ".local/share"
+        )
+    return os.path.join(data_dir, "context_menu", "index.jsonl")
+
+
+def entry_key(name: str, type: ActivationType | str | None) -> str:
+    """
+    Returns the key of a menu in the index.
+
+    For example, ('Foo menu', 'files') -> 'FILES:Foo menu'
+    """
+    return f"{(type or '').upper()}:{name}"
+
+
+def _load() -> dict[str, IndexEntry]:
+    """
+    Returns the entries of the index, only reading the lines appended since it was last read.
+
+    The whole log is read again if it was compacted in the meantime.
+    """
+    path = get_index_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _cache.update(path=path, inode=None, offset=0, lines=0, entries={})
+        return _cache["entries"]
+    if (
+        _cache["path"] != path
+        or _cache["inode"] != stat.st_ino
+        or stat.st_size < _cache["offset"]
+    ):
+        _cache.update(path=path, inode=stat.st_ino, offset=0, lines=0, entries={})
+    if stat.st_size == _cache["offset"]:
+        return _cache["entries"]
+
+    with open(path, "rb") as index_file:
+        index_file.seek(_cache["offset"])
+        data = index_file.read()
+    # A line being appended by another process is read next time
+    complete = data[: data.rfind(b"\n") + 1]
+    entries = _cache["entries"]
+    for line in complete.splitlines():
+        if not line.strip():
+            continue
+        change = json.loads(line)
+        if change["entry"] is None:
+            entries.pop(change["key"], None)
+        else:
+            entries[change["key"]] = change["entry"]
+        _cache["lines"] += 1
+    _cache["offset"] += len(complete)
+    return entries
+
+
+@contextmanager
+def _file_lock(path: str) -> Iterator[None]:
+    """
+    Holds the lock file next to the index, so other processes neither append to it nor compact it meanwhile.
+
+    Like the lock of launcher.coalesce(), it is a file created exclusively, taken over once it is stale.
+    """
+    lock_path = path + ".lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_AGE:
+                    os.remove(lock_path)
+            except OSError:
+                # The holder released it in the meantime
+                pass
+            time.sleep(0.01)
+            continue
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        break
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+def _append(key: str, entry: IndexEntry | None) -> None:
+    """
+    Appends a line setting the entry of key, or removing it if entry is None, then compacts the log if needed.
+    """
+    path = get_index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = json.dumps({"key": key, "entry": entry}, sort_keys=True) + "\n"
+    with _file_lock(path):
+        with open(path, "ab") as index_file:
+            index_file.write(line.encode("utf-8"))
+        # Read to the end under the lock, so the compacted log has the lines of every process
+        entries = _load()
+        if _cache["lines"] > max(COMPACT_MIN_LINES, 2 * len(entries)):
+            _compact(entries)
+
+
+def _compact(entries: dict[str, IndexEntry]) -> None:
+    """
+    Atomically replaces the log with one line per entry.
+    """
+    path = get_index_path()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+        for key, entry in sorted(entries.items()):
+            tmp_file.write(json.dumps({"key": key, "entry": entry}, sort_keys=True) + "\n")
+    os.replace(tmp_path, path)
+    _cache["inode"] = None
+    _load()
+
+
+def record(
+    name: str,
+    type: ActivationType | str,
+    backend: str,
+    location: str,
+    content_hash: str,
+    journal: list[list[Any]] | None = None,
+    store: list[str] | None = None,
+) -> IndexEntry:
+    """
+    Records a compiled menu, replacing the previous entry with the same name and type.
+
+    backend is 'nautilus', 'table' or 'registry', location the extension file, the table or the registry key.
+    If given, the journal of a transactional compilation is kept with the previous entry, so it can be rolled back.
+    store lists the shared store entries the menu references, if it was compiled with shared_store.
+    """
+    entry: IndexEntry = {
+        "name": name,
+        "type": type.upper(),
+        "backend": backend,
+        "location": location,
+        "hash": content_hash,
+        "timestamp": time.time(),
+    }
+    if store is not None:
+        entry["store"] = store
+    with _lock:
+        key = entry_key(name, type)
+        if journal is not None:
+            previous = _load().get(key)
+            if previous is not None:
+                # Only the last deploy can be rolled back
+                previous = {
+                    k: v
+                    for k, v in previous.items()
+                    if k not in ("journal", "previous")
+                }
+            entry["journal"] = journal
+            entry["previous"] = previous
+        _append(key, entry)
+    return entry
+
+
+def restore(entry: IndexEntry) -> None:
+    """
+    Puts back an entry removed or replaced since.
+    """
+    with _lock:
+        _append(entry_key(entry["name"], entry["type"]), entry)
+
+
+def forget(name: str, type: ActivationType | str) -> IndexEntry | None:
+    """
+    Removes a menu from the index. Returns its entry, if there was one.
+    """
+    with _lock:
+        key = entry_key(name, type)
+        entry = copy.deepcopy(_load().get(key))
+        if entry is not None:
+            _append(key, None)
+    return entry
+
+
+def lookup(name: str, type: ActivationType | str) -> IndexEntry | None:
+    """
+    Returns the entry of a menu, or None if it isn't in the index.
+    """
+    with _lock:
+        # A copy, so changing it doesn't change the cached entries
+        return copy.deepcopy(_load().get(entry_key(name, type)))
+
+
+def entries() -> list[IndexEntry]:
+    """
+    Returns all the entries of the index, sorted by type and name.
+    """
+    with _lock:
+        return [copy.deepcopy(entry) for _, entry in sorted(_load().items())]
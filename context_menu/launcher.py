@@ -0,0 +1,845 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import hashlib
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+if TYPE_CHECKING:
+    from typing import Any, Iterable
+
+# launcher.py -------------------------------------
+#
+# This module is imported by the commands that the menus generate, so it runs
+# on every click. Keep it free of heavy imports.
+
+# Default values of the options that change how a callback is launched.
+# Only the options that differ from these are written in the generated commands.
+LAUNCH_DEFAULTS: dict[str, Any] = {
+    "single_instance": False,
+    "coalesce_window": 0.5,
+    "timeout": None,
+    "max_memory": None,
+    "nice": None,
+    "trace": False,
+    "headless": False,
+}
+
+# Values of the MultiSelectModel registry value. With the last two, Explorer starts one
+# process per selected file, so the invocations are merged like with single_instance.
+MULTI_SELECT_MODELS = ("Single", "Document", "Player")
+AGGREGATED_MULTI_SELECT_MODELS = ("Document", "Player")
+
+# The options enforced by running the callback in a watched child process
+WATCHDOG_OPTIONS = ("timeout", "max_memory", "nice")
+
+# Set in the environment of the watched child, so it runs the callback itself
+SUPERVISED_ENV_VAR = "CONTEXT_MENU_SUPERVISED"
+
+# Exit code of a watched child whose callback ran out of memory
+MEMORY_EXIT_CODE = 137
+
+# Seconds between asking a timed out child to terminate and killing it
+KILL_GRACE = 2.0
+
+# Default number of commands run at the same time for per_file commands
+MAX_PARALLEL = 4
+
+# Directory holding the context_menu package, added to the path of the generated commands
+PACKAGE_PARENT_DIR = os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))
+).replace("\\", "/")
+
+# Holds the id of a traced invocation, passed from the handler to the processes it starts
+TRACE_ENV_VAR = "CONTEXT_MENU_TRACE_ID"
+
+# Stages of a traced invocation, in order
+TRACE_STAGES = ("handler", "spawn", "ready", "imported", "start", "end")
+
+# Size after which the trace file is rotated, and number of rotated files kept
+MAX_TRACE_BYTES = 1024 * 1024
+TRACE_BACKUPS = 2
+
+# Bytes of output a headless callback keeps in memory, only the last ones are logged
+OUTPUT_BUFFER_BYTES = 64 * 1024
+
+# Size after which the output log of a command is rotated, and number of rotated files kept
+MAX_OUTPUT_LOG_BYTES = 1024 * 1024
+OUTPUT_LOG_BACKUPS = 2
+
+# Size after which the watchdog log is rotated, and number of rotated files kept
+MAX_WATCHDOG_LOG_BYTES = 1024 * 1024
+WATCHDOG_LOG_BACKUPS = 2
+
+# A lock older than the coalesce window plus this grace period is left over
+# from a crashed instance and can be taken over.
+STALE_LOCK_GRACE = 5.0
+
+
+def get_runtime_dir() -> str:
+    """
+    Returns the directory holding the locks and spooled selections, creating it if needed.
+    """
+    runtime_dir = os.path.join(tempfile.gettempdir(), "context_menu")
+    os.makedirs(runtime_dir, exist_ok=True)
+    return runtime_dir
+
+
+def command_key(*parts: str) -> str:
+    """
+    Creates a short, file-system safe identifier for a command from its parts.
+
+    For example, ('foo', 'bar', '') -> '0b9a3f6c5d6e4a2b'
+    """
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def filter_launch_options(options: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns only the options that differ from LAUNCH_DEFAULTS.
+    """
+    return {
+        name: value
+        for name, value in options.items()
+        if name in LAUNCH_DEFAULTS and value != LAUNCH_DEFAULTS[name]
+    }
+
+
+def build_launch_code(
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    files_code: str,
+    options: dict[str, Any],
+) -> str:
+    """
+    Creates the python code that runs a callback through launch().
+
+    files_code is the python expression giving the list of selected files, for example 'sys.argv[1:]'.
+    With trace, the time the interpreter is ready is taken first thing and passed as 'ready'.
+    """
+    options = dict(options)
+    if options.get("single_instance") and "key" not in options:
+        options["key"] = command_key(func_file_name, func_name, params)
+    formatted_options = "".join(
+        f", {name}={value!r}" for name, value in sorted(options.items())
+    )
+    ready_code = ""
+    if options.get("trace"):
+        ready_code = "import time; ready = time.time(); "
+        formatted_options += ", ready=ready"
+    func_dir_path = func_dir_path.replace("\\", "/")
+    return (
+        f"{ready_code}import sys; import os; sys.path.insert(0, '{func_dir_path}'); "
+        f"from context_menu import launcher; "
+        f"launcher.launch('{func_file_name}', '{func_name}', {files_code}, "
+        f"'{params}'{formatted_options})"
+    )
+
+
+def build_per_file_code(
+    tokens: list[tuple[str, str]],
+    quote: bool,
+    files_code: str,
+    max_parallel: int = MAX_PARALLEL,
+    key: str | None = None,
+) -> str:
+    """
+    Creates the python code that runs a command template once per selected file through run_per_file().
+
+    With a key, the selections of invocations started at the same time are merged first.
+    """
+    formatted_key = f", key={key!r}" if key is not None else ""
+    return (
+        f"import sys; import os; sys.path.insert(0, '{PACKAGE_PARENT_DIR}'); "
+        f"from context_menu import launcher; "
+        f"launcher.run_per_file({tokens!r}, {files_code}, {quote!r}, "
+        f"max_parallel={max_parallel!r}{formatted_key})"
+    )
+
+
+def spawn(
+    python_loc: str,
+    code: str,
+    filenames: list[str],
+    trace: bool = False,
+    headless: bool = False,
+) -> subprocess.Popen:
+    """
+    Runs the launch code in a new interpreter, without waiting for it.
+
+    Used by the Linux handlers so the file manager never blocks on a callback.
+    With trace, the invocation gets an id passed to the new interpreter, and the handler and spawn stages are recorded.
+    With headless, the interpreter doesn't write to the output of the file manager, the launcher logs it instead.
+    """
+    output = subprocess.DEVNULL if headless else None
+    env = None
+    if trace:
+        trace_id = new_trace_id()
+        record_trace(trace_id, "handler")
+        env = dict(os.environ, **{TRACE_ENV_VAR: trace_id})
+    process = subprocess.Popen(
+        [python_loc, "-c", code] + list(filenames),
+        stdin=subprocess.DEVNULL,
+        stdout=output,
+        stderr=output,
+        start_new_session=True,
+        env=env,
+    )
+    if trace:
+        record_trace(trace_id, "spawn")
+    return process
+
+
+# single instance ------------------------------------
+
+
+def _write_selection(spool_dir: str, filenames: list[str]) -> str:
+    """
+    Atomically adds a selection to the spool directory.
+    """
+    name = f"{time.time_ns()}-{os.getpid()}.sel"
+    tmp_path = os.path.join(spool_dir, name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as sel_file:
+        json.dump(filenames, sel_file)
+    path = os.path.join(spool_dir, name)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _claim_selections(spool_dir: str) -> list[str]:
+    """
+    Takes every spooled selection, in arrival order.
+
+    A selection is claimed by renaming it, so that two collectors never get the same one.
+    """
+    filenames = []
+    for name in sorted(os.listdir(spool_dir)):
+        if not name.endswith(".sel"):
+            continue
+        path = os.path.join(spool_dir, name)
+        claimed_path = f"{path}.{os.getpid()}"
+        try:
+            os.rename(path, claimed_path)
+        except OSError:
+            # Another collector was faster
+            continue
+        try:
+            with open(claimed_path, encoding="utf-8") as sel_file:
+                filenames.extend(json.load(sel_file))
+        finally:
+            os.remove(claimed_path)
+    return filenames
+
+
+def _acquire_lock(lock_path: str, window: float) -> bool:
+    """
+    Tries to create the lock file. Takes over locks left by crashed instances.
+    """
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(lock_path)
+            except OSError:
+                # The holder released it in the meantime
+                continue
+            if age < window + STALE_LOCK_GRACE:
+                return False
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            continue
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return True
+    return False
+
+
+def coalesce(
+    key: str, filenames: Iterable[str], window: float = LAUNCH_DEFAULTS["coalesce_window"]
+) -> list[str] | None:
+    """
+    Merges the selections of invocations of the same command started within 'window' seconds.
+
+    The first invocation takes a lock, waits for the window to pass and returns the merged,
+    deduplicated selection. The later ones hand their selection over and return None, meaning
+    there is nothing left to do. So does a first invocation whose selection was already taken.
+    """
+    spool_dir = os.path.join(get_runtime_dir(), key)
+    os.makedirs(spool_dir, exist_ok=True)
+    lock_path = spool_dir + ".lock"
+
+    # The selection is spooled before trying the lock, so the holder always sees it
+    _write_selection(spool_dir, list(filenames))
+    if not _acquire_lock(lock_path, window):
+        return None
+
+    try:
+        time.sleep(window)
+        merged = _claim_selections(spool_dir)
+    finally:
+        os.remove(lock_path)
+    # Catches the selections spooled while the lock was being released
+    merged.extend(_claim_selections(spool_dir))
+    if not merged:
+        # The previous holder took every selection, this one included, just before releasing the lock
+        return None
+
+    return list(dict.fromkeys(merged))
+
+
+def launch(
+    func_file_name: str,
+    func_name: str,
+    filenames: list[str],
+    params: str,
+    key: str | None = None,
+    single_instance: bool = LAUNCH_DEFAULTS["single_instance"],
+    coalesce_window: float = LAUNCH_DEFAULTS["coalesce_window"],
+    timeout: float | None = LAUNCH_DEFAULTS["timeout"],
+    max_memory: int | None = LAUNCH_DEFAULTS["max_memory"],
+    nice: int | None = LAUNCH_DEFAULTS["nice"],
+    trace: bool = LAUNCH_DEFAULTS["trace"],
+    headless: bool = LAUNCH_DEFAULTS["headless"],
+    ready: float | None = None,
+) -> None:
+    """
+    Imports the callback and calls it with the selected files, applying the launch options.
+
+    With timeout, max_memory or nice, the callback runs in a child process watched by this one, see supervise().
+    With trace, the stages of the invocation are recorded in the trace file, see record_trace(). ready is the time
+    the interpreter was ready, the time launch is called by default.
+    With headless, what the callback prints goes to the output log of the command, see OutputCapture.
+    """
+    supervised = os.environ.pop(SUPERVISED_ENV_VAR, None) != None
+    # The watched child is traced whenever its parent is
+    trace_id = os.environ.get(TRACE_ENV_VAR) if trace or supervised else None
+    if trace and trace_id == None:
+        # Started by the file manager itself, as on Windows
+        trace_id = os.environ[TRACE_ENV_VAR] = new_trace_id()
+    entry = f"{func_file_name}.{func_name}"
+    if trace_id != None:
+        record_trace(trace_id, "ready", entry, ready)
+
+    if single_instance:
+        coalesced = coalesce(
+            key or command_key(func_file_name, func_name, params),
+            filenames,
+            coalesce_window,
+        )
+        if coalesced is None:
+            if trace_id != None:
+                record_trace(trace_id, "merged", entry)
+            return
+        filenames = coalesced
+
+    if not supervised and (timeout, max_memory, nice) != (None, None, None):
+        supervise(
+            func_file_name,
+            func_name,
+            filenames,
+            params,
+            timeout,
+            max_memory,
+            nice,
+            headless,
+        )
+        return
+
+    capture = OutputCapture(entry) if headless else None
+    if capture is not None:
+        capture.start()
+    try:
+        try:
+            # Importing the module counts against max_memory too
+            module = importlib.import_module(func_file_name)
+            if trace_id != None:
+                record_trace(trace_id, "imported", entry)
+            func = getattr(module, func_name)
+            if trace_id != None:
+                record_trace(trace_id, "start", entry)
+            try:
+                func(filenames, params)
+            finally:
+                if trace_id != None:
+                    record_trace(trace_id, "end", entry)
+        except MemoryError:
+            if not supervised:
+                raise
+            # Lets the watchdog know why the callback failed
+            print(f"{func_file_name}.{func_name} ran out of memory", file=sys.stderr)
+            sys.stderr.flush()
+            if capture is not None:
+                capture.stop()
+            os._exit(MEMORY_EXIT_CODE)
+    except BaseException:
+        if capture is None:
+            raise
+        # pythonw has nowhere to show the traceback
+        import traceback
+
+        traceback.print_exc()
+        raise
+    finally:
+        if capture is not None:
+            capture.stop()
+
+
+# tracing ------------------------------------
+
+
+def get_trace_path() -> str:
+    """
+    Returns the path of the file where the stages of the traced invocations are recorded.
+    """
+    return os.path.join(get_runtime_dir(), "trace.log")
+
+
+def new_trace_id() -> str:
+    """
+    Returns a new id for an invocation.
+    """
+    return os.urandom(6).hex()
+
+
+def rotate_file(path: str, backups: int = TRACE_BACKUPS) -> None:
+    """
+    Moves a log file, such as the trace file, to path.1, path.1 to path.2 and so on, keeping 'backups' files.
+    """
+    for backup in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{backup}"):
+            os.replace(f"{path}.{backup}", f"{path}.{backup + 1}")
+    os.replace(path, f"{path}.1")
+
+
+def record_trace(
+    trace_id: str, stage: str, entry: str | None = None, at: float | None = None
+) -> None:
+    """
+    Appends a stage of an invocation to the trace file, at the current time by default.
+
+    Each stage is a single small append, so the processes of an invocation can record theirs concurrently.
+    Tracing never makes a click fail: errors writing the file are ignored.
+    """
+    record: dict[str, Any] = {
+        "id": trace_id,
+        "stage": stage,
+        "time": time.time() if at == None else at,
+        "pid": os.getpid(),
+    }
+    if entry != None:
+        record["entry"] = entry
+    path = get_trace_path()
+    try:
+        if os.path.exists(path) and os.path.getsize(path) > MAX_TRACE_BYTES:
+            rotate_file(path)
+    except OSError:
+        # Another process rotated it first
+        pass
+    try:
+        with open(path, "a", encoding="utf-8") as trace_file:
+            trace_file.write(json.dumps(record) + "\n")
+    except OSError:
+        pass
+
+
+def read_traces(path: str | None = None) -> list[dict[str, Any]]:
+    """
+    Returns the records of the trace file and of its rotated files, oldest first.
+    """
+    path = path or get_trace_path()
+    records = []
+    for backup in range(TRACE_BACKUPS, -1, -1):
+        file_path = f"{path}.{backup}" if backup else path
+        try:
+            with open(file_path, encoding="utf-8") as trace_file:
+                lines = trace_file.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Cut by a crash or a rotation
+                continue
+    return records
+
+
+def summarize_traces(records: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """
+    Returns the latency of each stage of the invocations, per entry ('module.function').
+
+    The latency of a stage is the time since the previous stage recorded for the invocation, 'total' the time from
+    the first stage to the last. For each, the median, 90th percentile and maximum are given in seconds.
+    Invocations merged into another by single_instance are only counted.
+    """
+    invocations: dict[str, dict[str, float]] = {}
+    entries: dict[str, str] = {}
+    for record in records:
+        # The last time of a stage wins, a watched child records it after its parent
+        invocations.setdefault(record["id"], {})[record["stage"]] = record["time"]
+        if "entry" in record:
+            entries[record["id"]] = record["entry"]
+
+    latencies: dict[str, dict[str, list[float]]] = {}
+    summary: dict[str, dict[str, Any]] = {}
+    for trace_id, stages in invocations.items():
+        entry = entries.get(trace_id, "?")
+        entry_summary = summary.setdefault(
+            entry, {"invocations": 0, "merged": 0, "stages": {}}
+        )
+        entry_summary["invocations"] += 1
+        if "merged" in stages:
+            entry_summary["merged"] += 1
+            continue
+        times = [(stage, stages[stage]) for stage in TRACE_STAGES if stage in stages]
+        entry_latencies = latencies.setdefault(entry, {})
+        for (_, previous), (stage, current) in zip(times, times[1:]):
+            entry_latencies.setdefault(stage, []).append(current - previous)
+        if len(times) > 1:
+            entry_latencies.setdefault("total", []).append(times[-1][1] - times[0][1])
+
+    for entry, entry_latencies in latencies.items():
+        for stage, values in entry_latencies.items():
+            values.sort()
+            summary[entry]["stages"][stage] = {
+                "median": values[len(values) // 2],
+                "p90": values[min(len(values) - 1, int(len(values) * 0.9))],
+                "max": values[-1],
+            }
+    return summary
+
+
+def format_trace_summary(summary: dict[str, dict[str, Any]]) -> str:
+    """
+    Formats a summary of the traces as a table, with the median and 90th percentile of each stage in milliseconds.
+    """
+    columns = list(TRACE_STAGES[1:]) + ["total"]
+    lines = [
+        "\t".join(["entry", "invocations", "merged"] + columns),
+    ]
+    for entry, entry_summary in sorted(summary.items()):
+        cells = [entry, str(entry_summary["invocations"]), str(entry_summary["merged"])]
+        for stage in columns:
+            stats = entry_summary["stages"].get(stage)
+            cells.append(
+                "-"
+                if stats is None
+                else f"{stats['median'] * 1000:.1f} ({stats['p90'] * 1000:.1f})"
+            )
+        lines.append("\t".join(cells))
+    return "\n".join(lines)
+
+
+# headless ------------------------------------
+
+
+def get_output_log_path(entry: str) -> str:
+    """
+    Returns the path of the file where the output of the headless callback 'entry' (module.function) is logged.
+    """
+    return os.path.join(get_runtime_dir(), "output", f"{entry}.log")
+
+
+class OutputCapture(io.TextIOBase):
+    """
+    Stands in for sys.stdout and sys.stderr while a headless callback runs.
+
+    The output is kept in a ring buffer of max_bytes bytes, so a noisy callback only holds its last max_bytes bytes
+    in memory. When stopped, they are appended to the output log of the command, rotated once it reaches
+    MAX_OUTPUT_LOG_BYTES. Only what goes through sys.stdout and sys.stderr is captured, not the output of the
+    processes the callback starts.
+    """
+
+    def __init__(self, entry: str, max_bytes: int = OUTPUT_BUFFER_BYTES) -> None:
+        super().__init__()
+        self.entry = entry
+        self.buffer = bytearray(max_bytes)
+        # Number of bytes written so far, including the ones overwritten since
+        self.written = 0
+        self.saved_streams: tuple[Any, Any] | None = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        data = text.encode("utf-8", "replace")
+        size = len(self.buffer)
+        end = self.written + len(data)
+        data = data[-size:]
+        start = (end - len(data)) % size
+        head = min(len(data), size - start)
+        self.buffer[start : start + head] = data[:head]
+        self.buffer[: len(data) - head] = data[head:]
+        self.written = end
+        return len(text)
+
+    def getvalue(self) -> bytes:
+        """
+        Returns the output kept in the buffer, oldest first.
+        """
+        size = len(self.buffer)
+        if self.written <= size:
+            return bytes(self.buffer[: self.written])
+        start = self.written % size
+        return bytes(self.buffer[start:] + self.buffer[:start])
+
+    def start(self) -> None:
+        """
+        Redirects sys.stdout and sys.stderr to the buffer.
+        """
+        self.saved_streams = (sys.stdout, sys.stderr)
+        sys.stdout = sys.stderr = self
+
+    def stop(self) -> None:
+        """
+        Restores sys.stdout and sys.stderr, and logs the output, if any. Errors writing the log are ignored.
+        """
+        if self.saved_streams is None:
+            return
+        sys.stdout, sys.stderr = self.saved_streams
+        self.saved_streams = None
+        if not self.written:
+            return
+
+        header = f"--- {time.strftime('%Y-%m-%d %H:%M:%S')} pid {os.getpid()}"
+        dropped = self.written - len(self.buffer)
+        if dropped > 0:
+            header += f", first {dropped} bytes dropped"
+        path = get_output_log_path(self.entry)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > MAX_OUTPUT_LOG_BYTES:
+                rotate_file(path, OUTPUT_LOG_BACKUPS)
+            with open(path, "ab") as log_file:
+                log_file.write(header.encode("utf-8") + b"\n" + self.getvalue() + b"\n")
+        except OSError:
+            pass
+
+
+# watchdog ------------------------------------
+
+
+def get_watchdog_log_path() -> str:
+    """
+    Returns the path of the file where the watched callbacks are recorded.
+    """
+    return os.path.join(get_runtime_dir(), "watchdog.log")
+
+
+def apply_limits(max_memory: int | None, nice: int | None) -> None:
+    """
+    Limits the memory and lowers the priority of the current process. Called in the watched child before it starts.
+    """
+    if max_memory != None:
+        import resource
+
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    if nice != None:
+        os.nice(nice)
+
+
+def kill_tree(process: subprocess.Popen) -> None:
+    """
+    Terminates a watched child and everything it started, then kills them if they are still running after KILL_GRACE.
+    """
+    if os.name == "nt":
+        subprocess.call(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return
+
+    import signal
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def supervise(
+    func_file_name: str,
+    func_name: str,
+    filenames: list[str],
+    params: str,
+    timeout: float | None = None,
+    max_memory: int | None = None,
+    nice: int | None = None,
+    headless: bool = False,
+) -> dict[str, Any]:
+    """
+    Runs the callback in a child process with its own process group, and waits for it.
+
+    max_memory (in bytes) is enforced with setrlimit, and nice lowers the priority of the child. After timeout
+    seconds, the whole process group is killed. The outcome is recorded in the watchdog log and returned, its
+    reason being 'exit', 'timeout' or 'max_memory'. On Windows, max_memory isn't enforced and a warning is issued,
+    and a positive nice runs the child below the normal priority. With headless, the child logs the output of the callback.
+    """
+    from importlib.util import find_spec
+
+    if os.name == "nt" and max_memory != None:
+        import warnings
+
+        warnings.warn("max_memory isn't enforced on Windows", RuntimeWarning)
+    spec = find_spec(func_file_name)
+    func_dir_path = os.path.dirname(spec.origin) if spec and spec.origin else os.getcwd()
+    # The directory of the top-level package of a dotted module name
+    levels = func_file_name.count(".")
+    if spec and spec.origin and os.path.basename(spec.origin) == "__init__.py":
+        levels += 1
+    for _ in range(levels):
+        func_dir_path = os.path.dirname(func_dir_path)
+    launch_code = build_launch_code(
+        func_name,
+        func_file_name,
+        func_dir_path,
+        params,
+        "sys.argv[1:]",
+        {"headless": True} if headless else {},
+    )
+    env = dict(os.environ, **{SUPERVISED_ENV_VAR: "1"})
+
+    if os.name == "nt":
+        creationflags = subprocess.CREATE_NEW_PROCESS_GROUP
+        if nice != None and nice > 0:
+            creationflags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        process = subprocess.Popen(
+            [sys.executable, "-c", launch_code] + list(filenames),
+            stdin=subprocess.DEVNULL,
+            env=env,
+            creationflags=creationflags,
+        )
+    else:
+        process = subprocess.Popen(
+            [sys.executable, "-c", launch_code] + list(filenames),
+            stdin=subprocess.DEVNULL,
+            env=env,
+            start_new_session=True,
+            preexec_fn=lambda: apply_limits(max_memory, nice),
+        )
+
+    started = time.time()
+    reason = "exit"
+    try:
+        exit_code = process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        kill_tree(process)
+        exit_code = process.wait()
+        reason = "timeout"
+    if reason == "exit" and max_memory != None and exit_code == MEMORY_EXIT_CODE:
+        reason = "max_memory"
+
+    record = {
+        "pid": process.pid,
+        "module": func_file_name,
+        "function": func_name,
+        "started": started,
+        "duration": time.time() - started,
+        "exit_code": exit_code,
+        "reason": reason,
+    }
+    path = get_watchdog_log_path()
+    try:
+        if os.path.exists(path) and os.path.getsize(path) > MAX_WATCHDOG_LOG_BYTES:
+            rotate_file(path, WATCHDOG_LOG_BACKUPS)
+    except OSError:
+        # Another process rotated it first
+        pass
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write(json.dumps(record) + "\n")
+    return record
+
+
+# per file ------------------------------------
+
+
+def run_commands(commands: list[str], max_parallel: int = MAX_PARALLEL) -> list[int]:
+    """
+    Runs shell commands with at most max_parallel of them at the same time. Returns their exit codes, in order.
+
+    On Windows, cmd.exe runs them as os.system does, so their values must be quoted with templates.quote_cmd.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(command: str) -> int:
+        if os.name == "nt":
+            # With /s, cmd.exe only removes the quotes around the whole command, whatever it contains
+            command = '"{}" /s /c "{}"'.format(
+                os.environ.get("COMSPEC", "cmd.exe"), command
+            )
+            return subprocess.call(command, stdin=subprocess.DEVNULL)
+        return subprocess.call(command, shell=True, stdin=subprocess.DEVNULL)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+        return list(executor.map(run, commands))
+
+
+def run_per_file(
+    tokens: list[tuple[str, str]],
+    filenames: list[str],
+    quote: bool = True,
+    max_parallel: int = MAX_PARALLEL,
+    key: str | None = None,
+    coalesce_window: float = LAUNCH_DEFAULTS["coalesce_window"],
+) -> dict[str, Any] | None:
+    """
+    Runs a command template once per selected file, xargs -P style, and returns a summary of the exit codes.
+
+    If the template has no variables, the file is added at the end of the command.
+    Returns None if the selection was handed over to another invocation with the same key.
+    """
+    from context_menu import templates
+
+    if key is not None:
+        coalesced = coalesce(key, filenames, coalesce_window)
+        if coalesced is None:
+            return None
+        filenames = coalesced
+
+    template = templates.CommandTemplate.from_tokens(tokens, quote)
+    if not template.variables:
+        template.tokens.append((templates.LITERAL, " "))
+        template.tokens.append((templates.VARIABLE, "FILENAME"))
+    values = {
+        "DIR": os.getcwd(),
+        "DIRECTORY": os.getcwd(),
+        "PYTHONLOC": sys.executable,
+    }
+    commands = [
+        template.render(dict(values, FILENAME=filename)) for filename in filenames
+    ]
+    exit_codes = run_commands(commands, max_parallel)
+
+    summary = {
+        "commands": len(commands),
+        "succeeded": exit_codes.count(0),
+        "failed": [
+            {"file": filename, "exit_code": exit_code}
+            for filename, exit_code in zip(filenames, exit_codes)
+            if exit_code != 0
+        ],
+    }
+    if summary["failed"]:
+        print(
+            f"{len(summary['failed'])} of {len(commands)} commands failed: "
+            + ", ".join(f"{f['file']} ({f['exit_code']})" for f in summary["failed"]),
+            file=sys.stderr,
+        )
+    return summary
@@ -1,11 +1,31 @@
 # imports -------------------------------------------------
 from __future__ import annotations
 from typing import TYPE_CHECKING
+import hashlib
+import importlib.util
+import inspect
+import json
 import os
+import py_compile
+import stat
+import sys
+import tempfile
 from enum import Enum
 
+from context_menu import dynamic, launcher, menu_table, profiling, templates, tree
+
 if TYPE_CHECKING:
-    from context_menu.menus import ContextMenu, ItemType, ActivationType, CommandVar
+    from typing import IO, Any, Callable, Iterable, Iterator, Tuple
+    from context_menu.menus import (
+        ContextMenu,
+        ItemType,
+        ActivationType,
+        CommandVar,
+        MethodInfo,
+    )
+
+    Code = Tuple[str, str]
+    ItemsProvider = Callable[[list], list]
 
 # code_preset.py -------------------------------------
 
@@ -53,6 +73,50 @@ class {}MenuProvider(GObject.GObject, Nautilus.MenuProvider):
 \t\tfilepath = [unquote(subFile.get_uri()[7:]) for subFile in files][0]
 \t\tos.system('{}'{})
 
+"""
+
+    TEMPLATE_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+{}\t\tfilepath = [unquote(subFile.get_uri()[7:]) for subFile in files][0]
+\t\tos.system({})
+
+"""
+
+    LAUNCH_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\tfilenames = [unquote(subFile.get_uri()[7:]) for subFile in files]
+\t\tcontext_menu.launcher.spawn({!r}, {!r}, filenames{})
+
+"""
+
+    ZYGOTE_HANDLER_TEMPLATE = """
+\tdef {}(self, menu, files):
+\t\tfilenames = [unquote(subFile.get_uri()[7:]) for subFile in files]
+\t\tcontext_menu.zygote.submit({!r}, {!r}, {!r}, {!r}, filenames, {!r}, {!r}, {!r})
+
+"""
+
+    SHARED_MENU_TEMPLATE = """
+\tdef {}(self, files):
+{}
+\t\treturn {}
+
+"""
+
+    TABLES_EXTENSION = """
+sys.path.append("{}")
+import context_menu.menu_table
+
+
+class ContextMenuTablesMenuProvider(GObject.GObject, Nautilus.MenuProvider):
+\tdef __init__(self):
+\t\tpass
+
+\tdef get_file_items(self, *args):
+\t\treturn context_menu.menu_table.get_menu_items(Nautilus, args[-1], False, self)
+
+\tdef get_background_items(self, *args):
+\t\treturn context_menu.menu_table.get_menu_items(Nautilus, [args[-1]], True, self)
 """
 
     FILE_ITEMS = """\tdef get_file_items(self, *args):
@@ -74,15 +138,17 @@ class CodeBuilder:
     def __init__(
         self,
         name: str,
-        body_commands: list[str],
+        body_commands: Iterable[str],
         script_dirs: list[str],
-        funcs: list[str],
+        funcs: Iterable[str],
         imports: list[str],
         type: ActivationType | str,
     ) -> None:
         """
         Pass the list of body_commands, the directories of all the scripts, the
         list of the function names, the list of the imports, and the type.
+
+        body_commands and funcs can be any iterable, they are only iterated once.
         """
         self.name = name
         self.body_commands = body_commands
@@ -111,39 +177,63 @@ class CodeBuilder:
         compiled_imports = [f"import {x}" for x in self.imports]
         return "\n".join(compiled_imports)
 
-    def compile(self) -> str:
+    @staticmethod
+    def format_func(index: int, func: str) -> str:
         """
-        Creates the code file.
+        Returns the chunk of the index-th handler of the class.
+        """
+        return "\n\n" + func if index > 0 else func
+
+    @staticmethod
+    def format_command(index: int, command: str) -> str:
+        """
+        Returns the chunk of the index-th body command.
+        """
+        return ("\n\t\t" if index > 0 else "\t\t") + command
+
+    def iter_chunks(self) -> Iterator[str]:
+        """
+        Yields the code file in chunks, in order.
+        """
+        return self.iter_layout(
+            (self.format_func(index, func) for index, func in enumerate(self.funcs)),
+            (
+                self.format_command(index, command)
+                for index, command in enumerate(self.body_commands)
+            ),
+        )
+
+    def iter_layout(
+        self, func_chunks: Iterable[str], command_chunks: Iterable[str]
+    ) -> Iterator[str]:
+        """
+        Yields the code file in chunks, around the already formatted handlers and body commands.
         """
-        code_head = ExistingCode.CODE_HEAD.value
-        script_dirs_code = self.build_script_dirs()
-        imports_code = self.build_imports()
-        class_dec = ExistingCode.CLASS_TEMPLATE.value.format(self.name)
-        class_funcs = "\n\n".join(self.funcs)
         class_type = ExistingCode.FILE_ITEMS.value
         if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
             class_type = ExistingCode.BACKGROUND_ITEMS.value
-        class_body = "\n".join(map(lambda x: "\t\t" + x, self.body_commands))
 
-        code_skeleton = """
-{}
-{}
-{}
-{}
-{}
-{}
-{}
-    """.format(
-            code_head,
-            script_dirs_code,
-            imports_code,
-            class_dec,
-            class_funcs,
-            class_type,
-            class_body,
-        )
+        yield "\n"
+        yield ExistingCode.CODE_HEAD.value
+        yield "\n"
+        yield self.build_script_dirs()
+        yield "\n"
+        yield self.build_imports()
+        yield "\n"
+        yield ExistingCode.CLASS_TEMPLATE.value.format(self.name)
+        yield "\n"
+        yield from func_chunks
+        yield "\n"
+        yield class_type
+        yield "\n"
+        yield from command_chunks
+        yield "\n    "
 
-        return code_skeleton
+    def compile(self) -> str:
+        """
+        Creates the code file.
+        """
+        return "".join(self.iter_chunks())
 
 
 COMMAND_VARS = {
@@ -154,6 +244,10 @@ COMMAND_VARS = {
 }
 
 
+# Directory to add to the path of the extensions so they can import context_menu
+LAUNCHER_DIR = launcher.PACKAGE_PARENT_DIR
+
+
 def command_var_format(item: str) -> str:
     """
     Converts a python string to a value for a command
@@ -162,9 +256,128 @@ def command_var_format(item: str) -> str:
     return COMMAND_VARS[item.upper()]
 
 
+def extension_name(name: str) -> str:
+    """
+    Converts the name of a menu into the name of its extension file, without extension.
+
+    For example, 'Example menu item' -> 'ExampleMenuItem'
+    """
+    # nautilus extensions doesn't work with filenames with spaces
+    return (
+        "".join([word.title() for word in name.split()])
+        if len(name.split()) > 0
+        else name
+    )
+
+
+def get_extensions_dir(create: bool = True) -> str:
+    """
+    Returns the directory nautilus-python loads the extensions from, creating it if needed unless create is False.
+    """
+    extensions_dir = os.path.join(
+        os.path.expanduser("~"), ".local/share/nautilus-python/extensions"
+    )
+    if create:
+        os.makedirs(extensions_dir, exist_ok=True)
+    return extensions_dir
+
+
+# Read once, changing the umask to read it isn't safe while other threads create files
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def write_file_atomic(
+    path: str,
+    content: str | Iterable[str],
+    check: Callable[[str], None] | None = None,
+) -> None:
+    """
+    Writes a file through a temporary file in the same directory. The content can be given in chunks.
+
+    Readers never see a partially written file, and concurrent writers of the same file
+    don't interleave: the last one wins. The file keeps its mode, or gets the usual 0644 less the umask.
+
+    If given, check is called with the path of the temporary file before it replaces the file,
+    and the file is left as it was if it raises.
+    """
+    if isinstance(content, str):
+        content = [content]
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+            for chunk in content:
+                tmp_file.write(chunk)
+        if check is not None:
+            check(tmp_path)
+        # mkstemp creates the file readable by its owner only
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = 0o644 & ~UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_bytecode_path(path: str) -> str:
+    """
+    Returns the path of the bytecode of an extension, in the __pycache__ directory next to it.
+    """
+    return importlib.util.cache_from_source(path)
+
+
+def compile_bytecode(source_path: str, path: str) -> None:
+    """
+    Compiles the source of the extension at path, read from source_path, and writes its bytecode.
+
+    Raises SyntaxError if the source is invalid. The bytecode is invalidated by the hash of the source
+    rather than its modification time, so it is valid whatever the path it was compiled from.
+    """
+    try:
+        py_compile.compile(
+            source_path,
+            cfile=get_bytecode_path(path),
+            dfile=path,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+        )
+    except py_compile.PyCompileError as error:
+        raise error.exc_value
+
+
+# Bytes of generated code kept in memory before it is spooled to disk
+SPOOL_BYTES = 1024 * 1024
+
+
+def spooled_code() -> IO[str]:
+    """
+    Returns a temporary file holding generated code, in memory until it grows past SPOOL_BYTES.
+    """
+    return tempfile.SpooledTemporaryFile(
+        max_size=SPOOL_BYTES, mode="w+", encoding="utf-8"
+    )
+
+
+def read_chunks(file: IO[str], size: int = 64 * 1024) -> Iterator[str]:
+    """
+    Yields the content of a file in chunks of size characters.
+    """
+    return iter(lambda: file.read(size), "")
+
+
 # code_builder.py ----------------------------------
 
 
+# Kinds of code yielded when building the script
+BODY = "body"
+HANDLER = "handler"
+
+
 # Not necessary, but helps simplify the code.
 class Variable:
     """
@@ -179,21 +392,40 @@ class Variable:
 class NautilusMenu:
     # Constructor, automatically handeled by menus.py
     def __init__(
-        self, name: str, sub_items: list[ItemType], type: ActivationType | str
+        self,
+        name: str,
+        sub_items: list[ItemType],
+        type: ActivationType | str,
+        items_provider: ItemsProvider | None = None,
+        ttl: float = dynamic.DEFAULT_TTL,
+        budget: float | None = dynamic.DEFAULT_BUDGET,
+        max_items_per_level: int | None = None,
     ) -> None:
         """
         Items required are the name of the top menu, the sub items, and the type.
+
+        The items of items_provider are added after the sub items when the menu opens.
+        Levels of more than max_items_per_level items are split into alphabetical sub menus.
         """
         # nautilus extensions doesn't work with filenames with spaces
         # Example menu item -> ExampleMenuItem
-        self.name = (
-            "".join([word.title() for word in name.split()])
-            if len(name.split()) > 0
-            else name
+        self.name = extension_name(name)
+        self.sub_items = (
+            tree.paginate(sub_items, max_items_per_level)
+            if max_items_per_level != None
+            else sub_items
         )
-        self.sub_items = sub_items
         self.type = type
+        self.items_provider = items_provider
+        self.ttl = ttl
+        self.budget = budget
         self.counter = 0
+        self.profiler: profiling.CompileProfiler | profiling.NullProfiler = (
+            profiling.NULL_PROFILER
+        )
+        # Known once compiled
+        self.location: str | None = None
+        self.content_hash: str | None = None
 
         # Create all the necessary lists that will be used later on
         self.commands: list[str] = []
@@ -257,6 +489,81 @@ class NautilusMenu:
 
         return Variable(f"self.{func_name}", created_func)
 
+    def generate_launch_func(
+        self,
+        class_origin: str,
+        class_func: str,
+        class_dir: str,
+        params: str,
+        launch_options: dict[str, Any],
+    ) -> Variable:
+        """
+        Generates a command attached to a python function, ran in a new interpreter through the launcher.
+        """
+        func_name = "method_handler{}".format(self.counter)
+        launch_code = launcher.build_launch_code(
+            class_func, class_origin, class_dir, params, "sys.argv[1:]", launch_options
+        )
+        created_func = ExistingCode.LAUNCH_HANDLER_TEMPLATE.value.format(
+            func_name,
+            sys.executable,
+            launch_code,
+            "".join(
+                f", {name}=True"
+                for name in ("trace", "headless")
+                if launch_options.get(name)
+            ),
+        )
+
+        self.counter += 1
+
+        return Variable(f"self.{func_name}", created_func)
+
+    def generate_per_file_func(
+        self, template: templates.CommandTemplate, max_parallel: int
+    ) -> Variable:
+        """
+        Generates a command running the template once per selected file, in a new interpreter through the launcher.
+        """
+        func_name = "method_handler{}".format(self.counter)
+        per_file_code = launcher.build_per_file_code(
+            template.tokens, template.quote, "sys.argv[1:]", max_parallel
+        )
+        created_func = ExistingCode.LAUNCH_HANDLER_TEMPLATE.value.format(
+            func_name, sys.executable, per_file_code, ""
+        )
+
+        self.counter += 1
+
+        return Variable(f"self.{func_name}", created_func)
+
+    def generate_zygote_func(
+        self,
+        class_origin: str,
+        class_func: str,
+        class_dir: str,
+        params: str,
+        launch_options: dict[str, Any],
+    ) -> Variable:
+        """
+        Generates a command attached to a python function, ran in a child forked by the zygote server.
+        """
+        func_name = "method_handler{}".format(self.counter)
+        created_func = ExistingCode.ZYGOTE_HANDLER_TEMPLATE.value.format(
+            func_name,
+            sys.executable,
+            class_origin,
+            class_func,
+            class_dir,
+            params,
+            launch_options,
+            [[class_origin, class_dir]],
+        )
+
+        self.counter += 1
+
+        return Variable(f"self.{func_name}", created_func)
+
     def generate_command_func(self, command: str) -> Variable:
         """
         Generates a command attached to a python function
@@ -276,13 +583,21 @@ class NautilusMenu:
         """
         Generates a command attached to a python function that allows special variables.
         """
-        new_command = command.replace("?", "{}")
-        modified_vars = [command_var_format(item) for item in command_vars]
-        final_str = ", ".join(modified_vars)
+        return self.generate_template_func(
+            templates.CommandTemplate.from_legacy(command, command_vars)
+        )
+
+    def generate_template_func(self, template: templates.CommandTemplate) -> Variable:
+        """
+        Generates a command attached to a python function, with the variables of the template.
+
+        The command runs once, for the first selected file. per_file commands run once per file.
+        """
         func_name = "method_handler{}".format(self.counter)
-        replace_func = """.format({})""".format(final_str)
-        created_func = ExistingCode.COMMAND_HANDLER_TEMPLATE.value.format(
-            func_name, new_command, replace_func
+        created_func = ExistingCode.TEMPLATE_HANDLER_TEMPLATE.value.format(
+            func_name,
+            "\t\timport shlex\n" if template.quote else "",
+            template.to_python(COMMAND_VARS, "shlex.quote({})"),
         )
 
         self.counter += 1
@@ -302,60 +617,262 @@ class NautilusMenu:
 
     # Building the script body
 
-    def build_script_body(self, name: str, items: list[ItemType]) -> None:
+    def add_import(self, script_dir: str, module: str) -> None:
         """
-        Builds the body commands of the script.
+        Records a directory to add to the path and a module to import, once each.
+        """
+        if script_dir not in self.script_dirs:
+            self.script_dirs.append(script_dir)
+        if module not in self.imports:
+            self.imports.append(module)
+
+    def open_menu(self, name: str) -> tuple[str, list[str]]:
+        """
+        Creates the body commands declaring a menu item and its sub menu. Returns the name of the sub menu and the commands.
         """
         top_item = self.generate_item(name)
         top_menu = self.generate_menu()
         submenu_com = self.set_submenu(top_item.name, top_menu.name)
-        self.commands.append(top_item.code)
-        self.commands.append(top_menu.code)
-        self.commands.append(submenu_com)
-
-        for item in items:
-            if item.isMenu:
-                subsubmenu_con = self.append_item(top_menu.name, self.get_next_item())
-                self.build_script_body(item.name, item.sub_items)
-                self.commands.append(subsubmenu_con)
-                continue
-
-            # if the item is a command
-            formatted_command = self.generate_item(item.name)
-            self.commands.append(formatted_command.code)
-
-            if item.python != None:
-                # if there is a python function
-                item_info = item.get_method_info()
-                connected_func = self.generate_python_func(
-                    item_info[1], item_info[0], item.params
+
+        return top_menu.name, [top_item.code, top_menu.code, submenu_com]
+
+    def append_provider_items(
+        self,
+        menu: str,
+        items_provider: ItemsProvider,
+        ttl: float,
+        budget: float | None,
+    ) -> str:
+        """
+        Creates the body command adding the items of a provider to the sub menu 'menu' when it opens.
+        """
+        with self.profiler.phase(profiling.RESOLVE):
+            func_file_path = os.path.abspath(inspect.getfile(items_provider))
+        self.profiler.count(profiling.CALLBACKS_RESOLVED)
+        func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
+        func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
+        self.add_import(func_dir_path, func_file_name)
+        self.add_import(LAUNCHER_DIR, "context_menu.dynamic")
+
+        return "context_menu.dynamic.append_items(Nautilus, {}, files, {}.{}, {!r}, {!r}, self)".format(
+            menu, func_file_name, items_provider.__name__, ttl, budget
+        )
+
+    def get_handler_key(self, item: ItemType, item_info: MethodInfo | None) -> bytes:
+        """
+        Returns what identifies the handler of a command. Commands with the same key share their handler.
+
+        The key is a digest, so the handlers remembered while building a large menu stay small.
+        """
+        if item_info is not None:
+            key = repr(
+                (
+                    "python",
+                    item_info,
+                    item.params,
+                    item.zygote,
+                    sorted(item.get_launch_options().items()),
+                )
+            )
+        elif item.per_file:
+            key = repr(
+                ("per_file", item.command, item.command_vars, item.max_parallel)
+            )
+        else:
+            key = repr(("command", item.command, item.command_vars))
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def build_handler(self, item: ItemType, item_info: MethodInfo | None) -> Variable:
+        """
+        Generates the handler of a command.
+        """
+        if item_info is not None:
+            # if there is a python function
+            launch_options = item.get_launch_options()
+            if item.zygote:
+                # if it has to be forked from the zygote server
+                self.add_import(LAUNCHER_DIR, "context_menu.zygote")
+                return self.generate_zygote_func(
+                    item_info[1],
+                    item_info[0],
+                    item_info[2],
+                    item.params,
+                    launch_options,
                 )
-                self.script_dirs.append(item_info[2])
-                self.imports.append(item_info[1])
-            elif item.command_vars != None:
-                # if the command requries parameters
-                assert item.command is not None
-                assert item.command_vars is not None
-                connected_func = self.generate_mod_command_func(
-                    item.command, item.command_vars
+            if launch_options:
+                # if it has to go through the launcher
+                self.add_import(LAUNCHER_DIR, "context_menu.launcher")
+                return self.generate_launch_func(
+                    item_info[1],
+                    item_info[0],
+                    item_info[2],
+                    item.params,
+                    launch_options,
                 )
+            self.add_import(item_info[2], item_info[1])
+            return self.generate_python_func(item_info[1], item_info[0], item.params)
+        assert item.command is not None
+        if item.per_file:
+            # if the command runs once per selected file
+            self.add_import(LAUNCHER_DIR, "context_menu.launcher")
+            return self.generate_per_file_func(
+                templates.CommandTemplate.from_command(item.command, item.command_vars),
+                item.max_parallel,
+            )
+        if isinstance(item.command, templates.CommandTemplate):
+            # if the command has named variables
+            return self.generate_template_func(item.command)
+        if item.command_vars != None:
+            # if the command requries parameters
+            assert item.command is not None
+            assert item.command_vars is not None
+            return self.generate_mod_command_func(item.command, item.command_vars)
+        # if the command is simply normal
+        assert item.command is not None
+        return self.generate_command_func(item.command)
+
+    def build_command(
+        self, menu: str, item: ItemType
+    ) -> tuple[list[str], str | None]:
+        """
+        Creates the body commands and the handler of a command, appended to the sub menu 'menu'.
+
+        The handler is None if an identical one was already created, the command is then connected to it.
+        """
+        formatted_command = self.generate_item(item.name)
+
+        item_info = None
+        if item.python != None:
+            with self.profiler.phase(profiling.RESOLVE):
+                item_info = item.get_method_info()
+            self.profiler.count(profiling.CALLBACKS_RESOLVED)
+        handler_key = self.get_handler_key(item, item_info)
+        func = None
+        if handler_key not in self.handlers:
+            connected_func = self.build_handler(item, item_info)
+            self.handlers[handler_key] = connected_func.name
+            func = connected_func.code
+
+        connected_command = self.connect(
+            formatted_command.name, self.handlers[handler_key]
+        )
+        commands = [
+            formatted_command.code,
+            connected_command,
+            self.append_item(menu, formatted_command.name),
+        ]
+
+        return commands, func
+
+    def build_shared_menu(self, menu: ContextMenu) -> Iterator[str]:
+        """
+        Yields the handlers of a menu appearing several times in the tree, then the method building it.
+
+        The menu is built by calling the method wherever it appears, instead of repeating its code.
+        """
+        builder_name = "build_menu{}".format(self.counter)
+        self.counter += 1
+        self.shared_builders[id(menu)] = builder_name
+
+        body = []
+        for kind, code in self.iter_script_body(
+            menu.name, menu.sub_items, menu.items_provider, menu.ttl, menu.budget
+        ):
+            if kind == BODY:
+                body.append(code)
             else:
-                # if the command is simply normal
-                assert item.command is not None
-                connected_func = self.generate_command_func(item.command)
-                # connected_func = self.generate_func('os', 'system')
+                yield code
 
-            self.funcs.append(connected_func.code)
+        yield ExistingCode.SHARED_MENU_TEMPLATE.value.format(
+            builder_name,
+            "\n".join("\t\t" + command for command in body),
+            body[0].split(" = ")[0],
+        )
 
-            connected_command = self.connect(
-                formatted_command.name, connected_func.name
-            )
-            self.commands.append(connected_command)
+    def start_script(self, items: list[ItemType]) -> None:
+        """
+        Forgets the handlers and shared menus created by a previous iteration through the tree.
+        """
+        self.handlers: dict[bytes, str] = {}
+        self.shared_builders: dict[int, str] = {}
+        self.shared_menus = tree.find_shared_menus(items)
 
-            self.commands.append(
-                self.append_item(top_menu.name, formatted_command.name)
+    def iter_script_body(
+        self,
+        name: str,
+        items: list[ItemType],
+        items_provider: ItemsProvider | None = None,
+        ttl: float = dynamic.DEFAULT_TTL,
+        budget: float | None = dynamic.DEFAULT_BUDGET,
+    ) -> Iterator[Code]:
+        """
+        Yields the body commands (BODY, code) and the handlers (HANDLER, code) of the script, in order.
+
+        Iterates through the tree with an explicit stack, so deep cascades don't hit the recursion limit.
+        """
+        top_menu, commands = self.open_menu(name)
+        open_menus = [top_menu]
+        # The commands appending each open sub menu to its parent, added once the sub menu is complete
+        pending_appends = []
+        for command in commands:
+            yield BODY, command
+
+        def expand(menu: ContextMenu) -> bool:
+            return id(menu) not in self.shared_menus
+
+        for event, item in tree.walk(items, expand):
+            self.profiler.count(profiling.NODES_VISITED)
+            if event == tree.ENTER:
+                pending_appends.append(
+                    self.append_item(open_menus[-1], self.get_next_item())
+                )
+                top_menu, commands = self.open_menu(item.name)
+                open_menus.append(top_menu)
+                for command in commands:
+                    yield BODY, command
+            elif event == tree.EXIT:
+                if item.items_provider != None:
+                    yield BODY, self.append_provider_items(
+                        open_menus[-1], item.items_provider, item.ttl, item.budget
+                    )
+                open_menus.pop()
+                yield BODY, pending_appends.pop()
+            elif event == tree.COLLAPSED:
+                # if the menu appears several times
+                if id(item) not in self.shared_builders:
+                    for func in self.build_shared_menu(item):
+                        yield HANDLER, func
+                item_name = "menuitem{}".format(self.counter)
+                self.counter += 1
+                yield BODY, "{} = self.{}(files)".format(
+                    item_name, self.shared_builders[id(item)]
+                )
+                yield BODY, self.append_item(open_menus[-1], item_name)
+            else:
+                commands, func = self.build_command(open_menus[-1], item)
+                if func is not None:
+                    yield HANDLER, func
+                for command in commands:
+                    yield BODY, command
+
+        if items_provider != None:
+            yield BODY, self.append_provider_items(
+                open_menus[0], items_provider, ttl, budget
             )
 
+    def build_script_body(self, name: str, items: list[ItemType]) -> None:
+        """
+        Builds the body commands of the script.
+        """
+        self.start_script(items)
+        for kind, code in self.iter_script_body(
+            name, items, self.items_provider, self.ttl, self.budget
+        ):
+            if kind == BODY:
+                self.commands.append(code)
+            else:
+                self.funcs.append(code)
+
     def build_script(self) -> str:
         """
         Finishes and returns the full code.
@@ -373,28 +890,286 @@ class NautilusMenu:
 
         return full_code
 
+    def iter_script(self) -> Iterator[str]:
+        """
+        Yields the full code in chunks, identical to build_script but without holding it in memory.
+
+        The tree is iterated once: the handlers and the body commands are spooled to temporary files while
+        the imports, needed first, are collected, then read back in order.
+        """
+        self.counter = 0
+        self.start_script(self.sub_items)
+        with spooled_code() as funcs, spooled_code() as commands:
+            func_count = command_count = 0
+            for kind, code in self.iter_script_body(
+                self.name, self.sub_items, self.items_provider, self.ttl, self.budget
+            ):
+                if kind == BODY:
+                    commands.write(CodeBuilder.format_command(command_count, code))
+                    command_count += 1
+                else:
+                    funcs.write(CodeBuilder.format_func(func_count, code))
+                    func_count += 1
+            commands.write(CodeBuilder.format_command(command_count, "return menuitem0,"))
+            funcs.seek(0)
+            commands.seek(0)
+            builder = CodeBuilder(
+                self.name, [], self.script_dirs, [], self.imports, self.type
+            )
+            yield from builder.iter_layout(read_chunks(funcs), read_chunks(commands))
+
     def create_path(self, path: str, dir: str) -> str:
         """
         Creates a path to directory. Creates all sub-directories
         """
         new_dir = os.path.join(path, dir)
-        if not os.path.exists(new_dir):
-            os.makedirs(new_dir)
+        os.makedirs(new_dir, exist_ok=True)
         return new_dir
 
-    def compile(self) -> None:
+    def compile(
+        self, profiler: profiling.CompileProfiler | None = None, dry_run: bool = False
+    ) -> None:
         """
         Creates the code, creates a file, and moves it to the correct location.
+
+        The phases and the writes are reported to profiler. With dry_run, the code is generated and validated but not
+        written.
+        """
+        if profiler is not None:
+            self.profiler = profiler
+        save_loc = os.path.join(get_extensions_dir(create=not dry_run), f"{self.name}.py")
+        content_hash = hashlib.sha256()
+
+        def hashed_chunks() -> Iterator[str]:
+            with self.profiler.phase(profiling.GENERATE):
+                chunks = self.iter_script()
+            while True:
+                with self.profiler.phase(profiling.GENERATE):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                encoded = chunk.encode("utf-8")
+                content_hash.update(encoded)
+                self.profiler.count(profiling.BYTES_WRITTEN, len(encoded))
+                yield chunk
+
+        def check(tmp_path: str) -> None:
+            with self.profiler.phase(profiling.VALIDATE):
+                compile_bytecode(tmp_path, save_loc)
+
+        with self.profiler.phase(profiling.WRITE):
+            if dry_run:
+                # Written to an anonymous file instead, to be validated all the same
+                with tempfile.TemporaryFile("w+", encoding="utf-8") as tmp_file:
+                    for chunk in hashed_chunks():
+                        tmp_file.write(chunk)
+                    tmp_file.seek(0)
+                    with self.profiler.phase(profiling.VALIDATE):
+                        compile(tmp_file.read(), save_loc, "exec", dont_inherit=True)
+            else:
+                # Nautilus usually can't write the bytecode itself, it is written here so it doesn't parse the source
+                write_file_atomic(save_loc, hashed_chunks(), check)
+                # The menu may have been compiled to a table before
+                menu_table.remove_table(menu_table.get_table_path(self.name))
+                self.profiler.count(profiling.FILES_WRITTEN)
+        self.location = save_loc
+        self.content_hash = content_hash.hexdigest()
+
+
+# Name of the generic extension reading the tables
+TABLES_EXTENSION_NAME = "ContextMenuTables"
+
+
+def build_tables_extension() -> str:
+    """
+    Returns the code of the generic extension. It is the same for every menu.
+    """
+    return (
+        ExistingCode.CODE_HEAD.value
+        + "\n"
+        + ExistingCode.TABLES_EXTENSION.value.format(LAUNCHER_DIR)
+    )
+
+
+def install_tables_extension() -> None:
+    """
+    Writes the generic extension, unless it is already installed. Nautilus has to be restarted the first time only.
+    """
+    code = build_tables_extension()
+    path = os.path.join(get_extensions_dir(), f"{TABLES_EXTENSION_NAME}.py")
+    if file_hash(path) != hashlib.sha256(code.encode("utf-8")).hexdigest():
+        write_file_atomic(
+            path, code, lambda tmp_path: compile_bytecode(tmp_path, path)
+        )
+
+
+class TableMenu:
+    """
+    Compiles a menu into a table read by the generic extension, instead of generating an extension.
+
+    The table lists the rows of the tree depth first, each referencing the row of its parent menu.
+    Menus appearing several times are written once, and commands running the same thing share their action.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sub_items: list[ItemType],
+        type: ActivationType | str,
+        items_provider: ItemsProvider | None = None,
+        ttl: float = dynamic.DEFAULT_TTL,
+        budget: float | None = dynamic.DEFAULT_BUDGET,
+        max_items_per_level: int | None = None,
+    ) -> None:
+        self.label = name
+        self.name = extension_name(name)
+        self.sub_items = (
+            tree.paginate(sub_items, max_items_per_level)
+            if max_items_per_level != None
+            else sub_items
+        )
+        self.type = type
+        self.items_provider = items_provider
+        self.ttl = ttl
+        self.budget = budget
+        self.profiler: profiling.CompileProfiler | profiling.NullProfiler = (
+            profiling.NULL_PROFILER
+        )
+        # Known once compiled
+        self.location: str | None = None
+        self.content_hash: str | None = None
+
+    def build_provider(
+        self,
+        items_provider: ItemsProvider | None,
+        ttl: float,
+        budget: float | None,
+    ) -> dict[str, Any] | None:
+        """
+        Returns the value of a menu row, referencing its items provider if it has one.
+        """
+        if items_provider == None:
+            return None
+        with self.profiler.phase(profiling.RESOLVE):
+            function_ref = menu_table.get_function_ref(items_provider)
+        self.profiler.count(profiling.CALLBACKS_RESOLVED)
+        return {
+            "function": function_ref,
+            "ttl": ttl,
+            "budget": budget,
+        }
+
+    def build_table(self) -> dict[str, Any]:
+        """
+        Returns the content of the table.
         """
-        code = self.build_script()
-        save_loc = os.path.join(os.path.expanduser("~"), ".local/share/")
-        print(save_loc)
-        save_loc = self.create_path(save_loc, "nautilus-python")
-        save_loc = self.create_path(save_loc, "extensions")
-        save_loc = os.path.join(save_loc, f"{self.name}.py")
-        py_file = open(save_loc, "w")
-        py_file.write(code)
-        py_file.close()
+        rows = [
+            [
+                None,
+                menu_table.MENU,
+                self.label,
+                self.build_provider(self.items_provider, self.ttl, self.budget),
+            ]
+        ]
+        actions: list[dict[str, Any]] = []
+        action_rows: dict[str, int] = {}
+        menu_rows: dict[int, int] = {}
+        open_rows = [0]
+
+        def expand(menu: ContextMenu) -> bool:
+            return id(menu) not in menu_rows
+
+        for event, item in tree.walk(self.sub_items, expand):
+            self.profiler.count(profiling.NODES_VISITED)
+            if event == tree.ENTER:
+                menu_rows[id(item)] = len(rows)
+                rows.append(
+                    [
+                        open_rows[-1],
+                        menu_table.MENU,
+                        item.name,
+                        self.build_provider(item.items_provider, item.ttl, item.budget),
+                    ]
+                )
+                open_rows.append(menu_rows[id(item)])
+            elif event == tree.EXIT:
+                open_rows.pop()
+            elif event == tree.COLLAPSED:
+                # if the menu appears several times
+                rows.append(
+                    [open_rows[-1], menu_table.REFERENCE, item.name, menu_rows[id(item)]]
+                )
+            else:
+                if item.python != None:
+                    with self.profiler.phase(profiling.RESOLVE):
+                        action = menu_table.build_action(item)
+                    self.profiler.count(profiling.CALLBACKS_RESOLVED)
+                else:
+                    action = menu_table.build_action(item)
+                action_key = json.dumps(action, sort_keys=True)
+                if action_key not in action_rows:
+                    action_rows[action_key] = len(actions)
+                    actions.append(action)
+                rows.append(
+                    [open_rows[-1], menu_table.COMMAND, item.name, action_rows[action_key]]
+                )
+
+        return {
+            "version": menu_table.TABLE_VERSION,
+            "name": self.name,
+            "background": self.type.upper()
+            in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"],
+            "actions": actions,
+            "rows": rows,
+        }
+
+    def compile(
+        self, profiler: profiling.CompileProfiler | None = None, dry_run: bool = False
+    ) -> None:
+        """
+        Writes the table, replacing the extension generated for the menu if any. Takes effect on the next right click.
+
+        The phases and the writes are reported to profiler. With dry_run, the table is built but not written.
+        """
+        if profiler is not None:
+            self.profiler = profiler
+        with self.profiler.phase(profiling.GENERATE):
+            content = json.dumps(self.build_table(), separators=(",", ":"))
+        self.profiler.count(profiling.BYTES_WRITTEN, len(content.encode("utf-8")))
+        save_loc = menu_table.get_table_path(self.name)
+        if not dry_run:
+            with self.profiler.phase(profiling.WRITE):
+                install_tables_extension()
+                os.makedirs(os.path.dirname(save_loc), exist_ok=True)
+                write_file_atomic(save_loc, content)
+                remove_extension(os.path.join(get_extensions_dir(), f"{self.name}.py"))
+            self.profiler.count(profiling.FILES_WRITTEN)
+        self.location = save_loc
+        self.content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def remove_extension(path: str) -> None:
+    """
+    Removes an extension file and its bytecode.
+    """
+    for file_path in (
+        path,
+        os.path.splitext(path)[0] + ".pyc",
+        get_bytecode_path(path),
+    ):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def file_hash(path: str) -> str | None:
+    """
+    Returns the hash of an extension file as computed by compile, None if it doesn't exist.
+    """
+    try:
+        with open(path, "rb") as extension:
+            return hashlib.sha256(extension.read()).hexdigest()
+    except OSError:
+        return None
 
 
 # Testing section...
@@ -406,8 +1181,7 @@ try:
             os.path.expanduser("~"), ".local/share/nautilus-python/extensions", name
         )
         try:
-            os.remove(save_loc + ".py")
-            os.remove(save_loc + ".pyc")
+            remove_extension(save_loc + ".py")
         except Exception as e:
             print(e)
 
@@ -0,0 +1,263 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import json
+import os
+
+from context_menu import index, menus
+
+if TYPE_CHECKING:
+    from typing import Any, Union
+
+    Manifest = dict[str, Any]
+    DeployItem = Union[menus.ContextMenu, menus.FastCommand]
+
+# manifest.py -------------------------------------
+#
+# Menus described as data, in a JSON or TOML file, instead of Python code. The
+# python functions are referenced by import path, such as 'tools.images:resize',
+# so deploying the menus of a manifest never imports them. Used by
+# 'python -m context_menu deploy'. For example:
+#
+#     version = 1
+#
+#     [[menus]]
+#     name = "Images"
+#     type = "FILES"
+#
+#     [[menus.items]]
+#     name = "Resize"
+#     python = "tools.images:resize"
+#     single_instance = true
+#
+#     [[commands]]
+#     name = "Open terminal here"
+#     type = "DIRECTORY_BACKGROUND"
+#     command = "gnome-terminal"
+
+MANIFEST_VERSION = 1
+
+# Keys of a manifest, of a command besides its name, and of a root menu besides its name
+MANIFEST_KEYS = ("version", "menus", "commands")
+COMMAND_KEYS = tuple(
+    slot for slot in menus.ContextCommand.__slots__ if slot not in ("name", "isMenu")
+)
+MENU_KEYS = ("type", "items", "max_items_per_level")
+
+# Activation types of the root menus and fast commands, besides file extensions such as '.txt'
+ACTIVATION_TYPES = ("FILES", "DIRECTORY", "DIRECTORY_BACKGROUND", "DRIVE")
+
+
+class ManifestError(ValueError):
+    """
+    Raised when a manifest can't be read or is invalid, with every problem found.
+    """
+
+    def __init__(self, errors: list[str]) -> None:
+        self.errors = errors
+        super().__init__("invalid manifest:\n" + "\n".join(errors))
+
+
+def load_manifest(path: str) -> Manifest:
+    """
+    Reads a manifest, in JSON or in TOML depending on its extension.
+
+    TOML needs Python 3.11, or the tomli package on older versions.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == ".json":
+            with open(path, encoding="utf-8") as manifest_file:
+                return json.load(manifest_file)
+        if extension == ".toml":
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib  # type: ignore
+                except ImportError:
+                    raise ManifestError(
+                        [f"{path}: TOML manifests need Python 3.11 or the tomli package"]
+                    ) from None
+            with open(path, "rb") as manifest_file:
+                return tomllib.load(manifest_file)
+    except (OSError, ValueError) as e:
+        if isinstance(e, ManifestError):
+            raise
+        raise ManifestError([f"{path}: {e}"]) from e
+    raise ManifestError([f"{path}: unknown manifest format, expected .json or .toml"])
+
+
+def check_entry(
+    entry: Any, location: str, allowed: tuple[str, ...], errors: list[str]
+) -> bool:
+    """
+    Checks that an entry is a table with a name and only the allowed keys, adding the problems to errors.
+    """
+    if not isinstance(entry, dict):
+        errors.append(f"{location}: expected a table")
+        return False
+    ok = True
+    if not isinstance(entry.get("name"), str) or not entry["name"]:
+        errors.append(f"{location}: 'name' must be a non-empty string")
+        ok = False
+    for key in entry:
+        if key != "name" and key not in allowed:
+            errors.append(f"{location}: unknown key '{key}'")
+            ok = False
+    return ok
+
+
+def check_type(entry: dict[str, Any], location: str, errors: list[str]) -> bool:
+    """
+    Checks the activation type of a root menu or a fast command.
+    """
+    type = entry.get("type")
+    if isinstance(type, str) and (type.upper() in ACTIVATION_TYPES or "." in type):
+        return True
+    errors.append(
+        f"{location}: 'type' must be one of {', '.join(ACTIVATION_TYPES)} or a file extension"
+    )
+    return False
+
+
+def build_command(
+    entry: Any, location: str, errors: list[str], fast: bool = False
+) -> menus.ContextCommand | menus.FastCommand | None:
+    """
+    Returns the command of an entry, a FastCommand if fast, or None if it is invalid.
+
+    The module of the python function is found, but not imported.
+    """
+    allowed = (COMMAND_KEYS + ("type",)) if fast else COMMAND_KEYS
+    if not check_entry(entry, location, allowed, errors):
+        return None
+    if fast and not check_type(entry, location, errors):
+        return None
+    options = {key: value for key, value in entry.items() if key != "name"}
+    if ("command" in options) == ("python" in options):
+        errors.append(f"{location}: expected either 'command' or 'python'")
+        return None
+    if "python" in options and not isinstance(options["python"], str):
+        errors.append(f"{location}: 'python' must be a 'module:function' string")
+        return None
+    try:
+        command: menus.ContextCommand | menus.FastCommand
+        if fast:
+            command = menus.FastCommand(entry["name"], **options)
+        else:
+            command = menus.ContextCommand(entry["name"], **options)
+        if command.python != None:
+            # Finds the module of the function, without importing it
+            command.get_method_info()
+    except (TypeError, ValueError, SyntaxError) as e:
+        errors.append(f"{location}: {e}")
+        return None
+    return command
+
+
+def build_menu(entry: Any, location: str, errors: list[str]) -> menus.ContextMenu | None:
+    """
+    Returns the root menu of an entry with its sub items, or None if it is invalid.
+
+    Iterates with an explicit stack, so deep cascades don't hit the recursion limit.
+    """
+
+    def open_menu(entry: Any, location: str, root: bool) -> menus.ContextMenu | None:
+        if not check_entry(entry, location, MENU_KEYS if root else ("items",), errors):
+            return None
+        if root and not check_type(entry, location, errors):
+            return None
+        if not isinstance(entry.get("items", []), list):
+            errors.append(f"{location}: 'items' must be a list")
+            return None
+        try:
+            menu = menus.ContextMenu(
+                entry["name"],
+                type=entry.get("type"),
+                max_items_per_level=entry.get("max_items_per_level"),
+            )
+        except (TypeError, ValueError) as e:
+            errors.append(f"{location}: {e}")
+            return None
+        stack.append((menu, entry, location))
+        return menu
+
+    stack: list[tuple[menus.ContextMenu, dict[str, Any], str]] = []
+    top_menu = open_menu(entry, location, True)
+    while stack:
+        menu, menu_entry, menu_location = stack.pop()
+        for item_index, item_entry in enumerate(menu_entry.get("items", [])):
+            item_location = f"{menu_location}.items[{item_index}]"
+            if isinstance(item_entry, dict) and "items" in item_entry:
+                item = open_menu(item_entry, item_location, False)
+            else:
+                item = build_command(item_entry, item_location, errors)
+            if item is not None:
+                menu.add_items([item])
+    return top_menu
+
+
+def build_items(manifest: Manifest) -> list[DeployItem]:
+    """
+    Returns the root menus and the fast commands of a manifest, in order.
+
+    Raises a ManifestError listing every problem if the manifest is invalid.
+    """
+    if not isinstance(manifest, dict):
+        raise ManifestError(["the manifest must be a table"])
+    errors = []
+    if manifest.get("version", MANIFEST_VERSION) != MANIFEST_VERSION:
+        errors.append(f"unsupported manifest version {manifest['version']!r}")
+    for key in manifest:
+        if key not in MANIFEST_KEYS:
+            errors.append(f"unknown key '{key}'")
+
+    items: list[DeployItem | None] = []
+    for key in ("menus", "commands"):
+        entries = manifest.get(key, [])
+        if not isinstance(entries, list):
+            errors.append(f"'{key}' must be a list")
+            continue
+        for entry_index, entry in enumerate(entries):
+            location = f"{key}[{entry_index}]"
+            if key == "menus":
+                items.append(build_menu(entry, location, errors))
+            else:
+                items.append(build_command(entry, location, errors, fast=True))
+
+    seen: set[str] = set()
+    for item in items:
+        if item is None:
+            continue
+        key = index.entry_key(item.name, item.type)
+        if key in seen:
+            errors.append(f"'{item.name}' ({item.type}) is defined more than once")
+        seen.add(key)
+
+    if errors:
+        raise ManifestError(errors)
+    return [item for item in items if item is not None]
+
+
+def plan(items: list[DeployItem]) -> list[str]:
+    """
+    Returns what deploying each item does, 'create' if it isn't installed yet and 'update' otherwise.
+    """
+    return [
+        "update" if index.lookup(item.name, item.type) is not None else "create"
+        for item in items
+    ]
+
+
+def deploy(
+    path: str, workers: int = 1, dry_run: bool = False
+) -> list[tuple[str, menus.CompileResult]]:
+    """
+    Validates a manifest, then compiles all its menus and fast commands in one pass.
+
+    Returns the planned action and the result of each item. With dry_run, everything is done but writing the menus.
+    """
+    items = build_items(load_manifest(path))
+    actions = plan(items)
+    return list(zip(actions, menus.compile_all(items, workers, dry_run)))
@@ -0,0 +1,231 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import json
+import os
+import subprocess
+import sys
+import types
+
+if TYPE_CHECKING:
+    from typing import Any
+
+    MemoryRecord = dict[str, Any]
+
+# memory_report.py -------------------------------------
+#
+# How much memory the installed Nautilus extensions add to Nautilus. Each
+# extension is loaded in its own interpreter, with a stub gi module standing in
+# for Nautilus, and its allocations are traced with tracemalloc. Used by
+# 'python -m context_menu memory-report'.
+#
+# Keep the imports of this module small, they are loaded before tracing starts.
+
+# Retained bytes above which an extension is reported as over budget
+DEFAULT_BUDGET = 10 * 1024 * 1024
+
+# Number of right clicks simulated on each extension
+DEFAULT_CALLS = 20
+
+# Number of allocation sites reported per extension
+TOP_SITES = 5
+
+# Seconds an extension has to load and answer the right clicks
+MEASURE_TIMEOUT = 60.0
+
+
+def install_stub_gi() -> Any:
+    """
+    Installs stub gi and gi.repository modules, enough to load the generated extensions. Returns the stub Nautilus.
+    """
+
+    class MenuProvider:
+        def emit_items_updated_signal(self) -> None:
+            pass
+
+    class Menu:
+        def __init__(self) -> None:
+            self.items: list = []
+
+        def append_item(self, item: Any) -> None:
+            self.items.append(item)
+
+    class MenuItem:
+        def __init__(self, name: str = "", label: str = "", tip: str = "", icon: str = "") -> None:
+            self.name = name
+            self.label = label
+            self.submenu = None
+            self.handlers: list = []
+            self.properties: dict = {}
+
+        def set_submenu(self, menu: Menu) -> None:
+            self.submenu = menu
+
+        def set_property(self, name: str, value: Any) -> None:
+            self.properties[name] = value
+
+        def connect(self, signal: str, handler: Any, *args: Any) -> None:
+            self.handlers.append((signal, handler, args))
+
+    Nautilus = types.SimpleNamespace(MenuProvider=MenuProvider, Menu=Menu, MenuItem=MenuItem)
+    gi = types.ModuleType("gi")
+    gi.require_version = lambda *args: None  # type: ignore
+    repository = types.ModuleType("gi.repository")
+    repository.Nautilus = Nautilus  # type: ignore
+    repository.GObject = types.SimpleNamespace(GObject=type("GObject", (), {}))  # type: ignore
+    gi.repository = repository  # type: ignore
+    sys.modules["gi"] = gi
+    sys.modules["gi.repository"] = repository
+    return Nautilus
+
+
+class StubFile:
+    """
+    Stands in for Nautilus.FileInfo.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def get_uri(self) -> str:
+        return "file://" + self.path
+
+
+def measure(path: str, calls: int = DEFAULT_CALLS) -> MemoryRecord:
+    """
+    Loads the extension at path and simulates right clicks, tracing the allocations. Meant to run in its own interpreter.
+
+    Returns the bytes allocated by the import, the bytes retained per right click, the bytes retained in total,
+    the peak, and the allocation sites retaining the most memory.
+    """
+    import gc
+    import importlib.util
+    import tracemalloc
+
+    Nautilus = install_stub_gi()
+    tracemalloc.start()
+
+    spec = importlib.util.spec_from_file_location(
+        os.path.splitext(os.path.basename(path))[0], path
+    )
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    gc.collect()
+    imported, _ = tracemalloc.get_traced_memory()
+
+    providers = [
+        value()
+        for value in vars(module).values()
+        if isinstance(value, type)
+        and issubclass(value, Nautilus.MenuProvider)
+        and value is not Nautilus.MenuProvider
+    ]
+    for index in range(calls):
+        files = [StubFile(f"/tmp/context_menu/file{index}")]
+        for provider in providers:
+            if hasattr(provider, "get_file_items"):
+                provider.get_file_items(None, files)
+            if hasattr(provider, "get_background_items"):
+                provider.get_background_items(None, files[0])
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+
+    sites = tracemalloc.take_snapshot().statistics("filename")[:TOP_SITES]
+    tracemalloc.stop()
+    return {
+        "path": path,
+        "import_bytes": imported,
+        "per_call_bytes": (retained - imported) // calls if calls else 0,
+        "retained_bytes": retained,
+        "peak_bytes": peak,
+        "top": [
+            [stat.traceback[0].filename, stat.size] for stat in sites if stat.traceback
+        ],
+    }
+
+
+def measure_in_subprocess(path: str, calls: int = DEFAULT_CALLS) -> MemoryRecord:
+    """
+    Measures an extension in a new interpreter, so the extensions don't share their imports.
+    """
+    from context_menu import launcher
+
+    code = (
+        f"import sys; sys.path.insert(0, {launcher.PACKAGE_PARENT_DIR!r}); "
+        f"import json; from context_menu import memory_report; "
+        f"record = memory_report.measure(sys.argv[1], int(sys.argv[2])); "
+        f"sys.stdout.write('\\n' + json.dumps(record) + '\\n')"
+    )
+    try:
+        result = subprocess.run(
+            [sys.executable, "-c", code, path, str(calls)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=MEASURE_TIMEOUT,
+            universal_newlines=True,
+        )
+    except subprocess.TimeoutExpired:
+        return {"path": path, "error": f"timed out after {MEASURE_TIMEOUT}s"}
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return {"path": path, "error": lines[-1] if lines else f"exit code {result.returncode}"}
+    # The extension may print too, the record is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def build_report(
+    paths: list[str] | None = None,
+    budget: int = DEFAULT_BUDGET,
+    calls: int = DEFAULT_CALLS,
+) -> list[MemoryRecord]:
+    """
+    Measures the extensions, all the installed ones by default, and ranks them by retained bytes, largest first.
+
+    Each record says if the extension is over the budget, in bytes. Extensions that fail to load are ranked last,
+    with their error.
+    """
+    if paths is None:
+        from context_menu import linux_menus
+
+        extensions_dir = linux_menus.get_extensions_dir(create=False)
+        paths = (
+            sorted(
+                os.path.join(extensions_dir, name)
+                for name in os.listdir(extensions_dir)
+                if name.endswith(".py")
+            )
+            if os.path.isdir(extensions_dir)
+            else []
+        )
+
+    records = [measure_in_subprocess(path, calls) for path in paths]
+    for record in records:
+        record["name"] = os.path.splitext(os.path.basename(record["path"]))[0]
+        record["over_budget"] = record.get("retained_bytes", 0) > budget
+    records.sort(key=lambda record: ("error" in record, -record.get("retained_bytes", 0)))
+    return records
+
+
+def format_report(records: list[MemoryRecord], budget: int) -> str:
+    """
+    Formats the records as a table, sizes in KiB.
+    """
+    lines = [f"budget: {budget / 1024:.0f} KiB", "extension\tretained\timport\tper click\tpeak"]
+    for record in records:
+        if "error" in record:
+            lines.append(f"{record['name']}\terror: {record['error']}")
+            continue
+        lines.append(
+            "\t".join(
+                [
+                    record["name"] + (" (over budget)" if record["over_budget"] else ""),
+                    f"{record['retained_bytes'] / 1024:.1f}",
+                    f"{record['import_bytes'] / 1024:.1f}",
+                    f"{record['per_call_bytes'] / 1024:.2f}",
+                    f"{record['peak_bytes'] / 1024:.1f}",
+                ]
+            )
+        )
+    return "\n".join(lines)
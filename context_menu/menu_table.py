@@ -0,0 +1,332 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import importlib
+import json
+import os
+import sys
+import threading
+import traceback
+
+from context_menu import dynamic, launcher, templates
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+    from context_menu.menus import ItemType
+
+    Action = dict[str, Any]
+    Row = list[Any]
+
+# menu_table.py -------------------------------------
+#
+# An alternative to the generated Nautilus extensions. Each menu is compiled
+# into a JSON table, and a single generic extension builds the items from the
+# tables on every right click. A table is only parsed again when it changes, so
+# deploys take effect without restarting Nautilus or generating Python code.
+#
+# This module is imported by the generic extension, keep it free of heavy imports.
+
+TABLE_VERSION = 1
+
+# Kinds of rows. A row is [parent row, kind, label, value], the top menu is row 0 with no parent.
+# The value is the provider of a MENU, the row of the menu a REFERENCE shows again, and the
+# action of a COMMAND.
+MENU = "menu"
+REFERENCE = "reference"
+COMMAND = "command"
+
+
+def get_tables_dir() -> str:
+    """
+    Returns the directory holding the tables, ~/.local/share/context_menu/tables by default.
+    """
+    data_dir = os.environ.get("XDG_DATA_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local/share"
+    )
+    return os.path.join(data_dir, "context_menu", "tables")
+
+
+def get_table_path(file_name: str) -> str:
+    """
+    Returns the path of the table of a menu, given the name of its extension file.
+    """
+    return os.path.join(get_tables_dir(), f"{file_name}.json")
+
+
+def remove_table(path: str) -> None:
+    """
+    Removes a table, if it exists. The generic extension stops showing it on the next right click.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_function_ref(func: Callable) -> list[str]:
+    """
+    Returns [module, function name, directory] of a python function, for it to be imported back.
+    """
+    import inspect
+
+    func_file_path = os.path.abspath(inspect.getfile(func))
+    func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
+    func_file_name = os.path.splitext(os.path.basename(func_file_path))[0]
+    return [func_file_name, func.__name__, func_dir_path]
+
+
+def build_action(item: ItemType) -> Action:
+    """
+    Returns what a command item runs when clicked, the same way as the handlers of the generated extensions.
+    """
+    if item.python != None:
+        func_name, func_file_name, func_dir_path = item.get_method_info()
+        action: Action = {
+            "python": [func_file_name, func_name, func_dir_path],
+            "params": item.params,
+        }
+        launch_options = item.get_launch_options()
+        if launch_options:
+            action["launch_options"] = launch_options
+        if item.zygote:
+            action["zygote"] = True
+        return action
+
+    assert item.command is not None
+    template = templates.CommandTemplate.from_command(item.command, item.command_vars)
+    if item.per_file:
+        return {
+            "per_file": template.tokens,
+            "quote": template.quote,
+            "max_parallel": item.max_parallel,
+        }
+    if isinstance(item.command, templates.CommandTemplate) or item.command_vars != None:
+        return {"template": template.tokens, "quote": template.quote}
+    return {"shell": item.command}
+
+
+# generic extension -------------------------------------
+
+
+def import_function(func_file_name: str, func_name: str, func_dir_path: str) -> Any:
+    """
+    Imports a python function referenced in a table, like the imports at the top of the generated extensions.
+    """
+    if func_dir_path not in sys.path:
+        sys.path.append(func_dir_path)
+    return getattr(importlib.import_module(func_file_name), func_name)
+
+
+def run_action(action: Action, filenames: list[str]) -> None:
+    """
+    Runs the action of a command on the selected files.
+    """
+    if "python" in action:
+        func_file_name, func_name, func_dir_path = action["python"]
+        launch_options = action.get("launch_options", {})
+        if action.get("zygote"):
+            from context_menu import zygote
+
+            zygote.submit(
+                sys.executable,
+                func_file_name,
+                func_name,
+                func_dir_path,
+                filenames,
+                action["params"],
+                launch_options,
+                [[func_file_name, func_dir_path]],
+            )
+        elif launch_options:
+            launch_code = launcher.build_launch_code(
+                func_name,
+                func_file_name,
+                func_dir_path,
+                action["params"],
+                "sys.argv[1:]",
+                launch_options,
+            )
+            launcher.spawn(
+                sys.executable,
+                launch_code,
+                filenames,
+                launch_options.get("trace", False),
+                launch_options.get("headless", False),
+            )
+        else:
+            import_function(func_file_name, func_name, func_dir_path)(
+                filenames, action["params"]
+            )
+        return
+
+    if "shell" in action:
+        os.system(action["shell"])
+        return
+    if "per_file" in action:
+        per_file_code = launcher.build_per_file_code(
+            action["per_file"], action["quote"], "sys.argv[1:]", action["max_parallel"]
+        )
+        launcher.spawn(sys.executable, per_file_code, filenames)
+        return
+    templates.run_command(
+        templates.CommandTemplate.from_tokens(action["template"], action["quote"]),
+        filenames,
+    )
+
+
+class Table:
+    """
+    A table loaded in memory, with the rows under each menu.
+    """
+
+    __slots__ = ("name", "background", "rows", "actions", "children")
+
+    def __init__(self, data: dict[str, Any]) -> None:
+        if data.get("version") != TABLE_VERSION:
+            raise ValueError(f"unsupported table version {data.get('version')!r}")
+        self.name: str = data["name"]
+        self.background: bool = data["background"]
+        self.rows: list[Row] = data["rows"]
+        self.actions: list[Action] = data["actions"]
+        self.children: list[list[int]] = [[] for _ in self.rows]
+        for row_index, row in enumerate(self.rows[1:], 1):
+            self.children[row[0]].append(row_index)
+
+    def build_item(
+        self,
+        Nautilus: Any,
+        files: list[Any],
+        filenames: list[str],
+        menu_provider: Any = None,
+    ) -> Any:
+        """
+        Creates the Nautilus menu item of the top menu, with its sub menus.
+
+        Iterates with an explicit stack, so deep cascades don't hit the recursion limit.
+        """
+        prefix = f"ContextMenuTable::{self.name}"
+
+        def open_menu(row_index: int, menu_row: int) -> Any:
+            menu_item = Nautilus.MenuItem(
+                name=f"{prefix}::{row_index}",
+                label=self.rows[row_index][2],
+                tip="",
+                icon="",
+            )
+            sub_menu = Nautilus.Menu()
+            menu_item.set_submenu(sub_menu)
+            stack.append((sub_menu, menu_row, iter(self.children[menu_row])))
+            return menu_item
+
+        stack: list[tuple[Any, int, Any]] = []
+        top_item = open_menu(0, 0)
+        while stack:
+            sub_menu, menu_row, children = stack[-1]
+            for row_index in children:
+                parent, kind, label, value = self.rows[row_index]
+                if kind == MENU:
+                    sub_menu.append_item(open_menu(row_index, row_index))
+                    break
+                if kind == REFERENCE:
+                    sub_menu.append_item(open_menu(row_index, value))
+                    break
+                menu_item = Nautilus.MenuItem(
+                    name=f"{prefix}::{row_index}", label=label, tip="", icon=""
+                )
+                menu_item.connect(
+                    "activate",
+                    lambda menu_item, action=self.actions[value]: run_action(
+                        action, filenames
+                    ),
+                )
+                sub_menu.append_item(menu_item)
+            else:
+                stack.pop()
+                provider = self.rows[menu_row][3]
+                if provider is not None:
+                    dynamic.append_items(
+                        Nautilus,
+                        sub_menu,
+                        files,
+                        import_function(*provider["function"]),
+                        provider["ttl"],
+                        provider["budget"],
+                        menu_provider,
+                    )
+        return top_item
+
+
+class TableCache:
+    """
+    The tables of a directory, each parsed again only when its file changes.
+    """
+
+    def __init__(self) -> None:
+        # The stat of each file when it was parsed, and its table
+        self.tables: dict[str, tuple[tuple[int, int, int], Table]] = {}
+        self.lock = threading.Lock()
+
+    def load(self, path: str) -> Table | None:
+        """
+        Returns the table of a file, parsing it only if it changed. Returns None if it doesn't exist anymore.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self.lock:
+                self.tables.pop(path, None)
+            return None
+        # Tables are replaced atomically, so a new inode also means a new table
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self.lock:
+            cached = self.tables.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(path, encoding="utf-8") as table_file:
+            table = Table(json.load(table_file))
+        with self.lock:
+            self.tables[path] = (signature, table)
+        return table
+
+    def get_tables(self, tables_dir: str) -> list[Table]:
+        """
+        Returns the tables of a directory, in the order of their file names. Each file is checked once.
+        """
+        try:
+            file_names = sorted(
+                name for name in os.listdir(tables_dir) if name.endswith(".json")
+            )
+        except OSError:
+            file_names = []
+        paths = [os.path.join(tables_dir, name) for name in file_names]
+        with self.lock:
+            for path in set(self.tables) - set(paths):
+                del self.tables[path]
+
+        tables = []
+        for path in paths:
+            try:
+                table = self.load(path)
+            except (OSError, ValueError, KeyError, IndexError):
+                # A broken table doesn't hide the others
+                traceback.print_exc()
+                continue
+            if table is not None:
+                tables.append(table)
+        return tables
+
+
+_cache = TableCache()
+
+
+def get_menu_items(
+    Nautilus: Any, files: list[Any], background: bool, menu_provider: Any = None
+) -> list[Any]:
+    """
+    Returns the Nautilus menu items of the tables, for the file items or the background items. Called by the generic extension.
+    """
+    filenames = dynamic.get_unquoted_paths(files)
+    return [
+        table.build_item(Nautilus, files, filenames, menu_provider)
+        for table in _cache.get_tables(get_tables_dir())
+        if table.background == background
+    ]
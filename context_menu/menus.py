@@ -4,9 +4,11 @@ import inspect
 import sys
 import os
 import platform
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 if TYPE_CHECKING:
-    from typing import Tuple, Union, Literal
+    from typing import Any, Callable, Tuple, Union, Literal
     from types import FunctionType
 
     ActivationType = Literal["FILES", "DIRECTORY", "DIRECTORY_BACKGROUND", "DRIVE"]
@@ -14,8 +16,22 @@ if TYPE_CHECKING:
     ItemType = Union["ContextMenu", "ContextCommand"]
     MethodInfo = Tuple[str, str, str]
 
+    from context_menu.linux_menus import NautilusMenu, TableMenu
+    from context_menu.profiling import CompileProfiler, CompileReport
+    from context_menu.windows_menus import RegistryMenu, FastRegistryCommand
 
-from context_menu import linux_menus, windows_menus
+
+from context_menu import (
+    callbacks,
+    dynamic,
+    index,
+    launcher,
+    linux_menus,
+    menu_table,
+    profiling,
+    windows_menus,
+)
+from context_menu.templates import CommandTemplate
 
 
 class ContextMenu:
@@ -23,15 +39,48 @@ class ContextMenu:
     The general menu class. This class generalizes the menus and eventually passes the correct values to the platform-specifically menus.
     """
 
-    def __init__(self, name: str, type: ActivationType | str | None = None) -> None:
+    # Generated trees can have tens of thousands of nodes, slots keep them small
+    __slots__ = (
+        "name",
+        "sub_items",
+        "type",
+        "isMenu",
+        "items_provider",
+        "ttl",
+        "budget",
+        "max_items_per_level",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        type: ActivationType | str | None = None,
+        items_provider: Callable[[list[str]], list[ItemType]] | None = None,
+        ttl: float = dynamic.DEFAULT_TTL,
+        budget: float | None = dynamic.DEFAULT_BUDGET,
+        max_items_per_level: int | None = None,
+    ) -> None:
         """
         Only specify type if it's the root menu.
+
+        items_provider is a function called with the selected files when the menu opens, returning items added after
+        the sub items. Its results are cached for ttl seconds. If it takes longer than budget seconds, a placeholder is
+        shown until it is done. On Windows, it is called once when compiling instead.
+
+        max_items_per_level is only used on the root menu. Levels with more items are sorted by name and split
+        into alphabetical sub menus ("A–F", "G–M", ...) of at most that many items.
         """
+        if max_items_per_level != None and max_items_per_level < 2:
+            raise ValueError("max_items_per_level must be at least 2")
 
         self.name = name
         self.sub_items: list[ItemType] = []
         self.type = type
         self.isMenu = True  # Needed to avoid circular imports
+        self.items_provider = items_provider
+        self.ttl = ttl
+        self.budget = budget
+        self.max_items_per_level = max_items_per_level
 
     def add_items(self, items: list[ItemType]) -> None:
         """
@@ -39,17 +88,77 @@ class ContextMenu:
         """
         self.sub_items.extend(items)
 
-    def compile(self) -> None:
+    def compile(
+        self,
+        shared_store: bool = False,
+        workers: int = 1,
+        transactional: bool = False,
+        table: bool = False,
+        profiler: CompileProfiler | None = None,
+        dry_run: bool = False,
+    ) -> CompileReport | None:
         """
         Recognizes the current platform and passes information to the respective menu. Creates the actual menu.
+
+        On Windows, shared_store writes each unique sub menu once and references it wherever it appears,
+        which saves a lot of registry writes when the same menu is compiled for several types.
+        With more than one worker, the top level items are written to the registry concurrently.
+        With transactional, a failed compilation leaves the registry as it was, and rollback() can undo a successful one.
+
+        On Linux, table writes the menu as data read by a generic extension instead of generating an extension,
+        so changes show on the next right click, without restarting Nautilus.
+
+        profiler receives the timings of the phases of the compilation and counters of what it did, see profiling.py.
+        With dry_run, everything is done but writing the menu. Returns the report of the profiler, if any.
         """
         if self.type is None:
             raise Exception("type can't be None for top-level ContextMenu")
+        profiler = start_profiler(profiler, dry_run)
 
-        if platform.system() == "Linux":
-            linux_menus.NautilusMenu(self.name, self.sub_items, self.type).compile()
+        if platform.system() == "Linux" and table:
+            table_menu = linux_menus.TableMenu(
+                self.name,
+                self.sub_items,
+                self.type,
+                items_provider=self.items_provider,
+                ttl=self.ttl,
+                budget=self.budget,
+                max_items_per_level=self.max_items_per_level,
+            )
+            table_menu.compile(profiler, dry_run)
+            record_menu(self.name, self.type, "table", table_menu, profiler, dry_run)
+        elif platform.system() == "Linux":
+            nautilus_menu = linux_menus.NautilusMenu(
+                self.name,
+                self.sub_items,
+                self.type,
+                items_provider=self.items_provider,
+                ttl=self.ttl,
+                budget=self.budget,
+                max_items_per_level=self.max_items_per_level,
+            )
+            nautilus_menu.compile(profiler, dry_run)
+            record_menu(
+                self.name, self.type, "nautilus", nautilus_menu, profiler, dry_run
+            )
         if platform.system() == "Windows":
-            windows_menus.RegistryMenu(self.name, self.sub_items, self.type).compile()
+            sub_items = dynamic.snapshot(self.sub_items)
+            if self.items_provider != None:
+                sub_items = sub_items + list(self.items_provider([]))
+            registry_menu = windows_menus.RegistryMenu(
+                self.name,
+                sub_items,
+                self.type,
+                shared_store=shared_store,
+                workers=workers,
+                transactional=transactional,
+                max_items_per_level=self.max_items_per_level,
+            )
+            registry_menu.compile(profiler=profiler, dry_run=dry_run)
+            record_menu(
+                self.name, self.type, "registry", registry_menu, profiler, dry_run
+            )
+        return profiler.report() if profiler is not None else None
 
 
 class ContextCommand:
@@ -60,21 +169,64 @@ class ContextCommand:
 
      Name = Name of the command
      Command = command to be ran from the shell
-     python = function to be ran
+     python = function to be ran, or a reference to it such as 'tools.images:resize', found without importing it
      params = any other parameters to be passed
      command_vars = to help with the command
+     A CommandTemplate can be passed as the command instead, with named variables such as '{FILENAME}'
+     single_instance = merge the selections of invocations started within coalesce_window seconds
+     timeout, max_memory (bytes), nice = watch the python function, killing it after timeout seconds
+     trace = record the time of each stage of the invocations, see launcher.record_trace()
+     headless = run the python function without a console (pythonw on Windows), logging its output, see launcher.OutputCapture
+     zygote = on Linux, run the python function in a process forked from a preloaded server
+     per_file = run the command once per selected file, with at most max_parallel commands at the same time
+     multi_select_model = on Windows, the MultiSelectModel of the command, 'Single', 'Document' or 'Player'.
+     With 'Document' and 'Player', the files of the processes Explorer starts are collected by the first one
     """
 
+    __slots__ = (
+        "name",
+        "command",
+        "isMenu",
+        "python",
+        "params",
+        "command_vars",
+        "single_instance",
+        "coalesce_window",
+        "timeout",
+        "max_memory",
+        "nice",
+        "trace",
+        "headless",
+        "zygote",
+        "per_file",
+        "max_parallel",
+        "multi_select_model",
+    )
+
     def __init__(
         self,
         name: str,
-        command: str | None = None,
-        python: FunctionType | None = None,
+        command: str | CommandTemplate | None = None,
+        python: FunctionType | str | None = None,
         params: str = "",
         command_vars: list[CommandVar] | None = None,
+        single_instance: bool = False,
+        coalesce_window: float = launcher.LAUNCH_DEFAULTS["coalesce_window"],
+        timeout: float | None = None,
+        max_memory: int | None = None,
+        nice: int | None = None,
+        trace: bool = False,
+        headless: bool = False,
+        zygote: bool = False,
+        per_file: bool = False,
+        max_parallel: int = launcher.MAX_PARALLEL,
+        multi_select_model: str | None = None,
     ) -> None:
         """
         Do not specify both 'python' and 'command', either pass a python function or a command but not both.
+
+        python can also be a 'module:function' reference. The module is looked up on sys.path and parsed when
+        compiling, but never imported, so its dependencies don't have to be installed on the deploying machine.
         """
         self.name = name
         self.command = command
@@ -82,9 +234,33 @@ class ContextCommand:
         self.python = python
         self.params = params
         self.command_vars = command_vars
+        self.single_instance = single_instance
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.nice = nice
+        self.trace = trace
+        self.headless = headless
+        self.zygote = zygote
+        self.per_file = per_file
+        self.max_parallel = max_parallel
+        self.multi_select_model = multi_select_model
 
         if command != None and python != None:
             raise ValueError("both command and python cannot be defined")
+        if python == None and (self.get_launch_options() or zygote):
+            raise ValueError("launch options require a python function")
+        if isinstance(python, str):
+            callbacks.split_reference(python)
+        if per_file and command == None:
+            raise ValueError("per_file requires a command")
+        if (
+            multi_select_model != None
+            and multi_select_model not in launcher.MULTI_SELECT_MODELS
+        ):
+            raise ValueError(
+                f"unknown multi_select_model {multi_select_model!r}, expected one of {', '.join(launcher.MULTI_SELECT_MODELS)}"
+            )
 
     def get_platform_command(self):
         """
@@ -92,6 +268,14 @@ class ContextCommand:
         """
         return self.command[platform.system().lower()]
 
+    def get_launch_options(self) -> dict[str, Any]:
+        """
+        Returns the options changing how the python function is launched, without the default ones.
+        """
+        return launcher.filter_launch_options(
+            {name: getattr(self, name) for name in launcher.LAUNCH_DEFAULTS}
+        )
+
     def get_method_info(
         self,
     ) -> MethodInfo:
@@ -101,6 +285,8 @@ class ContextCommand:
         Returns a tuple (function name, function file name, path to function directory)
         """
         assert self.python is not None
+        if isinstance(self.python, str):
+            return callbacks.resolve_reference(self.python)
         func_file_path = os.path.abspath(inspect.getfile(self.python))
 
         func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
@@ -117,14 +303,45 @@ class FastCommand:
     Extremely similar methods to other classes, only slightly modified. View the documentation of the above classes for info on these methods.
     """
 
+    __slots__ = (
+        "name",
+        "type",
+        "command",
+        "python",
+        "params",
+        "command_vars",
+        "single_instance",
+        "coalesce_window",
+        "timeout",
+        "max_memory",
+        "nice",
+        "trace",
+        "headless",
+        "zygote",
+        "per_file",
+        "max_parallel",
+        "multi_select_model",
+    )
+
     def __init__(
         self,
         name: str,
         type: ActivationType | str,
-        command: str | None = None,
-        python: FunctionType | None = None,
+        command: str | CommandTemplate | None = None,
+        python: FunctionType | str | None = None,
         params: str = "",
         command_vars: list[CommandVar] | None = None,
+        single_instance: bool = False,
+        coalesce_window: float = launcher.LAUNCH_DEFAULTS["coalesce_window"],
+        timeout: float | None = None,
+        max_memory: int | None = None,
+        nice: int | None = None,
+        trace: bool = False,
+        headless: bool = False,
+        zygote: bool = False,
+        per_file: bool = False,
+        max_parallel: int = launcher.MAX_PARALLEL,
+        multi_select_model: str | None = None,
     ) -> None:
         self.name = name
         self.type = type
@@ -132,12 +349,43 @@ class FastCommand:
         self.python = python
         self.params = params
         self.command_vars = command_vars
+        self.single_instance = single_instance
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.nice = nice
+        self.trace = trace
+        self.headless = headless
+        self.zygote = zygote
+        self.per_file = per_file
+        self.max_parallel = max_parallel
+        self.multi_select_model = multi_select_model
 
         if command != None and python != None:
             raise ValueError("both command and python cannot be defined")
+        if python == None and (self.get_launch_options() or zygote):
+            raise ValueError("launch options require a python function")
+        if isinstance(python, str):
+            callbacks.split_reference(python)
+        if per_file and command == None:
+            raise ValueError("per_file requires a command")
+        if (
+            multi_select_model != None
+            and multi_select_model not in launcher.MULTI_SELECT_MODELS
+        ):
+            raise ValueError(
+                f"unknown multi_select_model {multi_select_model!r}, expected one of {', '.join(launcher.MULTI_SELECT_MODELS)}"
+            )
+
+    def get_launch_options(self) -> dict[str, Any]:
+        return launcher.filter_launch_options(
+            {name: getattr(self, name) for name in launcher.LAUNCH_DEFAULTS}
+        )
 
     def get_method_info(self) -> MethodInfo:
         assert self.python is not None
+        if isinstance(self.python, str):
+            return callbacks.resolve_reference(self.python)
         func_file_path = os.path.abspath(inspect.getfile(self.python))
 
         func_dir_path = os.path.dirname(func_file_path).replace("\\", "/")
@@ -146,9 +394,12 @@ class FastCommand:
 
         return (func_name, func_file_name, func_dir_path)
 
-    def compile(self) -> None:
+    def compile(
+        self, profiler: CompileProfiler | None = None, dry_run: bool = False
+    ) -> CompileReport | None:
+        profiler = start_profiler(profiler, dry_run)
         if platform.system() == "Linux":
-            linux_menus.NautilusMenu(
+            nautilus_menu = linux_menus.NautilusMenu(
                 self.name,
                 [
                     ContextCommand(
@@ -157,19 +408,201 @@ class FastCommand:
                         python=self.python,
                         params=self.params,
                         command_vars=self.command_vars,
+                        zygote=self.zygote,
+                        per_file=self.per_file,
+                        max_parallel=self.max_parallel,
+                        multi_select_model=self.multi_select_model,
+                        **self.get_launch_options(),
                     )
                 ],
                 self.type,
-            ).compile()
+            )
+            nautilus_menu.compile(profiler, dry_run)
+            record_menu(
+                self.name, self.type, "nautilus", nautilus_menu, profiler, dry_run
+            )
         if platform.system() == "Windows":
-            windows_menus.FastRegistryCommand(
+            registry_command = windows_menus.FastRegistryCommand(
                 self.name,
                 self.type,
                 self.command,
                 self.python,
                 self.params,
                 self.command_vars,
-            ).compile()
+                launch_options=self.get_launch_options(),
+                per_file=self.per_file,
+                max_parallel=self.max_parallel,
+                multi_select_model=self.multi_select_model,
+            )
+            registry_command.compile(profiler, dry_run)
+            record_menu(
+                self.name, self.type, "registry", registry_command, profiler, dry_run
+            )
+        return profiler.report() if profiler is not None else None
+
+
+def start_profiler(
+    profiler: CompileProfiler | None, dry_run: bool
+) -> CompileProfiler | None:
+    """
+    Returns the profiler of a compilation, a new one for a dry run without one, so it has something to report.
+    """
+    if profiler is None and dry_run:
+        profiler = profiling.CompileProfiler()
+    if profiler is not None:
+        profiler.dry_run = dry_run
+    return profiler
+
+
+def record_menu(
+    name: str,
+    type: ActivationType | str,
+    backend: str,
+    compiled: NautilusMenu | TableMenu | RegistryMenu | FastRegistryCommand,
+    profiler: CompileProfiler | None = None,
+    dry_run: bool = False,
+) -> None:
+    """
+    Records a compiled menu in the index of installed menus, unless it is a dry run.
+    """
+    assert compiled.location is not None
+    assert compiled.content_hash is not None
+    if dry_run:
+        return
+    journal = getattr(compiled, "journal", None)
+    with (profiler or profiling.NULL_PROFILER).phase(profiling.INDEX):
+        previous = index.lookup(name, type)
+        index.record(
+            name,
+            type,
+            backend,
+            compiled.location,
+            compiled.content_hash,
+            journal.entries if journal is not None else None,
+            getattr(compiled, "store_entries", None),
+        )
+    if previous is not None:
+        release_store_entries(previous.get("store", []))
+
+
+def release_store_entries(digests: list[str]) -> None:
+    """
+    Deletes the shared store entries that no menu of the index references anymore.
+
+    The entries referenced by the previous version of a transactional compilation are kept, it may be rolled back.
+    """
+    if not digests:
+        return
+    referenced: set[str] = set()
+    for entry in index.entries():
+        referenced.update(entry.get("store", []))
+        referenced.update((entry.get("previous") or {}).get("store", []))
+    for digest in digests:
+        if digest not in referenced:
+            windows_menus.delete_store_entry(digest)
+
+
+def rollback(last_deploy: dict[str, Any]) -> None:
+    """
+    Undoes a transactional compilation, given its entry in the index, as returned by list_menus().
+
+    The registry and the index are put back as they were before the compilation.
+    """
+    if last_deploy.get("journal") is None:
+        raise ValueError(
+            f"'{last_deploy['name']}' wasn't compiled with transactional=True"
+        )
+    windows_menus.RegistryJournal(last_deploy["journal"]).rollback()
+    if last_deploy["previous"] is not None:
+        index.restore(last_deploy["previous"])
+    else:
+        index.forget(last_deploy["name"], last_deploy["type"])
+
+
+class CompileResult:
+    """
+    The outcome of compiling one item with compile_all.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        type: ActivationType | str | None,
+        error: Exception | None = None,
+        duration: float = 0.0,
+    ) -> None:
+        self.name = name
+        self.type = type
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        status = "ok" if self.ok else f"failed: {self.error!r}"
+        return f"<CompileResult {self.name!r} ({self.type}) {status} in {self.duration:.3f}s>"
+
+
+def get_output_key(item: ContextMenu | FastCommand) -> str | None:
+    """
+    Returns what identifies the output of an item on the current platform, the extension file on Linux and the registry key on Windows.
+
+    Two items with the same key would overwrite each other.
+    """
+    if item.type is None:
+        return None
+    if platform.system() == "Linux":
+        return linux_menus.extension_name(item.name)
+    if platform.system() == "Windows":
+        return windows_menus.join_keys(
+            windows_menus.context_registry_format(item.type), item.name
+        ).lower()
+    return None
+
+
+def compile_all(
+    items: list[ContextMenu | FastCommand], workers: int = 1, dry_run: bool = False
+) -> list[CompileResult]:
+    """
+    Compiles many independent top-level menus and fast commands, up to 'workers' at a time.
+
+    Never raises for a single item: returns one CompileResult per item, in the same order, holding the error if any.
+    Items that would overwrite the output of a previous item are not compiled. With dry_run, nothing is written.
+    """
+    results = [CompileResult(item.name, item.type) for item in items]
+
+    seen: set[str] = set()
+    todo = []
+    for item, result in zip(items, results):
+        key = get_output_key(item)
+        if key is not None and key in seen:
+            result.error = ValueError(
+                f"'{item.name}' ({item.type}) has the same output as a previous item"
+            )
+            continue
+        if key is not None:
+            seen.add(key)
+        todo.append((item, result))
+
+    def compile_item(item: ContextMenu | FastCommand, result: CompileResult) -> None:
+        start = time.perf_counter()
+        try:
+            item.compile(dry_run=dry_run)
+        except Exception as e:
+            result.error = e
+        result.duration = time.perf_counter() - start
+
+    if workers <= 1:
+        for item, result in todo:
+            compile_item(item, result)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(lambda args: compile_item(*args), todo):
+                pass
+
+    return results
 
 
 try:
@@ -181,6 +614,18 @@ try:
         Requires the name of the menu and type of the menu
         """
 
+        entry = index.forget(name, type)
+        if entry is not None:
+            # The index knows exactly what to remove
+            if entry["backend"] == "nautilus":
+                linux_menus.remove_extension(entry["location"])
+            if entry["backend"] == "table":
+                menu_table.remove_table(entry["location"])
+            if entry["backend"] == "registry":
+                windows_menus.delete_key(entry["location"])
+                release_store_entries(entry.get("store", []))
+            return
+
         if platform.system() == "Linux":
             linux_menus.remove_linux_menu(name)
         if platform.system() == "Windows":
@@ -190,3 +635,56 @@ except Exception as e:
     # For testing
     print(e)
     pass
+
+
+def list_menus() -> list[dict[str, Any]]:
+    """
+    Returns the menus compiled on this machine, as recorded in the index.
+
+    Each entry holds the name, type, backend ('nautilus', 'table' or 'registry'), location (extension file, table or registry key),
+    hash of the content and timestamp of the compilation.
+    """
+    return index.entries()
+
+
+def is_installed(name: str, type: ActivationType | str) -> bool:
+    """
+    Returns True if the menu is recorded in the index. Use verify() to check that the index matches reality.
+    """
+    return index.lookup(name, type) is not None
+
+
+def verify() -> dict[str, list[dict[str, Any]]]:
+    """
+    Reconciles the index with what is really installed.
+
+    Entries whose extension file, table or registry key no longer exists are dropped from the index and returned as 'missing'.
+    Extension files and tables changed since their compilation are returned as 'modified'. Entries of the backend of
+    another platform, for example in an index shared through the home directory, can't be checked here: they are
+    kept and returned as 'skipped'.
+    """
+    report: dict[str, list[dict[str, Any]]] = {
+        "missing": [],
+        "modified": [],
+        "skipped": [],
+    }
+    backends = {"Linux": ("nautilus", "table"), "Windows": ("registry",)}.get(
+        platform.system(), ()
+    )
+    for entry in index.entries():
+        if entry["backend"] not in backends:
+            report["skipped"].append(entry)
+            continue
+        if entry["backend"] in ("nautilus", "table"):
+            content_hash = linux_menus.file_hash(entry["location"])
+            exists = content_hash is not None
+            if exists and content_hash != entry["hash"]:
+                report["modified"].append(entry)
+        else:
+            exists = windows_menus.key_exists(entry["location"])
+
+        if not exists:
+            index.forget(entry["name"], entry["type"])
+            report["missing"].append(entry)
+
+    return report
@@ -0,0 +1,130 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Iterator
+
+    CompileReport = dict[str, Any]
+
+# profiling.py -------------------------------------
+#
+# Where the time of a compilation goes. The compile methods take a profiler,
+# time their phases with it and count what they did, for example:
+#
+#     profiler = CompileProfiler()
+#     cm.compile(profiler=profiler)
+#     profiler.report()
+
+# Phases of a compilation
+RESOLVE = "resolve"  # finding the files of the python functions
+GENERATE = "generate"  # building the code of the extensions or the registry commands
+VALIDATE = "validate"  # compiling the generated code
+WRITE = "write"  # writing files
+REGISTRY = "registry"  # calls to the registry
+INDEX = "index"  # recording the menu in the index
+
+# Counters
+NODES_VISITED = "nodes_visited"
+CALLBACKS_RESOLVED = "callbacks_resolved"
+KEYS_CREATED = "keys_created"
+VALUES_SET = "values_set"
+BYTES_WRITTEN = "bytes_written"
+FILES_WRITTEN = "files_written"
+
+
+class CompileProfiler:
+    """
+    Collects how long each phase of a compilation takes, and counters of what it did.
+
+    The time of a phase doesn't include the phases nested in it, and adds up over the threads running it.
+    If given, hook is called with the name and the duration of each phase as it ends.
+    Used as a context manager, the wall time of the block is also reported.
+    """
+
+    def __init__(self, hook: Callable[[str, float], None] | None = None) -> None:
+        self.hook = hook
+        self.timings: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.wall: float | None = None
+        self.dry_run = False
+        self.lock = threading.Lock()
+        # The phases open in each thread, and when the innermost one was last resumed
+        self.local = threading.local()
+        self.started: float | None = None
+
+    def __enter__(self) -> CompileProfiler:
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        assert self.started is not None
+        self.wall = time.perf_counter() - self.started
+
+    def add_time(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Times the code run in the block as the phase 'name', pausing the phase it is nested in.
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        now = time.perf_counter()
+        if stack:
+            self.add_time(stack[-1], now - self.local.resumed)
+        stack.append(name)
+        self.local.resumed = now
+        start = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.add_time(stack.pop(), now - self.local.resumed)
+            self.local.resumed = now
+            if self.hook is not None:
+                self.hook(name, now - start)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """
+        Adds amount to the counter 'name'.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self) -> CompileReport:
+        """
+        Returns the timings in seconds and the counters collected so far.
+        """
+        with self.lock:
+            return {
+                "timings": dict(self.timings),
+                "counters": dict(self.counters),
+                "wall": self.wall,
+                "dry_run": self.dry_run,
+            }
+
+
+class NullProfiler:
+    """
+    Stands in for a profiler when none is given, doing nothing.
+    """
+
+    dry_run = False
+
+    def phase(self, name: str) -> nullcontext:
+        return _NO_PHASE
+
+    def count(self, name: str, amount: int = 1) -> None:
+        pass
+
+
+_NO_PHASE = nullcontext()
+
+NULL_PROFILER = NullProfiler()
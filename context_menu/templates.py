@@ -0,0 +1,231 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import os
+import platform
+import re
+import shlex
+import sys
+
+if TYPE_CHECKING:
+    from typing import Callable, Tuple
+
+    from context_menu.menus import CommandVar
+
+    Token = Tuple[str, str]
+
+# templates.py -------------------------------------
+#
+# Shell commands with named placeholders, such as 'touch {FILENAME}x'. A
+# template is parsed and validated once into a list of tokens, then rendered
+# for each file, either directly or as Python code embedded in the menus.
+
+# Kinds of tokens
+LITERAL = "literal"
+VARIABLE = "variable"
+
+# Names allowed in the placeholders, the same as the command_vars
+VARIABLES = ("FILENAME", "DIR", "DIRECTORY", "PYTHONLOC")
+
+# Characters cmd.exe interprets, even between quotes for some of them
+CMD_METACHARACTERS = re.compile(r'([()%!^"<>&|])')
+
+
+def parse(source: str) -> list[Token]:
+    """
+    Splits a template into literal and variable tokens.
+
+    '{NAME}' is a variable, '{{' and '}}' are literal braces. Raises ValueError if the template is invalid.
+    """
+    tokens: list[Token] = []
+    literal = ""
+    i = 0
+    while i < len(source):
+        char = source[i]
+        if char in "{}" and source[i : i + 2] == char * 2:
+            literal += char
+            i += 2
+            continue
+        if char == "}":
+            raise ValueError(f"single '}}' at position {i} in {source!r}")
+        if char == "{":
+            end = source.find("}", i)
+            if end == -1:
+                raise ValueError(f"unclosed '{{' at position {i} in {source!r}")
+            name = source[i + 1 : end]
+            if name.upper() not in VARIABLES:
+                raise ValueError(
+                    f"unknown variable {name!r} in {source!r}, expected one of {', '.join(VARIABLES)}"
+                )
+            if literal:
+                tokens.append((LITERAL, literal))
+                literal = ""
+            tokens.append((VARIABLE, name.upper()))
+            i = end + 1
+            continue
+        literal += char
+        i += 1
+    if literal:
+        tokens.append((LITERAL, literal))
+    return tokens
+
+
+def get_quote(system: str | None = None) -> Callable[[str], str]:
+    """
+    Returns the function quoting a value for the shell of a platform, the current one by default.
+    """
+    if (system or platform.system()) == "Windows":
+        return quote_cmd
+    return shlex.quote
+
+
+def quote_cmd(value: str) -> str:
+    """
+    Quotes a value for cmd.exe, which os.system runs on Windows.
+
+    The value is quoted as a single argument of the program first. Every character cmd.exe interprets, quotes
+    included, is then escaped with a caret, so cmd.exe expands nothing in it and passes the argument as it is.
+    """
+    argument = re.sub(r'(\\*)"', r'\1\1\\"', value)
+    argument = '"' + re.sub(r"(\\+)$", r"\1\1", argument) + '"'
+    return CMD_METACHARACTERS.sub(r"^\1", argument)
+
+
+def python_string(text: str) -> str:
+    """
+    Escapes text to be put between single quotes in Python code.
+    """
+    return text.replace("\\", "\\\\").replace("'", "\\'")
+
+
+class CommandTemplate:
+    """
+    A shell command with named placeholders, parsed once.
+
+    For example, CommandTemplate('touch {FILENAME}x'). The values are quoted for the shell.
+    """
+
+    __slots__ = ("source", "tokens", "quote")
+
+    def __init__(self, source: str, quote: bool = True) -> None:
+        self.source = source
+        self.tokens = parse(source)
+        self.quote = quote
+
+    @classmethod
+    def from_legacy(
+        cls, command: str, command_vars: list[CommandVar]
+    ) -> CommandTemplate:
+        """
+        Creates a template from a command where each '?' is replaced by the next of the command_vars.
+
+        Braces in the command are kept as they are, and the values aren't quoted, as before templates existed.
+        """
+        parts = command.split("?")
+        if len(parts) - 1 != len(command_vars):
+            raise ValueError(
+                f"{command!r} has {len(parts) - 1} '?' but {len(command_vars)} command_vars were given"
+            )
+        tokens: list[Token] = []
+        for i, part in enumerate(parts):
+            if i > 0:
+                name = command_vars[i - 1].upper()
+                if name not in VARIABLES:
+                    raise ValueError(
+                        f"unknown command var {name!r}, expected one of {', '.join(VARIABLES)}"
+                    )
+                tokens.append((VARIABLE, name))
+            if part:
+                tokens.append((LITERAL, part))
+        template = cls.from_tokens(tokens, quote=False)
+        template.source = command
+        return template
+
+    @classmethod
+    def from_tokens(cls, tokens: list[Token], quote: bool = True) -> CommandTemplate:
+        """
+        Creates a template from tokens that were already parsed, for example in a generated command.
+        """
+        template = cls.__new__(cls)
+        template.tokens = [(kind, text) for kind, text in tokens]
+        template.quote = quote
+        template.source = "".join(
+            text.replace("{", "{{").replace("}", "}}")
+            if kind == LITERAL
+            else "{" + text + "}"
+            for kind, text in template.tokens
+        )
+        return template
+
+    @classmethod
+    def from_command(
+        cls,
+        command: str | CommandTemplate,
+        command_vars: list[CommandVar] | None = None,
+    ) -> CommandTemplate:
+        """
+        Returns the template of a command, whether it is a template, a command with command_vars or a plain command.
+        """
+        if isinstance(command, CommandTemplate):
+            return command
+        if command_vars != None:
+            assert command_vars is not None
+            return cls.from_legacy(command, command_vars)
+        return cls.from_tokens([(LITERAL, command)] if command else [])
+
+    @property
+    def variables(self) -> list[str]:
+        """
+        The names of the variables, in order.
+        """
+        return [text for kind, text in self.tokens if kind == VARIABLE]
+
+    def render(
+        self, values: dict[str, str], quote: Callable[[str], str] | None = None
+    ) -> str:
+        """
+        Returns the command with the variables replaced by their values, quoted for the current platform by default.
+        """
+        if quote is None:
+            quote = get_quote() if self.quote else str
+        return "".join(
+            text if kind == LITERAL else quote(values[text])
+            for kind, text in self.tokens
+        )
+
+    def to_python(self, expressions: dict[str, str], quote_code: str = "{}") -> str:
+        """
+        Returns a Python expression building the command, given the Python expressions of the variables.
+
+        If the template is quoted, each value is put in quote_code, for example 'shlex.quote({})'.
+        """
+        code = "'"
+        for kind, text in self.tokens:
+            if kind == LITERAL:
+                code += python_string(text)
+                continue
+            value = expressions[text]
+            if self.quote:
+                value = quote_code.format(value)
+            code += "' + " + value + " + '"
+        return code + "'"
+
+    def __repr__(self) -> str:
+        return f"CommandTemplate({self.source!r}, quote={self.quote!r})"
+
+
+def run_command(template: CommandTemplate, filenames: list[str]) -> None:
+    """
+    Runs a template through the shell once for the selected files, with the first one as FILENAME.
+
+    Like the generated handlers, the command isn't repeated for the other files, per_file commands do that.
+    """
+    if not filenames:
+        return
+    values = {
+        "FILENAME": filenames[0],
+        "DIR": os.getcwd(),
+        "DIRECTORY": os.getcwd(),
+        "PYTHONLOC": sys.executable,
+    }
+    os.system(template.render(values))
@@ -0,0 +1,177 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterator, Tuple
+
+    from context_menu.menus import ItemType
+
+    TreeEvent = Tuple[str, ItemType]
+
+# tree.py -------------------------------------
+#
+# Traversal of the menu trees shared by the platform-specific menus.
+
+# Events yielded by walk()
+ENTER = "enter"
+COMMAND = "command"
+EXIT = "exit"
+COLLAPSED = "collapsed"
+
+
+def walk(
+    items: list[ItemType], expand: Callable[[ItemType], bool] | None = None
+) -> Iterator[TreeEvent]:
+    """
+    Iterates depth first through the items and their sub items, in order.
+
+    Yields (ENTER, menu) before the sub items of a menu, (EXIT, menu) after them,
+    and (COMMAND, command) for each command.
+
+    If given, expand is called on each menu; the menus it returns False for are
+    yielded as (COLLAPSED, menu), without their sub items.
+
+    Uses an explicit stack instead of recursion, so the depth of the tree isn't
+    limited by sys.getrecursionlimit().
+    """
+    stack = [(None, iter(items))]
+    while stack:
+        menu, sub_items = stack[-1]
+        for item in sub_items:
+            if item.isMenu:
+                if expand is not None and not expand(item):
+                    yield COLLAPSED, item
+                    continue
+                yield ENTER, item
+                stack.append((item, iter(item.sub_items)))
+                break
+            yield COMMAND, item
+        else:
+            stack.pop()
+            if menu is not None:
+                yield EXIT, menu
+
+
+def find_shared_menus(items: list[ItemType]) -> set[int]:
+    """
+    Returns the ids of the menus that appear more than once in the tree.
+
+    The sub items of a menu are only visited the first time it is seen.
+    """
+    seen: set[int] = set()
+    shared: set[int] = set()
+
+    def expand(menu: ItemType) -> bool:
+        if id(menu) in seen:
+            shared.add(id(menu))
+            return False
+        seen.add(id(menu))
+        return True
+
+    for _ in walk(items, expand):
+        pass
+
+    return shared
+
+
+def page_label(first: str, last: str, previous: str | None, next: str | None) -> str:
+    """
+    Returns the label of a page going from the item 'first' to the item 'last', like "A–F".
+
+    Each end is the shortest prefix telling it apart from the other end, and from the last item of the previous
+    page or the first item of the next page.
+    """
+
+    def prefix(name: str, neighbours: list[str | None]) -> str:
+        folded = name.casefold()
+        length = 1
+        for neighbour in neighbours:
+            if neighbour is None:
+                continue
+            neighbour = neighbour.casefold()
+            while length < len(name) and folded[:length] == neighbour[:length]:
+                length += 1
+        return name[:1].upper() + name[1:length]
+
+    start, end = prefix(first, [previous, last]), prefix(last, [next, first])
+    return start if start == end else f"{start}–{end}"
+
+
+def split_level(items: list[ItemType], max_items: int) -> list[ItemType]:
+    """
+    Returns the items of a level, sorted by name and split into balanced pages of at most max_items items if there
+    are more. Pages are grouped again in pages until the level itself has at most max_items items.
+    """
+    if len(items) <= max_items:
+        return items
+
+    from context_menu.menus import ContextMenu
+
+    level = sorted(items, key=lambda item: item.name.casefold())
+    # The names of the first and the last item under each entry of the level
+    bounds = [(item.name, item.name) for item in level]
+    while len(level) > max_items:
+        page_count = -(-len(level) // max_items)
+        page_size = -(-len(level) // page_count)
+        starts = range(0, len(level), page_size)
+        pages_bounds = [
+            (bounds[start][0], bounds[min(start + page_size, len(level)) - 1][1])
+            for start in starts
+        ]
+        labels = [
+            page_label(
+                first,
+                last,
+                pages_bounds[index - 1][1] if index > 0 else None,
+                pages_bounds[index + 1][0] if index + 1 < len(starts) else None,
+            )
+            for index, (first, last) in enumerate(pages_bounds)
+        ]
+        # Pages of items with the same name get the same label, and would be merged into one registry key
+        folded = [label.casefold() for label in labels]
+        labels = [
+            f"{label} ({index + 1})" if folded.count(folded[index]) > 1 else label
+            for index, label in enumerate(labels)
+        ]
+        pages: list[ItemType] = []
+        for label, start in zip(labels, starts):
+            page = ContextMenu(label)
+            page.add_items(level[start : start + page_size])
+            pages.append(page)
+        level, bounds = pages, pages_bounds
+    return level
+
+
+def paginate(items: list[ItemType], max_items: int) -> list[ItemType]:
+    """
+    Returns the items with every level of more than max_items items split into alphabetical pages, see split_level.
+
+    The menus are copied, so the items themselves aren't changed. A menu appearing several times is copied once,
+    and the items of the providers, added when the menu opens, aren't paginated.
+    """
+    from context_menu.menus import ContextMenu
+
+    copies: dict[int, ItemType] = {}
+    seen: set[int] = set()
+
+    def expand(menu: ItemType) -> bool:
+        if id(menu) in seen:
+            return False
+        seen.add(id(menu))
+        return True
+
+    def copy_items(items: list[ItemType]) -> list[ItemType]:
+        return split_level([copies.get(id(item), item) for item in items], max_items)
+
+    for event, item in walk(items, expand):
+        if event == EXIT:
+            copy = ContextMenu(
+                item.name,
+                items_provider=item.items_provider,
+                ttl=item.ttl,
+                budget=item.budget,
+            )
+            copy.add_items(copy_items(item.sub_items))
+            copies[id(item)] = copy
+    return copy_items(items)
@@ -3,10 +3,16 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 import os
 import ctypes
+import subprocess
+import hashlib
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from context_menu import callbacks, launcher, profiling, templates, tree
 
 if TYPE_CHECKING:
-    from typing import Any
+    from typing import Any, Callable
     from types import FunctionType
     from context_menu.menus import (
         ItemType,
@@ -105,6 +111,25 @@ try:
                 delete_key(path + "\\" + key)
         winreg.DeleteKey(open_key, "")
 
+    def delete_key_value(
+        key_path: str, subkey_name: str, hive: int = winreg.HKEY_CURRENT_USER
+    ) -> None:
+        """
+        Deletes a value of a key.
+        """
+        with winreg.OpenKey(hive, key_path, 0, winreg.KEY_SET_VALUE) as open_key:
+            winreg.DeleteValue(open_key, subkey_name)
+
+    def key_exists(path: str, hive: int = winreg.HKEY_CURRENT_USER) -> bool:
+        """
+        Returns True if the key exists at the given path.
+        """
+        try:
+            winreg.CloseKey(winreg.OpenKey(hive, path))
+            return True
+        except OSError:
+            return False
+
 except:
 
     def create_key(path: str, hive: int = 0) -> None:
@@ -139,6 +164,18 @@ except:
         """
         raise NotImplementedError("winreg is not available on this platform")
 
+    def delete_key_value(key_path: str, subkey_name: str, hive: int = 0) -> None:
+        """
+        Deletes a value of a key.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
+    def key_exists(path: str, hive: int = 0) -> bool:
+        """
+        Returns True if the key exists at the given path.
+        """
+        raise NotImplementedError("winreg is not available on this platform")
+
     print("Not windows")
 
 
@@ -155,7 +192,10 @@ CONTEXT_SHORTCUTS = {
     "DRIVE": "Software\\Classes\\Drive\\shell",
 }
 
-# Not used yet, but could be useful in the future
+# Key under Software\Classes holding the sub menus shared through ExtendedSubCommandsKey
+SHARED_STORE = "context_menu.store"
+
+# pythonw runs the headless commands, without opening a console
 COMMAND_PRESETS = {
     "python": sys.executable,
     "pythonw": os.path.join(os.path.dirname(sys.executable), "pythonw.exe"),
@@ -181,6 +221,15 @@ def join_keys(*keys: str) -> str:
     return "\\".join(keys)
 
 
+def delete_store_entry(digest: str) -> None:
+    """
+    Deletes an entry of the shared store, if it exists.
+    """
+    store_path = join_keys(CONTEXT_SHORTCUTS["FILELOC"], SHARED_STORE, digest)
+    if key_exists(store_path):
+        delete_key(store_path)
+
+
 def context_registry_format(item: str) -> str:
     """
     Converts a verbose type into a registry path.
@@ -257,37 +306,295 @@ def create_directory_background_command(
     return full_command
 
 
+def create_launcher_command(
+    func_name: str,
+    func_file_name: str,
+    func_dir_path: str,
+    params: str,
+    launch_options: dict[str, Any],
+    background: bool = False,
+) -> str:
+    """
+    Creates a registry valid command that runs a function through the launcher, applying the launch options.
+
+    Used instead of the two commands above when options such as single_instance are set.
+    Headless commands run under pythonw, so no console opens. Raises a ValueError for max_memory, which can't be
+    enforced on Windows.
+    """
+    if launch_options.get("max_memory") != None:
+        raise ValueError("max_memory isn't supported on Windows")
+    files_code = "[os.getcwd()]" if background else "sys.argv[1:]"
+    launch_code = launcher.build_launch_code(
+        func_name, func_file_name, func_dir_path, params, files_code, launch_options
+    )
+    python_loc = (
+        command_preset_format("pythonw")
+        if launch_options.get("headless")
+        else sys.executable
+    )
+    full_command = f'"{python_loc}" -c "{launch_code}"'
+    if not background:
+        full_command += ' "%1"'
+
+    return full_command
+
+
+def aggregate_launch_options(
+    launch_options: dict[str, Any], multi_select_model: str | None
+) -> dict[str, Any]:
+    """
+    Returns the launch options of a python function, with single_instance set if Explorer starts it once per file.
+
+    The first process then collects the files of the others, and calls the function once with all of them.
+    """
+    if multi_select_model in launcher.AGGREGATED_MULTI_SELECT_MODELS:
+        return dict(launch_options, single_instance=True)
+    return launch_options
+
+
 def create_shell_command(command: str, command_vars: list[CommandVar]) -> str:
     """
     Creates a shell command and replaces '?' with the command_vars list
     """
+    return create_template_command(
+        templates.CommandTemplate.from_legacy(command, command_vars)
+    )
+
+
+def create_template_command(template: templates.CommandTemplate) -> str:
+    """
+    Creates a shell command from a template, with the variables evaluated when the command runs.
+    """
+    imports = "import os; import sys"
+    if template.quote and template.variables:
+        # Quoted for cmd.exe, which os.system runs
+        imports += (
+            f"; sys.path.insert(0, '{launcher.PACKAGE_PARENT_DIR}')"
+            "; from context_menu import templates"
+        )
+    command_code = template.to_python(COMMAND_VARS, "templates.quote_cmd({})")
+    python_section = f"{imports}; os.system({command_code})"
+    # Always quoted as it has spaces, with its own quotes escaped so they don't end the argument
+    full_command = '"{}" -c {} "%1"'.format(
+        sys.executable, subprocess.list2cmdline([python_section])
+    )
+    return full_command
+
+
+def create_per_file_command(
+    template: templates.CommandTemplate, max_parallel: int, background: bool = False
+) -> str:
+    """
+    Creates a command running the template once per selected file through the launcher.
+
+    Explorer starts one command per selected file, so their selections are merged first.
+    """
+    files_code = "[os.getcwd()]" if background else "sys.argv[1:]"
+    per_file_code = launcher.build_per_file_code(
+        template.tokens,
+        template.quote,
+        files_code,
+        max_parallel,
+        None if background else launcher.command_key(template.source, "per_file"),
+    )
+    full_command = subprocess.list2cmdline([sys.executable, "-c", per_file_code])
+    if not background:
+        full_command += ' "%1"'
 
-    transformed_vars = [
-        "' + " + command_var_format(item) + " + '" for item in command_vars
-    ]
-    new_command = command.replace("?", "{}").format(*transformed_vars)
-    python_section = """import os; import sys; os.system('{}')""".format(new_command)
-    full_command = '"{}" -c "{}" "%1"'.format(sys.executable, python_section)
     return full_command
 
 
 # windows_menus.py ----------------------------------------------------------------------------------------
 
 
+class RegistryWriter:
+    """
+    Writes the keys and values of a menu to the registry, keeping track of what was written.
+    """
+
+    def __init__(
+        self,
+        journal: RegistryJournal | None = None,
+        profiler: profiling.CompileProfiler
+        | profiling.NullProfiler = profiling.NULL_PROFILER,
+        dry_run: bool = False,
+    ) -> None:
+        """
+        With dry_run, nothing is written, but the hash and the counters of the profiler are the same.
+        """
+        self.hash = hashlib.sha256()
+        self.journal = journal
+        self.profiler = profiler
+        self.dry_run = dry_run
+
+    def create_key(self, path: str) -> None:
+        """
+        Creates a key at the desired path.
+        """
+        self.profiler.count(profiling.KEYS_CREATED)
+        if not self.dry_run:
+            with self.profiler.phase(profiling.REGISTRY):
+                if self.journal is not None:
+                    self.journal.before_create_key(path)
+                create_key(path)
+        self.hash.update(f"{path}\0".encode("utf-8"))
+
+    def set_key_value(self, key_path: str, subkey_name: str, value: str | int) -> None:
+        """
+        Changes the value of a subkey.
+        """
+        self.profiler.count(profiling.VALUES_SET)
+        if not self.dry_run:
+            with self.profiler.phase(profiling.REGISTRY):
+                if self.journal is not None:
+                    self.journal.before_set_key_value(key_path, subkey_name)
+                set_key_value(key_path, subkey_name, value)
+        self.hash.update(f"{key_path}\0{subkey_name}\0{value}\0".encode("utf-8"))
+
+    def hexdigest(self) -> str:
+        """
+        Returns a hash of everything written so far.
+        """
+        return self.hash.hexdigest()
+
+
+class RegistryJournal:
+    """
+    Records what is about to change in the registry, so it can be undone in one pass.
+
+    Only the topmost keys created are recorded, since deleting them deletes everything under them.
+    The previous values are recorded for the keys that already existed, None if the value didn't exist.
+    """
+
+    def __init__(self, entries: list[list[Any]] | None = None) -> None:
+        # ["key", path] or ["value", key_path, subkey_name, previous value]
+        self.entries: list[list[Any]] = entries or []
+        self.created: set[str] = set()
+        self.recorded: set[tuple[str, str]] = set()
+        self.lock = threading.Lock()
+
+    def before_create_key(self, path: str) -> None:
+        """
+        Records the key if it doesn't exist yet, or its first missing parent.
+        """
+        parent = path.rpartition("\\")[0]
+        with self.lock:
+            if path in self.created or parent in self.created:
+                self.created.add(path)
+                return
+        if key_exists(path):
+            return
+
+        # CreateKey also creates the missing parents
+        new_keys = [path]
+        while parent and not key_exists(parent):
+            new_keys.append(parent)
+            parent = parent.rpartition("\\")[0]
+        with self.lock:
+            self.created.update(new_keys)
+            self.entries.append(["key", new_keys[-1]])
+
+    def before_set_key_value(self, key_path: str, subkey_name: str) -> None:
+        """
+        Records the previous value of a subkey, unless its key is new.
+        """
+        with self.lock:
+            if key_path in self.created or (key_path, subkey_name) in self.recorded:
+                return
+            self.recorded.add((key_path, subkey_name))
+        try:
+            previous = get_key_value(key_path, subkey_name)
+        except OSError:
+            previous = None
+        with self.lock:
+            self.entries.append(["value", key_path, subkey_name, previous])
+
+    def rollback(self) -> None:
+        """
+        Restores the previous values and deletes the new keys, in the reverse order they were recorded.
+        """
+        for entry in reversed(self.entries):
+            if entry[0] == "key":
+                if key_exists(entry[1]):
+                    delete_key(entry[1])
+            elif entry[3] == None:
+                try:
+                    delete_key_value(entry[1], entry[2])
+                except OSError:
+                    pass
+            else:
+                set_key_value(entry[1], entry[2], entry[3])
+
+
+class _ThreadWriter:
+    """
+    Forwards the writes to the RegistryWriter of the current thread.
+    """
+
+    def __init__(self, local: threading.local) -> None:
+        self.local = local
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.local.writer, name)
+
+
+class RegistryCompileError(Exception):
+    """
+    Raised when some subtrees of a menu could not be written. The other subtrees were written.
+    """
+
+    def __init__(self, name: str, errors: list[tuple[str, Exception]]) -> None:
+        self.name = name
+        self.errors = errors
+        details = ", ".join(f"{subtree}: {error!r}" for subtree, error in errors)
+        super().__init__(f"failed to write {len(errors)} subtree(s) of '{name}': {details}")
+
+
 # Used to create a Registry entry
 class RegistryMenu:
     """
     Class to convert the general menu from menus.py to a Windows-specific menu.
     """
 
-    def __init__(self, name: str, sub_items: list[ItemType], type: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        sub_items: list[ItemType],
+        type: str,
+        shared_store: bool = False,
+        workers: int = 1,
+        transactional: bool = False,
+        max_items_per_level: int | None = None,
+    ) -> None:
         """
         Handled automatically by menus.py, but requires a name, all the sub items, and a type
+
+        With shared_store, the sub menus are written once in a shared store instead of under each menu.
+        With more than one worker, the top level items are written concurrently.
+        With transactional, what is about to change is recorded in a journal first, and rolled back if the compilation fails.
+        Levels of more than max_items_per_level items are split into alphabetical sub menus.
         """
         self.name = name
-        self.sub_items = sub_items
+        self.sub_items = (
+            tree.paginate(sub_items, max_items_per_level)
+            if max_items_per_level != None
+            else sub_items
+        )
         self.type = type.upper()
         self.path = context_registry_format(type)
+        self.shared_store = shared_store
+        self.workers = workers
+        self.transactional = transactional
+        self.writer = RegistryWriter()
+        self.journal: RegistryJournal | None = None
+        self.profiler: profiling.CompileProfiler | profiling.NullProfiler = (
+            profiling.NULL_PROFILER
+        )
+        # Known once compiled
+        self.location: str | None = None
+        self.content_hash: str | None = None
+        # The shared store entries the menu references, known once compiled with shared_store
+        self.store_entries: list[str] | None = None
 
     def create_menu(self, name: str, path: str) -> str:
         """
@@ -296,74 +603,310 @@ class RegistryMenu:
         Used in the compile method.
         """
         key_path = join_keys(path, name)
-        create_key(key_path)
+        self.writer.create_key(key_path)
 
-        set_key_value(key_path, "MUIVerb", name)
-        set_key_value(key_path, "subcommands", "")
+        self.writer.set_key_value(key_path, "MUIVerb", name)
+        self.writer.set_key_value(key_path, "subcommands", "")
 
         key_shell_path = join_keys(key_path, "shell")
-        create_key(key_shell_path)
+        self.writer.create_key(key_shell_path)
 
         return key_shell_path
 
-    def create_command(self, name: str, path: str, command: str) -> None:
+    def create_command(
+        self,
+        name: str,
+        path: str,
+        command: str,
+        multi_select_model: str | None = None,
+    ) -> None:
         """
         Creates a key with a command subkey with the 'name' and 'command', at path 'path'.
         """
         key_path = join_keys(path, name)
-        create_key(key_path)
-        set_key_value(key_path, "", name)
+        self.writer.create_key(key_path)
+        self.writer.set_key_value(key_path, "", name)
+        if multi_select_model != None:
+            self.writer.set_key_value(key_path, "MultiSelectModel", multi_select_model)
 
         command_path = join_keys(key_path, "command")
-        create_key(command_path)
-        set_key_value(command_path, "", command)
+        self.writer.create_key(command_path)
+        self.writer.set_key_value(command_path, "", command)
+
+    def get_command(self, item: ItemType) -> str:
+        """
+        Returns the registry command of a command item.
+        """
+        if item.command == None:
+            # If a Python function is defined
+            with self.profiler.phase(profiling.RESOLVE):
+                func_name, func_file_name, func_dir_path = item.get_method_info()
+            self.profiler.count(profiling.CALLBACKS_RESOLVED)
+            launch_options = aggregate_launch_options(
+                item.get_launch_options(), item.multi_select_model
+            )
+            if launch_options:
+                # If it has to go through the launcher
+                return create_launcher_command(
+                    func_name,
+                    func_file_name,
+                    func_dir_path,
+                    item.params,
+                    launch_options,
+                    self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"],
+                )
+            if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
+                # If it requires a background command
+                return create_directory_background_command(
+                    func_name, func_file_name, func_dir_path, item.params
+                )
+            # If it requires a file command
+            return create_file_select_command(
+                func_name, func_file_name, func_dir_path, item.params
+            )
+        assert item.command is not None
+        if item.per_file:
+            # If the command runs once per selected file
+            return create_per_file_command(
+                templates.CommandTemplate.from_command(item.command, item.command_vars),
+                item.max_parallel,
+                self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"],
+            )
+        if isinstance(item.command, templates.CommandTemplate):
+            # If the item has named variables
+            return create_template_command(item.command)
+        if item.command_vars != None:
+            # If the item has to be ran from os.system
+            assert item.command is not None
+            assert item.command_vars is not None
+            return create_shell_command(item.command, item.command_vars)
+        # The item is just a plain old command
+        assert item.command is not None
+        return item.command
+
+    def compile_command(self, item: ItemType, path: str) -> None:
+        """
+        Creates the key of a command at path 'path'.
+        """
+        with self.profiler.phase(profiling.GENERATE):
+            command = self.get_command(item)
+        self.create_command(item.name, path, command, item.multi_select_model)
 
     def compile(
-        self, items: list[ItemType] | None = None, path: str | None = None
+        self,
+        items: list[ItemType] | None = None,
+        path: str | None = None,
+        profiler: profiling.CompileProfiler | None = None,
+        dry_run: bool = False,
     ) -> None:
         """
-        Used to create the menu. Recursively iterates through each element in the top level menu.
+        Used to create the menu. Iterates through each element in the top level menu, or in 'items' at 'path' if given.
+
+        Uses an explicit stack instead of recursion, so deep cascades don't hit the recursion limit.
+        The phases and the writes are reported to profiler. With dry_run, the registry is only read, never changed.
         """
-        if items == None:
-            # run_admin()
-            items = self.sub_items
-            path = self.create_menu(self.name, self.path)
+        if profiler is not None:
+            self.profiler = profiler
+        self.writer = RegistryWriter(self.writer.journal, self.profiler, dry_run)
+        if items != None:
+            assert path is not None
+            self.compile_items(items, path)
+            return
 
-        assert items is not None
-        assert path is not None
-        for item in items:
-            if item.isMenu:
+        # run_admin()
+        if self.transactional and not dry_run:
+            self.journal = RegistryJournal()
+            self.writer.journal = self.journal
+        try:
+            if self.shared_store:
+                self.compile_shared()
+            else:
+                self.compile_menu()
+        except BaseException:
+            # Leaves the registry as it was before the compilation
+            if self.journal is not None:
+                self.journal.rollback()
+            raise
+
+    def compile_menu(self) -> None:
+        """
+        Creates the menu with its sub items under it.
+        """
+        path = self.create_menu(self.name, self.path)
+        self.run_subtrees(
+            [
+                (item.name, lambda item=item: self.compile_items([item], path))
+                for item in self.sub_items
+            ]
+        )
+        self.location = join_keys(self.path, self.name)
+        self.content_hash = self.writer.hexdigest()
+
+    def compile_items(self, items: list[ItemType], path: str) -> None:
+        """
+        Creates the keys of the items and their sub items at path 'path'.
+        """
+        paths = [path]
+        for event, item in tree.walk(items):
+            self.profiler.count(profiling.NODES_VISITED)
+            if event == tree.ENTER:
                 # if the item is a menu
-                submenu_path = self.create_menu(item.name, path)
-                self.compile(items=item.sub_items, path=submenu_path)
+                paths.append(self.create_menu(item.name, paths[-1]))
+            elif event == tree.EXIT:
+                paths.pop()
+            else:
+                # Otherwise the item is  a command
+                self.compile_command(item, paths[-1])
+
+    def run_subtrees(self, subtrees: list[tuple[str, Callable[[], None]]]) -> None:
+        """
+        Runs the functions writing independent subtrees, up to self.workers at a time.
+
+        Each subtree is written with its own RegistryWriter, combined in order afterwards so the content hash
+        doesn't depend on the number of workers. The errors are collected per subtree and raised together.
+        """
+        top_writer = self.writer
+        writers = [
+            RegistryWriter(top_writer.journal, top_writer.profiler, top_writer.dry_run)
+            for _ in subtrees
+        ]
+        errors: list[tuple[str, Exception]] = []
+        local = threading.local()
+
+        def run(index: int) -> None:
+            local.writer = writers[index]
+            name, write = subtrees[index]
+            try:
+                write()
+            except Exception as e:
+                errors.append((name, e))
+
+        self.writer = _ThreadWriter(local)  # type: ignore
+        try:
+            if self.workers <= 1:
+                for index in range(len(subtrees)):
+                    run(index)
+            else:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    for _ in executor.map(run, range(len(subtrees))):
+                        pass
+        finally:
+            self.writer = top_writer
+
+        for writer in writers:
+            top_writer.hash.update(writer.hexdigest().encode("utf-8"))
+        if errors:
+            raise RegistryCompileError(self.name, errors)
+
+    # Shared store layout
+
+    def create_menu_reference(self, name: str, path: str, digest: str) -> None:
+        """
+        Creates a menu with the given name and path, whose items are in the shared store entry 'digest'.
+        """
+        key_path = join_keys(path, name)
+        self.writer.create_key(key_path)
+
+        self.writer.set_key_value(key_path, "MUIVerb", name)
+        self.writer.set_key_value(
+            key_path, "ExtendedSubCommandsKey", join_keys(SHARED_STORE, digest)
+        )
+
+    def hash_menus(self) -> tuple[str, dict[int, str], dict[int, str]]:
+        """
+        Hashes the content of the top level menu and of each sub menu, from their items and commands.
+
+        Returns the digest of the top level menu, the digest of each sub menu and the command of each command, by id.
+        """
+        digests: dict[int, str] = {}
+        commands: dict[int, str] = {}
+
+        def expand(menu: ContextMenu) -> bool:
+            return id(menu) not in digests
+
+        hashes = [hashlib.sha256()]
+        for event, item in tree.walk(self.sub_items, expand):
+            self.profiler.count(profiling.NODES_VISITED)
+            if event == tree.ENTER:
+                hashes.append(hashlib.sha256())
                 continue
+            if event == tree.EXIT:
+                digests[id(item)] = hashes.pop().hexdigest()[:32]
+            if item.isMenu:
+                # The name is part of the parent, so menus with the same items share their entry
+                content = f"menu\0{item.name}\0{digests[id(item)]}\0"
+            else:
+                with self.profiler.phase(profiling.GENERATE):
+                    commands[id(item)] = self.get_command(item)
+                content = f"command\0{item.name}\0{commands[id(item)]}\0"
+                if item.multi_select_model != None:
+                    content += f"{item.multi_select_model}\0"
+            hashes[-1].update(content.encode("utf-8"))
 
-            # Otherwise the item is  a command
-            if item.command == None:
-                # If a Python function is defined
-                func_name, func_file_name, func_dir_path = item.get_method_info()
-                new_command = None
-                if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
-                    # If it requires a background command
-                    new_command = create_directory_background_command(
-                        func_name, func_file_name, func_dir_path, item.params
-                    )
-                else:
-                    # If it requires a file command
-                    new_command = create_file_select_command(
-                        func_name, func_file_name, func_dir_path, item.params
-                    )
-                self.create_command(item.name, path, new_command)
-            elif item.command_vars != None:
-                # If the item has to be ran from os.system
-                assert item.command is not None
-                assert item.command_vars is not None
-                new_command = create_shell_command(item.command, item.command_vars)
-                self.create_command(item.name, path, new_command)
+        return hashes[0].hexdigest()[:32], digests, commands
+
+    def write_store_entry(
+        self,
+        digest: str,
+        items: list[ItemType],
+        digests: dict[int, str],
+        commands: dict[int, str],
+    ) -> None:
+        """
+        Writes the items of a menu to the shared store, unless an entry with the same digest is already there.
+        """
+        store_path = join_keys(CONTEXT_SHORTCUTS["FILELOC"], SHARED_STORE, digest)
+        try:
+            if get_key_value(store_path, "ContentHash") == digest:
+                return
+        except OSError:
+            pass
+
+        self.writer.create_key(store_path)
+        shell_path = join_keys(store_path, "shell")
+        self.writer.create_key(shell_path)
+        for item in items:
+            if item.isMenu:
+                self.create_menu_reference(item.name, shell_path, digests[id(item)])
             else:
-                # The item is just a plain old command
-                assert item.command is not None
-                self.create_command(item.name, path, item.command)
+                self.create_command(
+                    item.name, shell_path, commands[id(item)], item.multi_select_model
+                )
+        # Written last, marks the entry as complete
+        self.writer.set_key_value(store_path, "ContentHash", digest)
+
+    def compile_shared(self) -> None:
+        """
+        Creates the menu with each unique sub menu written once in the shared store, and referenced with ExtendedSubCommandsKey.
+
+        Menus with the same items, in this menu or in menus compiled for other types, share the same entry.
+        The entries are recorded in store_entries, and removed once no menu of the index references them.
+        """
+        top_digest, digests, commands = self.hash_menus()
+
+        entries = {top_digest: self.sub_items}
+        for event, item in tree.walk(
+            self.sub_items, lambda menu: digests[id(menu)] not in entries
+        ):
+            if event == tree.ENTER:
+                entries[digests[id(item)]] = item.sub_items
+        # The entries are independent from each other
+        self.run_subtrees(
+            [
+                (
+                    digest,
+                    lambda digest=digest, items=items: self.write_store_entry(
+                        digest, items, digests, commands
+                    ),
+                )
+                for digest, items in entries.items()
+            ]
+        )
+
+        self.create_menu_reference(self.name, self.path, top_digest)
+        self.store_entries = list(entries)
+        self.location = join_keys(self.path, self.name)
+        self.content_hash = self.writer.hexdigest()
 
 
 # Fast command class
@@ -379,10 +922,14 @@ class FastRegistryCommand:
         self,
         name: str,
         type: ActivationType | str,
-        command: str,
-        python: FunctionType,
+        command: str | templates.CommandTemplate,
+        python: FunctionType | str,
         params: str,
         command_vars: list[CommandVar],
+        launch_options: dict[str, Any] | None = None,
+        per_file: bool = False,
+        max_parallel: int = launcher.MAX_PARALLEL,
+        multi_select_model: str | None = None,
     ) -> None:
         self.name = name
         self.type = type
@@ -391,10 +938,22 @@ class FastRegistryCommand:
         self.python = python
         self.params = params
         self.command_vars = command_vars
+        self.launch_options = aggregate_launch_options(
+            launch_options or {}, multi_select_model
+        )
+        self.per_file = per_file
+        self.max_parallel = max_parallel
+        self.multi_select_model = multi_select_model
+        self.writer = RegistryWriter()
+        # Known once compiled
+        self.location: str | None = None
+        self.content_hash: str | None = None
 
     def get_method_info(self) -> MethodInfo:
         import inspect
 
+        if isinstance(self.python, str):
+            return callbacks.resolve_reference(self.python)
         func_file_path = os.path.abspath(inspect.getfile(self.python))
 
         func_dir_path = os.path.dirname(func_file_path)
@@ -403,35 +962,75 @@ class FastRegistryCommand:
 
         return (func_name, func_file_name, func_dir_path)
 
-    def compile(self) -> None:
+    def compile(
+        self,
+        profiler: profiling.CompileProfiler | None = None,
+        dry_run: bool = False,
+    ) -> None:
+        """
+        The phases and the writes are reported to profiler. With dry_run, the registry isn't changed.
+        """
         # run_admin()
+        profiler = profiler or profiling.NULL_PROFILER
+        profiler.count(profiling.NODES_VISITED)
+        self.writer = RegistryWriter(None, profiler, dry_run)
 
         key_path = join_keys(self.path, self.name)
-        create_key(key_path)
+        self.writer.create_key(key_path)
+        if self.multi_select_model != None:
+            self.writer.set_key_value(
+                key_path, "MultiSelectModel", self.multi_select_model
+            )
 
         command_path = join_keys(key_path, "command")
-        create_key(command_path)
-
-        new_command = self.command
-
-        if self.command == None:
-            # If a python function is defined
-            func_name, func_file_name, func_dir_path = self.get_method_info()
-            if self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
-                # If it requires a background selection
-                new_command = create_directory_background_command(
-                    func_name, func_file_name, func_dir_path, self.params
-                )
-            else:
-                # If it requires a file selection
-                new_command = create_file_select_command(
-                    func_name, func_file_name, func_dir_path, self.params
+        self.writer.create_key(command_path)
+
+        with profiler.phase(profiling.GENERATE):
+            new_command = self.command
+
+            if self.command == None:
+                # If a python function is defined
+                with profiler.phase(profiling.RESOLVE):
+                    func_name, func_file_name, func_dir_path = self.get_method_info()
+                profiler.count(profiling.CALLBACKS_RESOLVED)
+                if self.launch_options:
+                    # If it has to go through the launcher
+                    new_command = create_launcher_command(
+                        func_name,
+                        func_file_name,
+                        func_dir_path,
+                        self.params,
+                        self.launch_options,
+                        self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"],
+                    )
+                elif self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"]:
+                    # If it requires a background selection
+                    new_command = create_directory_background_command(
+                        func_name, func_file_name, func_dir_path, self.params
+                    )
+                else:
+                    # If it requires a file selection
+                    new_command = create_file_select_command(
+                        func_name, func_file_name, func_dir_path, self.params
+                    )
+            elif self.per_file:
+                # If the command runs once per selected file
+                new_command = create_per_file_command(
+                    templates.CommandTemplate.from_command(self.command, self.command_vars),
+                    self.max_parallel,
+                    self.type in ["DIRECTORY_BACKGROUND", "DESKTOP_BACKGROUND"],
                 )
-        elif self.command_vars != None:
-            # If it has command_vars
-            new_command = create_shell_command(self.command, self.command_vars)
+            elif isinstance(self.command, templates.CommandTemplate):
+                # If it has named variables
+                new_command = create_template_command(self.command)
+            elif self.command_vars != None:
+                # If it has command_vars
+                new_command = create_shell_command(self.command, self.command_vars)
+
+        self.writer.set_key_value(command_path, "", new_command)
 
-        set_key_value(command_path, "", new_command)
+        self.location = key_path
+        self.content_hash = self.writer.hexdigest()
 
 
 # Testing section...
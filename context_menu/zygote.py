@@ -0,0 +1,469 @@
+# imports -------------------------------------------------
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import argparse
+import importlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from context_menu import launcher
+
+if TYPE_CHECKING:
+    from types import ModuleType
+    from typing import Any
+
+# zygote.py -------------------------------------
+#
+# A preloaded parent process that forks a fresh child for each invocation, so
+# callbacks are isolated from each other without paying for a cold start.
+# Linux only, since it relies on os.fork and unix sockets.
+
+# The server exits after this many seconds without requests nor children
+ZYGOTE_IDLE_TIMEOUT = 600.0
+
+# How long a client waits for a server it started before falling back to a cold start
+ZYGOTE_START_TIMEOUT = 2.0
+
+# How long a client waits for the reply to a request it sent, longer on the first request importing the callback
+ZYGOTE_REPLY_TIMEOUT = 30.0
+
+
+def get_socket_path() -> str:
+    """
+    Returns the path of the unix socket the server listens on.
+    """
+    return os.path.join(launcher.get_runtime_dir(), "zygote.sock")
+
+
+def get_log_path() -> str:
+    """
+    Returns the path of the file where finished children are recorded.
+    """
+    return os.path.join(launcher.get_runtime_dir(), "zygote.log")
+
+
+def decode_status(status: int) -> int:
+    """
+    Converts a status returned by os.waitpid into an exit code, negative if killed by a signal.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ChildRecord:
+    """
+    Very simple class with no methods holding what is known about a forked child.
+    """
+
+    def __init__(self, pid: int, func_file_name: str, func_name: str) -> None:
+        self.pid = pid
+        self.func_file_name = func_file_name
+        self.func_name = func_name
+        self.started = time.time()
+        self.ended: float | None = None
+        self.exit_code: int | None = None
+
+
+class ZygoteServer:
+    """
+    Forks a child running the requested callback for each request received on the socket.
+
+    The callback modules are imported once in the parent, and reloaded when their file changes.
+    """
+
+    def __init__(
+        self,
+        socket_path: str | None = None,
+        log_path: str | None = None,
+        idle_timeout: float = ZYGOTE_IDLE_TIMEOUT,
+    ) -> None:
+        self.socket_path = socket_path or get_socket_path()
+        self.log_path = log_path or get_log_path()
+        self.idle_timeout = idle_timeout
+        # Keyed by (func_dir_path, func_file_name), as callbacks in different directories may share a name
+        self.modules: dict[tuple[str, str], ModuleType] = {}
+        self.mtimes: dict[tuple[str, str], float] = {}
+        # The entries of sys.modules of the package of each callback, installed again whenever it is used
+        self.namespaces: dict[tuple[str, str], dict[str, ModuleType]] = {}
+        self.children: dict[int, ChildRecord] = {}
+        self.finished: list[ChildRecord] = []
+        self.server: socket.socket | None = None
+
+    def preload(self, func_file_name: str, func_dir_path: str) -> ModuleType:
+        """
+        Imports a callback module in the parent, so the children inherit it.
+        """
+        key = (func_dir_path, func_file_name)
+        if key not in self.modules:
+            package = func_file_name.partition(".")[0]
+            # A callback of the same name from another directory may already be imported
+            self.package_modules(package, remove=True)
+            if func_dir_path in sys.path:
+                sys.path.remove(func_dir_path)
+            sys.path.insert(0, func_dir_path)
+            module = importlib.import_module(func_file_name)
+            self.modules[key] = module
+            self.mtimes[key] = self.get_mtime(module)
+            self.namespaces[key] = self.package_modules(package)
+        return self.modules[key]
+
+    def package_modules(self, package: str, remove: bool = False) -> dict[str, ModuleType]:
+        """
+        Returns the entries of sys.modules of a top level package and its sub modules, removing them if asked.
+        """
+        names = [
+            name
+            for name in sys.modules
+            if name == package or name.startswith(package + ".")
+        ]
+        if remove:
+            return {name: sys.modules.pop(name) for name in names}
+        return {name: sys.modules[name] for name in names}
+
+    def install(self, key: tuple[str, str]) -> None:
+        """
+        Makes the modules of a callback the ones found by import statements.
+        """
+        sys.modules.update(self.namespaces[key])
+        func_dir_path = key[0]
+        if func_dir_path in sys.path:
+            sys.path.remove(func_dir_path)
+        sys.path.insert(0, func_dir_path)
+
+    def get_mtime(self, module: ModuleType) -> float:
+        """
+        Returns the modification time of the file of a module, 0 if it has none.
+        """
+        try:
+            return os.path.getmtime(module.__file__ or "")
+        except OSError:
+            return 0.0
+
+    def refresh(self) -> list[str]:
+        """
+        Reloads the callback modules whose file changed. Returns their names.
+        """
+        reloaded = []
+        for key, module in list(self.modules.items()):
+            mtime = self.get_mtime(module)
+            if mtime != self.mtimes[key]:
+                # reload needs the module to be the one in sys.modules
+                self.install(key)
+                self.modules[key] = importlib.reload(module)
+                self.mtimes[key] = mtime
+                self.namespaces[key] = self.package_modules(key[1].partition(".")[0])
+                reloaded.append(key[1])
+        return reloaded
+
+    def handle(self, request: dict[str, Any]) -> int:
+        """
+        Forks a child running the callback of the request. Returns its pid.
+        """
+        self.refresh()
+        self.preload(request["func_file_name"], request["func_dir_path"])
+        key = (request["func_dir_path"], request["func_file_name"])
+
+        pid = os.fork()
+        if pid == 0:
+            # In the child, nothing must return to the server loop
+            exit_code = 0
+            try:
+                if self.server is not None:
+                    self.server.close()
+                os.setsid()
+                self.install(key)
+                # Like a cold start, the callback runs in the directory of the file manager
+                if request.get("cwd") != None:
+                    os.chdir(request["cwd"])
+                launcher.launch(
+                    request["func_file_name"],
+                    request["func_name"],
+                    request["filenames"],
+                    request["params"],
+                    **request.get("options", {}),
+                )
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        self.children[pid] = ChildRecord(
+            pid, request["func_file_name"], request["func_name"]
+        )
+        return pid
+
+    def reap(self) -> list[ChildRecord]:
+        """
+        Collects the children that exited, recording their exit code and duration.
+        """
+        reaped = []
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            record = self.children.pop(pid, None)
+            if record is None:
+                continue
+            record.ended = time.time()
+            record.exit_code = decode_status(status)
+            reaped.append(record)
+
+        if reaped:
+            with open(self.log_path, "a", encoding="utf-8") as log_file:
+                for record in reaped:
+                    log_file.write(
+                        json.dumps(
+                            {
+                                "pid": record.pid,
+                                "module": record.func_file_name,
+                                "function": record.func_name,
+                                "started": record.started,
+                                "duration": record.ended - record.started,
+                                "exit_code": record.exit_code,
+                            }
+                        )
+                        + "\n"
+                    )
+        self.finished.extend(reaped)
+        return reaped
+
+    def bind(self) -> bool:
+        """
+        Starts listening on the socket. Returns False if another server already does.
+        """
+        if os.path.exists(self.socket_path):
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(self.socket_path)
+                probe.close()
+                return False
+            except OSError:
+                # Left over by a server that died
+                os.remove(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(16)
+        self.server.settimeout(1.0)
+        return True
+
+    def serve_forever(self) -> None:
+        """
+        Answers requests until the server has been idle for idle_timeout seconds.
+        """
+        if self.server is None and not self.bind():
+            return
+        assert self.server is not None
+
+        last_activity = time.time()
+        try:
+            while True:
+                self.reap()
+                try:
+                    connection, _ = self.server.accept()
+                except socket.timeout:
+                    if (
+                        not self.children
+                        and time.time() - last_activity > self.idle_timeout
+                    ):
+                        break
+                    continue
+
+                last_activity = time.time()
+                with connection:
+                    connection.settimeout(5.0)
+                    try:
+                        request = json.loads(connection.makefile("r").readline())
+                        reply = {"pid": self.handle(request)}
+                    except Exception as e:
+                        reply = {"error": repr(e)}
+                    connection.sendall((json.dumps(reply) + "\n").encode("utf-8"))
+        finally:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+# client -------------------------------------
+
+
+def deliver(
+    request: dict[str, Any], socket_path: str | None = None
+) -> socket.socket | None:
+    """
+    Sends a request to a running server. Returns the connection the reply comes on, None if it couldn't be sent.
+
+    A request that couldn't be sent entirely is never handled, as the server only handles complete lines.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(1.0)
+        client.connect(socket_path or get_socket_path())
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def read_reply(client: socket.socket, timeout: float = ZYGOTE_REPLY_TIMEOUT) -> int:
+    """
+    Waits for the reply to a request sent by deliver(). Returns the pid of the forked child.
+
+    Raises RuntimeError if the server failed to fork the callback, OSError or ValueError if no reply came.
+    """
+    with client:
+        client.settimeout(timeout)
+        reply = json.loads(client.makefile("r").readline())
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["pid"]
+
+
+def send_request(
+    request: dict[str, Any],
+    socket_path: str | None = None,
+    timeout: float = ZYGOTE_REPLY_TIMEOUT,
+) -> int:
+    """
+    Sends a request to a running server. Returns the pid of the forked child.
+
+    Raises ConnectionRefusedError if the request couldn't be sent, otherwise see read_reply().
+    """
+    client = deliver(request, socket_path)
+    if client is None:
+        raise ConnectionRefusedError(f"no server on {socket_path or get_socket_path()}")
+    return read_reply(client, timeout)
+
+
+def start_server(python_loc: str, preload: list[list[str]] | None = None) -> None:
+    """
+    Starts a detached server, preloading the given [module, directory] pairs.
+    """
+    command = [python_loc, "-m", "context_menu.zygote"]
+    for func_file_name, func_dir_path in preload or []:
+        command += ["--preload", f"{func_file_name}={func_dir_path}"]
+    subprocess.Popen(
+        command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+
+
+def submit(
+    python_loc: str,
+    func_file_name: str,
+    func_name: str,
+    func_dir_path: str,
+    filenames: list[str],
+    params: str,
+    options: dict[str, Any] | None = None,
+    preload: list[list[str]] | None = None,
+) -> threading.Thread:
+    """
+    Runs a callback in a child of the server, starting the server if needed.
+
+    The request is sent from a background thread, returned, so the file manager never waits for the server.
+    See run_request().
+    """
+    request = {
+        "func_file_name": func_file_name,
+        "func_name": func_name,
+        "func_dir_path": func_dir_path,
+        "filenames": filenames,
+        "params": params,
+        "options": options or {},
+        "cwd": os.getcwd(),
+    }
+    thread = threading.Thread(
+        target=run_request, args=(python_loc, request, preload), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def run_request(
+    python_loc: str, request: dict[str, Any], preload: list[list[str]] | None = None
+) -> None:
+    """
+    Sends a request to the server, starting it if needed, and waits for its reply.
+
+    The request is sent once at most, so the callback never runs twice. It falls back to a cold start through the
+    launcher if the request couldn't be sent, or if the server replied that it failed to fork the callback.
+    """
+    client = deliver(request)
+    if client is None:
+        start_server(python_loc, preload)
+        deadline = time.time() + ZYGOTE_START_TIMEOUT
+        while client is None and time.time() < deadline:
+            time.sleep(0.05)
+            client = deliver(request)
+
+    if client is not None:
+        try:
+            read_reply(client, ZYGOTE_REPLY_TIMEOUT)
+            return
+        except RuntimeError:
+            # Nothing was forked, a cold start still runs the callback
+            traceback.print_exc()
+        except (OSError, ValueError):
+            # The server has the request and may still fork the callback
+            traceback.print_exc()
+            return
+
+    options = request["options"]
+    launch_code = launcher.build_launch_code(
+        request["func_name"],
+        request["func_file_name"],
+        request["func_dir_path"],
+        request["params"],
+        "sys.argv[1:]",
+        options,
+    )
+    launcher.spawn(
+        python_loc, launch_code, request["filenames"], headless=options.get("headless", False)
+    )
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m context_menu.zygote")
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("--log", default=None)
+    parser.add_argument("--idle-timeout", type=float, default=ZYGOTE_IDLE_TIMEOUT)
+    parser.add_argument(
+        "--preload", action="append", default=[], metavar="MODULE=DIRECTORY"
+    )
+    args = parser.parse_args(argv)
+
+    server = ZygoteServer(args.socket, args.log, idle_timeout=args.idle_timeout)
+    if not server.bind():
+        return
+    # Most callback modules use the menus module, so the children inherit it
+    importlib.import_module("context_menu.menus")
+    for item in args.preload:
+        func_file_name, _, func_dir_path = item.partition("=")
+        try:
+            server.preload(func_file_name, func_dir_path)
+        except Exception:
+            traceback.print_exc()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
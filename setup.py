@@ -26,5 +26,8 @@ setuptools.setup(
     ],
     python_requires=">= 3.7",
     packages=setuptools.find_packages(exclude=["tests*"]),
-    extras_require={"test": ["pytest-html"]},
+    extras_require={
+        "test": ["pytest-html"],
+        "toml": ["tomli; python_version < '3.11'"],
+    },
 )
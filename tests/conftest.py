@@ -1,11 +1,13 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 from unittest.mock import patch
+import sys
+import types
 import pytest
 
 
 if TYPE_CHECKING:
-    from typing import Iterable
+    from typing import Any, Iterable
 
 
 class MockedPlatform:
@@ -42,8 +44,103 @@ def mock_platform(name: str) -> MockedPlatform:
     return MockedPlatform(name)
 
 
+@pytest.fixture(autouse=True)
+def menu_index(tmp_path_factory, monkeypatch) -> str:
+    """Keeps the index of installed menus out of the user's data."""
+    path = str(tmp_path_factory.mktemp("index") / "index.jsonl")
+    monkeypatch.setenv("CONTEXT_MENU_INDEX", path)
+    return path
+
+
 @pytest.fixture
 def windows_platform() -> Iterable[None]:
     """Makes the code think we are on Windows."""
     with mock_platform("Windows"):
         yield
+
+
+@pytest.fixture
+def linux_platform() -> Iterable[None]:
+    """Makes the code think we are on Linux."""
+    with mock_platform("Linux"):
+        yield
+
+
+@pytest.fixture
+def home(tmp_path, monkeypatch):
+    """Redirects the home directory, where the Linux menus are written."""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    return tmp_path
+
+
+class FakeNautilus:
+    """Stands in for gi.repository.Nautilus, so generated extensions can run in tests."""
+
+    class MenuProvider:
+        pass
+
+    class Menu:
+        def __init__(self) -> None:
+            self.items: list = []
+
+        def append_item(self, item) -> None:
+            self.items.append(item)
+
+    class MenuItem:
+        def __init__(self, name: str, label: str, tip: str = "", icon: str = "") -> None:
+            self.name = name
+            self.label = label
+            self.submenu = None
+            self.handlers: list = []
+            self.properties: dict = {}
+
+        def set_submenu(self, menu) -> None:
+            self.submenu = menu
+
+        def set_property(self, name: str, value) -> None:
+            self.properties[name] = value
+
+        def connect(self, signal: str, handler, *args) -> None:
+            self.handlers.append((signal, handler, args))
+
+        def activate(self) -> None:
+            for _, handler, args in self.handlers:
+                handler(self, *args)
+
+
+class FakeFile:
+    """Stands in for Nautilus.FileInfo."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def get_uri(self) -> str:
+        return "file://" + self.path
+
+
+def load_extension(code: str, monkeypatch) -> Any:
+    """Runs a generated extension with fake gi modules and returns an instance of its provider."""
+    gi = types.ModuleType("gi")
+    gi.require_version = lambda *args: None
+    repository = types.ModuleType("gi.repository")
+    repository.Nautilus = FakeNautilus
+    repository.GObject = types.SimpleNamespace(GObject=type("GObject", (), {}))
+    gi.repository = repository
+    monkeypatch.setitem(sys.modules, "gi", gi)
+    monkeypatch.setitem(sys.modules, "gi.repository", repository)
+
+    namespace: dict = {"__name__": "extension"}
+    exec(compile(code, "extension.py", "exec"), namespace)
+    provider = [
+        value
+        for name, value in namespace.items()
+        if name.endswith("MenuProvider") and isinstance(value, type)
+    ][0]
+    return provider()
+
+
+def menu_labels(item) -> Any:
+    """Returns the labels of a generated menu item, as nested lists for the sub menus."""
+    if item.submenu is None:
+        return item.label
+    return [item.label, [menu_labels(sub_item) for sub_item in item.submenu.items]]
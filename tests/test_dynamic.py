@@ -0,0 +1,137 @@
+from __future__ import annotations
+import os
+import threading
+import time
+
+from conftest import FakeFile, load_extension, menu_labels
+from context_menu import dynamic, linux_menus, menus
+from test_windows import MockedWinReg
+
+calls = []
+slow_release = threading.Event()
+
+
+def recent_projects(filenames):
+    calls.append(filenames)
+    return [
+        menus.ContextCommand(f"Open in {name}", command=f"echo {name}")
+        for name in ("alpha", "beta")
+    ]
+
+
+def slow_projects(filenames):
+    slow_release.wait(5)
+    return [menus.ContextCommand("Slow", command="echo slow")]
+
+
+def test_item_cache():
+    cache = dynamic.ItemCache(max_entries=2)
+    results = iter(range(100))
+
+    def compute():
+        return [next(results)]
+
+    assert cache.get("a", compute, ttl=60) == [0]
+    assert cache.get("a", compute, ttl=60) == [0]
+    assert cache.get("b", compute, ttl=60) == [1]
+    # Evicts b, the least recently used
+    cache.get("a", compute, ttl=60)
+    assert cache.get("c", compute, ttl=60) == [2]
+    assert list(cache.entries) == ["a", "c"]
+
+    # Stale items are served while they are refreshed
+    assert cache.get("a", compute, ttl=0) == [0]
+    for _ in range(100):
+        if not cache.refreshing:
+            break
+        time.sleep(0.01)
+    assert cache.get("a", compute, ttl=60) == [3]
+
+
+def test_linux_provider(monkeypatch):
+    calls.clear()
+    commands = []
+    cm = menus.ContextMenu("Root", type="FILES")
+    projects = menus.ContextMenu("Projects", items_provider=recent_projects, ttl=60)
+    projects.add_items([menus.ContextCommand("Static", command="echo static")])
+    cm.add_items([projects])
+    code = linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).build_script()
+    assert (
+        "context_menu.dynamic.append_items(Nautilus, submenu3, files, "
+        "test_dynamic.recent_projects, 60, 0.03, self)"
+    ) in code
+
+    provider = load_extension(code, monkeypatch)
+    monkeypatch.setattr(os, "system", commands.append)
+    for _ in range(2):
+        items = provider.get_file_items(None, [FakeFile("/tmp/a")])
+    assert menu_labels(items[0]) == [
+        "Root",
+        [["Projects", ["Static", "Open in alpha", "Open in beta"]]],
+    ]
+    # The second right click is served from the cache
+    assert calls == [["/tmp/a"]]
+
+    items[0].submenu.items[0].submenu.items[2].activate()
+    assert commands == ["echo beta"]
+
+
+def test_windows_snapshot(windows_platform):
+    calls.clear()
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Test", "FILES", items_provider=recent_projects)
+        cm.add_items([menus.ContextCommand("Static", command="echo static")])
+        cm.compile()
+
+        parent = "Software\\Classes\\*\\shell\\Test\\shell"
+        mocked_winreg.assert_context_command(parent, "Static", "echo static")
+        mocked_winreg.assert_context_command(parent, "Open in alpha", "echo alpha")
+    assert calls == [[]]
+    assert len(cm.sub_items) == 1
+
+
+def test_linux_provider_budget(monkeypatch):
+    cm = menus.ContextMenu(
+        "Root", type="FILES", items_provider=slow_projects, budget=0.01
+    )
+    code = linux_menus.NautilusMenu(
+        cm.name, cm.sub_items, cm.type, cm.items_provider, cm.ttl, cm.budget
+    ).build_script()
+    provider = load_extension(code, monkeypatch)
+    updated = threading.Event()
+    provider.emit_items_updated_signal = updated.set
+
+    # The right click doesn't wait for the provider
+    start = time.perf_counter()
+    items = provider.get_file_items(None, [FakeFile("/tmp/slow")])
+    assert time.perf_counter() - start < 1
+    assert menu_labels(items[0]) == ["Root", [dynamic.PLACEHOLDER_LABEL]]
+    assert items[0].submenu.items[0].properties == {"sensitive": False}
+
+    slow_release.set()
+    assert updated.wait(5)
+    items = provider.get_file_items(None, [FakeFile("/tmp/slow")])
+    assert menu_labels(items[0]) == ["Root", ["Slow"]]
+
+
+def test_slow_failing_provider():
+    cache = dynamic.ItemCache()
+    computed = []
+    ready_calls = []
+
+    def compute():
+        computed.append(1)
+        time.sleep(0.05)
+        raise RuntimeError("provider failed")
+
+    assert cache.get("a", compute, 60, 0.001, lambda: ready_calls.append(1)) is None
+    for _ in range(100):
+        if not cache.refreshing:
+            break
+        time.sleep(0.01)
+    # Nautilus isn't told to query the items again, and the failure is cached
+    assert ready_calls == []
+    for _ in range(10):
+        assert cache.get("a", compute, 60, 0.001, lambda: ready_calls.append(1)) == []
+    assert computed == [1]
+    assert ready_calls == []
@@ -0,0 +1,377 @@
+from __future__ import annotations
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from context_menu import launcher, linux_menus, menus, templates, windows_menus
+
+
+def foo(filenames, params):
+    pass
+
+
+@pytest.fixture
+def runtime_dir(tmp_path, monkeypatch):
+    """Keeps the locks and spooled selections in a temporary directory."""
+    monkeypatch.setattr(launcher, "get_runtime_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_coalesce_merges_selections(runtime_dir) -> None:
+    results = {}
+
+    def primary() -> None:
+        results["primary"] = launcher.coalesce("key", ["a", "b"], window=0.5)
+
+    thread = threading.Thread(target=primary)
+    thread.start()
+    time.sleep(0.1)
+    results["secondary"] = launcher.coalesce("key", ["b", "c"], window=0.5)
+    thread.join()
+
+    assert results["secondary"] is None
+    assert results["primary"] == ["a", "b", "c"]
+
+
+def test_coalesce_takes_over_stale_lock(runtime_dir, monkeypatch) -> None:
+    monkeypatch.setattr(launcher, "STALE_LOCK_GRACE", 0)
+    (runtime_dir / "key.lock").write_text("0")
+    time.sleep(0.05)
+
+    assert launcher.coalesce("key", ["a"], window=0.01) == ["a"]
+
+
+def test_coalesce_after_selection_taken(runtime_dir, monkeypatch) -> None:
+    acquire_lock = launcher._acquire_lock
+
+    def previous_holder_releasing(lock_path, window):
+        # The previous holder takes every selection, this one included, right before releasing the lock
+        assert launcher._claim_selections(str(runtime_dir / "key")) == ["a"]
+        return acquire_lock(lock_path, window)
+
+    monkeypatch.setattr(launcher, "_acquire_lock", previous_holder_releasing)
+    assert launcher.coalesce("key", ["a"], window=0.01) is None
+    assert not (runtime_dir / "key.lock").exists()
+
+
+def test_launch_options_require_python() -> None:
+    with pytest.raises(ValueError):
+        menus.ContextCommand("Test", command="echo hello", single_instance=True)
+
+
+def test_single_instance_windows_command() -> None:
+    command = windows_menus.create_launcher_command(
+        "foo", "test_launcher", "/tmp", "", {"single_instance": True}
+    )
+    key = launcher.command_key("test_launcher", "foo", "")
+
+    assert command == (
+        f'"{sys.executable}" -c "import sys; import os; sys.path.insert(0, \'/tmp\'); '
+        "from context_menu import launcher; launcher.launch('test_launcher', 'foo', "
+        f"sys.argv[1:], '', key='{key}', single_instance=True)\" \"%1\""
+    )
+
+
+COLLECTING_MODULE = """
+import json
+
+
+def collect(filenames, params):
+    with open(params, "a") as calls_file:
+        calls_file.write(json.dumps(filenames) + "\\n")
+"""
+
+
+def test_multi_select_aggregation(runtime_dir, tmp_path) -> None:
+    """Simulates Explorer starting one process per selected file, with a Document MultiSelectModel."""
+    (tmp_path / "collecting.py").write_text(COLLECTING_MODULE)
+    calls = str(tmp_path / "calls")
+    launch_options = windows_menus.aggregate_launch_options({}, "Document")
+    code = launcher.build_launch_code(
+        "collect", "collecting", str(tmp_path), calls, "sys.argv[1:]", launch_options
+    )
+    env = dict(os.environ, TMPDIR=str(runtime_dir))
+
+    filenames = [f"file{i}" for i in range(8)]
+    processes = [
+        subprocess.Popen([sys.executable, "-c", code, filename], env=env)
+        for filename in filenames
+    ]
+    for process in processes:
+        assert process.wait() == 0
+
+    called = [json.loads(line) for line in open(calls)]
+    assert len(called) == 1
+    assert sorted(called[0]) == filenames
+
+
+def test_single_instance_linux_handler() -> None:
+    item = menus.ContextCommand("Test", python=foo, single_instance=True)
+    nm = linux_menus.NautilusMenu("Test", [item], "FILES")
+    code = nm.build_script()
+
+    assert "import context_menu.launcher" in code
+    assert "context_menu.launcher.spawn(" in code
+    compile(code, "TestMenu.py", "exec")
+
+
+def test_run_per_file(tmp_path, capsys) -> None:
+    first, second = tmp_path / "a b.txt", tmp_path / "c.txt"
+    first.write_text("")
+    template = menus.CommandTemplate("test -e {FILENAME} && cp {FILENAME} {FILENAME}.bak")
+
+    filenames = [str(first), str(second), str(tmp_path / "missing")]
+    summary = launcher.run_per_file(template.tokens, filenames, max_parallel=2)
+
+    assert (tmp_path / "a b.txt.bak").exists()
+    assert summary["commands"] == 3
+    assert summary["succeeded"] == 1
+    assert [f["file"] for f in summary["failed"]] == filenames[1:]
+    assert "2 of 3 commands failed" in capsys.readouterr().err
+
+
+def test_run_per_file_windows_quoting(monkeypatch) -> None:
+    commands = []
+    monkeypatch.setattr(templates.platform, "system", lambda: "Windows")
+    monkeypatch.setattr(
+        launcher, "run_commands", lambda c, max_parallel: commands.extend(c) or [0] * len(c)
+    )
+    template = menus.CommandTemplate("type {FILENAME}")
+    launcher.run_per_file(template.tokens, ["x&calc.exe", "50%PATH%"])
+
+    # cmd.exe neither runs calc.exe nor expands PATH
+    assert commands == ['type ^"x^&calc.exe^"', 'type ^"50^%PATH^%^"']
+
+
+def test_run_commands_is_bounded(tmp_path) -> None:
+    # Each command records how many commands are running when it starts
+    script = (
+        "import os, sys, time; d = sys.argv[1]; open(os.path.join(d, sys.argv[2]), 'w').close(); "
+        "print(len(os.listdir(d))); time.sleep(0.2); os.remove(os.path.join(d, sys.argv[2]))"
+    )
+    commands = [
+        f'"{sys.executable}" -c "{script}" "{tmp_path}" {i} >> "{tmp_path}.log"'
+        for i in range(6)
+    ]
+
+    assert launcher.run_commands(commands, max_parallel=2) == [0] * 6
+    assert max(int(line) for line in open(f"{tmp_path}.log")) <= 2
+
+
+def test_per_file_commands() -> None:
+    with pytest.raises(ValueError):
+        menus.ContextCommand("Test", python=foo, per_file=True)
+
+    template = menus.CommandTemplate("gzip {FILENAME}")
+    command = windows_menus.create_per_file_command(template, 8)
+    key = launcher.command_key("gzip {FILENAME}", "per_file")
+    python = subprocess.list2cmdline([sys.executable])
+    assert command.startswith(f'{python} -c "import sys; import os; ')
+    assert f"max_parallel=8, key='{key}')\" \"%1\"" in command
+
+    item = menus.ContextCommand(
+        "Test", command="gzip ?", command_vars=["FILENAME"], per_file=True
+    )
+    code = linux_menus.NautilusMenu("Test", [item], "FILES").build_script()
+    assert "context_menu.launcher.spawn(" in code
+    assert "launcher.run_per_file([('literal', 'gzip '), ('variable', 'FILENAME')]" in code
+    compile(code, "TestMenu.py", "exec")
+
+
+WATCHED_MODULE = """
+import os
+import subprocess
+import sys
+import time
+
+
+def hang(filenames, params):
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    with open(filenames[0], "w") as pid_file:
+        pid_file.write(str(child.pid))
+    time.sleep(60)
+
+
+def allocate(filenames, params):
+    data = bytearray(1024 * 1024 * 1024)
+
+
+def priority(filenames, params):
+    with open(filenames[0], "w") as nice_file:
+        nice_file.write(str(os.nice(0)))
+"""
+
+
+def is_running(pid: int) -> bool:
+    """Killed processes may stay zombies if nothing reaps them."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            return stat_file.read().rpartition(")")[2].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="uses process groups and setrlimit")
+def test_watchdog(runtime_dir, tmp_path, monkeypatch) -> None:
+    (tmp_path / "watched.py").write_text(WATCHED_MODULE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    output = str(tmp_path / "output")
+
+    launcher.launch("watched", "hang", [output], "", timeout=0.5)
+    grandchild = int(open(output).read())
+    time.sleep(0.1)
+    assert not is_running(grandchild)
+
+    launcher.launch("watched", "allocate", [output], "", max_memory=256 * 1024 * 1024)
+
+    launcher.launch("watched", "priority", [output], "", nice=5)
+    assert int(open(output).read()) == os.nice(0) + 5
+
+    # Running out of memory while importing the module
+    (tmp_path / "greedy.py").write_text("data = bytearray(1024 * 1024 * 1024)\n")
+    launcher.launch("greedy", "run", [output], "", max_memory=256 * 1024 * 1024)
+
+    records = [json.loads(line) for line in open(launcher.get_watchdog_log_path())]
+    assert [record["reason"] for record in records] == [
+        "timeout",
+        "max_memory",
+        "exit",
+        "max_memory",
+    ]
+    assert [record["function"] for record in records] == ["hang", "allocate", "priority", "run"]
+    assert records[2]["exit_code"] == 0
+
+    # The log is rotated once too large
+    monkeypatch.setattr(launcher, "MAX_WATCHDOG_LOG_BYTES", 0)
+    launcher.launch("watched", "priority", [output], "", nice=5)
+    assert os.path.exists(launcher.get_watchdog_log_path() + ".1")
+    assert len(open(launcher.get_watchdog_log_path()).readlines()) == 1
+
+
+def test_watchdog_options() -> None:
+    with pytest.raises(ValueError):
+        menus.ContextCommand("Test", command="echo hello", timeout=10)
+
+    command = windows_menus.create_launcher_command(
+        "foo", "test_launcher", "/tmp", "", {"timeout": 10, "nice": 5}
+    )
+    assert "sys.argv[1:], '', nice=5, timeout=10)" in command
+    with pytest.raises(ValueError, match="max_memory isn't supported on Windows"):
+        windows_menus.create_launcher_command(
+            "foo", "test_launcher", "/tmp", "", {"max_memory": 2**30}
+        )
+
+
+def test_tracing(tmp_path, monkeypatch, capsys) -> None:
+    from context_menu import __main__
+
+    # The same runtime directory in this process and in the spawned ones
+    runtime_dir = tmp_path / "context_menu"
+    runtime_dir.mkdir()
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr(launcher, "get_runtime_dir", lambda: str(runtime_dir))
+    (tmp_path / "collecting.py").write_text(COLLECTING_MODULE)
+    calls = str(tmp_path / "calls")
+
+    code = launcher.build_launch_code(
+        "collect", "collecting", str(tmp_path), calls, "sys.argv[1:]", {"trace": True}
+    )
+    assert code.startswith("import time; ready = time.time(); ")
+    for _ in range(3):
+        assert launcher.spawn(sys.executable, code, ["a"], trace=True).wait() == 0
+
+    records = launcher.read_traces()
+    assert len({record["id"] for record in records}) == 3
+    first_id = records[0]["id"]
+    assert {
+        record["stage"] for record in records if record["id"] == first_id
+    } == set(launcher.TRACE_STAGES)
+    summary = launcher.summarize_traces(records)
+    assert summary["collecting.collect"]["invocations"] == 3
+    assert set(summary["collecting.collect"]["stages"]) == set(
+        launcher.TRACE_STAGES[1:] + ("total",)
+    )
+
+    # The trace file is rotated once too large, and the rotated records are still read
+    monkeypatch.setattr(launcher, "MAX_TRACE_BYTES", 0)
+    launcher.record_trace("rotated", "handler")
+    assert os.path.exists(launcher.get_trace_path() + ".1")
+    assert len(launcher.read_traces()) == len(records) + 1
+
+    assert __main__.main(["trace-summary"]) == 0
+    assert "collecting.collect\t3\t0\t" in capsys.readouterr().out
+
+
+NOISY_MODULE = """
+import sys
+
+
+def noisy(filenames, params):
+    for i in range(20000):
+        print("line", i)
+    sys.stderr.write("failing on " + filenames[0] + "\\n")
+    raise ValueError("noisy failed")
+"""
+
+
+def test_headless(tmp_path, monkeypatch, capfd) -> None:
+    command = windows_menus.create_launcher_command(
+        "foo", "test_launcher", "/tmp", "", {"headless": True}
+    )
+    assert command.startswith(f'"{windows_menus.COMMAND_PRESETS["pythonw"]}" -c "')
+    assert command.endswith(", headless=True)\" \"%1\"")
+
+    handler = linux_menus.NautilusMenu(
+        "Test", [], "FILES"
+    ).generate_launch_func("noisy", "noisy", "/tmp", "", {"headless": True})
+    assert handler.code.rstrip().endswith("filenames, headless=True)")
+
+    # The same runtime directory in this process and in the spawned one
+    runtime_dir = tmp_path / "context_menu"
+    runtime_dir.mkdir()
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.setattr(launcher, "get_runtime_dir", lambda: str(runtime_dir))
+    (tmp_path / "noisy.py").write_text(NOISY_MODULE)
+    code = launcher.build_launch_code(
+        "noisy", "noisy", str(tmp_path), "", "sys.argv[1:]", {"headless": True}
+    )
+    assert launcher.spawn(sys.executable, code, ["a.txt"], headless=True).wait() == 1
+    # Nothing reaches the output of the file manager
+    assert capfd.readouterr() == ("", "")
+
+    log = (runtime_dir / "output" / "noisy.noisy.log").read_bytes()
+    header, output = log.split(b"\n", 1)
+    assert b"bytes dropped" in header
+    # Only the end of the output is kept, with the traceback
+    assert len(output) == launcher.OUTPUT_BUFFER_BYTES + 1
+    assert b"line 19999\nfailing on a.txt\n" in output
+    assert output.endswith(b"ValueError: noisy failed\n\n")
+    assert b"line 0\n" not in output
+
+
+def test_output_capture(runtime_dir, monkeypatch) -> None:
+    capture = launcher.OutputCapture("test.capture", max_bytes=10)
+    capture.start()
+    print("abcdef", end="")
+    print("ghijklmno", end="", file=sys.stderr)
+    capture.stop()
+    assert capture.getvalue() == b"fghijklmno"
+    capture.write("0123456789abc")
+    assert capture.getvalue() == b"3456789abc"
+    assert sys.stdout is not capture and sys.stderr is not capture
+
+    # The log is rotated once too large
+    monkeypatch.setattr(launcher, "MAX_OUTPUT_LOG_BYTES", 0)
+    for _ in range(2):
+        capture = launcher.OutputCapture("test.capture")
+        capture.start()
+        print("hello")
+        capture.stop()
+    path = launcher.get_output_log_path("test.capture")
+    assert os.path.exists(path + ".1")
+    assert open(path).read().endswith("\nhello\n\n")
@@ -1,4 +1,11 @@
-from context_menu import menus, linux_menus
+import json
+import os
+import sys
+import threading
+import time
+import pytest
+from context_menu import index, menus, linux_menus
+from conftest import FakeFile, load_extension, menu_labels
 # from context_menu import menus
 #
 # from context_menu import linux_menus
@@ -32,3 +39,371 @@ def test_command_func():
 #     print()
 #     print(valid_commands)
 #     assert nm.commands == valid_commands
+
+
+def test_compile_all(linux_platform, home):
+    items = [
+        menus.FastCommand(f"Command {i}", type="FILES", command="echo hello")
+        for i in range(8)
+    ]
+    # Same extension file as 'Command 0'
+    items.append(menus.FastCommand("command 0", type="FILES", command="echo hello"))
+    # Fails to compile, built-in functions have no file
+    items.append(menus.FastCommand("Builtin", type="FILES", python=print))
+
+    results = menus.compile_all(items, workers=4)
+
+    assert [result.name for result in results] == [item.name for item in items]
+    assert all(result.ok for result in results[:8])
+    assert not results[8].ok and not results[9].ok
+    extensions = home / ".local/share/nautilus-python/extensions"
+    assert sorted(os.listdir(extensions)) == sorted(
+        [f"Command{i}.py" for i in range(8)] + ["__pycache__"]
+    )
+
+
+def test_deep_menu():
+    depth = sys.getrecursionlimit() + 100
+    root = menus.ContextMenu("Root", type="FILES")
+    menu = root
+    for level in range(depth):
+        sub_menu = menus.ContextMenu(f"Level {level}")
+        menu.add_items([sub_menu])
+        menu = sub_menu
+    menu.add_items([menus.ContextCommand("Leaf", command="echo hello")])
+
+    nm = linux_menus.NautilusMenu(root.name, root.sub_items, root.type)
+    nm.build_script_body(nm.name, nm.sub_items)
+
+    assert nm.commands[-1] == "submenu1.append_item(menuitem2)"
+    assert len(nm.funcs) == 1
+
+
+def foo(filenames, params):
+    pass
+
+
+def bar(filenames, params):
+    pass
+
+
+def build_nested_menu():
+    cm = menus.ContextMenu("Foo menu", type="FILES")
+    cm2 = menus.ContextMenu("Foo Menu 2")
+    cm3 = menus.ContextMenu("Foo Menu 3")
+    cm3.add_items([
+        menus.ContextCommand("Foo One", command="echo hello > example.txt"),
+        menus.ContextCommand("Foo Two", command="touch ?x", command_vars=["FILENAME"]),
+    ])
+    cm2.add_items([menus.ContextCommand("Foo Three", python=foo), cm3])
+    cm.add_items([cm2, menus.ContextCommand("Foo Four", python=bar)])
+    return cm
+
+
+def test_streamed_script(home):
+    cm = build_nested_menu()
+    expected = linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).build_script()
+
+    nm = linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type)
+    assert "".join(nm.iter_script()) == expected
+
+    linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).compile()
+    extension = home / ".local/share/nautilus-python/extensions/FooMenu.py"
+    assert extension.read_text() == expected
+    # Readable by Nautilus whoever runs it, not only by its owner like the temporary file
+    assert extension.stat().st_mode & 0o777 == 0o644 & ~linux_menus.UMASK
+
+    # Compiling again keeps the mode of the extension
+    extension.chmod(0o600)
+    linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).compile()
+    assert extension.stat().st_mode & 0o777 == 0o600
+
+
+def test_menu_index(linux_platform, home):
+    cm = build_nested_menu()
+    cm.compile()
+    menus.FastCommand("Fast Command", type="FILES", command="echo hello").compile()
+    extension = home / ".local/share/nautilus-python/extensions/FooMenu.py"
+
+    entry = [m for m in menus.list_menus() if m["name"] == "Foo menu"][0]
+    assert entry["location"] == str(extension)
+    assert menus.verify() == {"missing": [], "modified": [], "skipped": []}
+
+    extension.write_text("# changed")
+    assert [m["name"] for m in menus.verify()["modified"]] == ["Foo menu"]
+
+    menus.removeMenu("Foo menu", "FILES")
+    assert not extension.exists()
+    assert not menus.is_installed("Foo menu", "FILES")
+
+    os.remove(home / ".local/share/nautilus-python/extensions/FastCommand.py")
+    assert [m["name"] for m in menus.verify()["missing"]] == ["Fast Command"]
+    assert menus.list_menus() == []
+
+    # A menu compiled on Windows, with the index shared through the home directory
+    index.record("Shared", "FILES", "registry", "Software\\Classes\\*\\shell\\Shared", "0")
+    assert [m["name"] for m in menus.verify()["skipped"]] == ["Shared"]
+    assert menus.is_installed("Shared", "FILES")
+
+
+def test_index_log(linux_platform, home, monkeypatch):
+    monkeypatch.setattr(index, "COMPACT_MIN_LINES", 8)
+    for number in range(20):
+        index.record(f"Menu {number % 3}", "FILES", "nautilus", f"/tmp/{number}", "0")
+        index.forget("Menu 0", "FILES")
+    path = index.get_index_path()
+    with open(path, encoding="utf-8") as index_file:
+        lines = index_file.readlines()
+    # Compacted every time the superseded lines outnumber the entries
+    assert len(lines) <= 8
+    assert [(m["name"], m["location"]) for m in menus.list_menus()] == [
+        ("Menu 1", "/tmp/19"),
+        ("Menu 2", "/tmp/17"),
+    ]
+
+    # Lines appended by another process are read incrementally
+    with open(path, "a", encoding="utf-8") as index_file:
+        index_file.write(json.dumps({"key": "FILES:Menu 1", "entry": None}) + "\n")
+    assert [m["name"] for m in menus.list_menus()] == ["Menu 2"]
+
+    # The entries returned are copies of the cached ones
+    index.lookup("Menu 2", "FILES")["location"] = "changed"
+    index.entries()[0]["location"] = "changed"
+    assert index.lookup("Menu 2", "FILES")["location"] == "/tmp/17"
+
+
+def test_index_file_lock(linux_platform, home, monkeypatch):
+    index.record("Menu", "FILES", "nautilus", "/tmp/1", "0")
+    lock_path = index.get_index_path() + ".lock"
+
+    # Another process appending or compacting holds the lock, this one waits for it
+    open(lock_path, "w").close()
+    writer = threading.Thread(
+        target=index.record, args=("Other", "FILES", "nautilus", "/tmp/2", "0")
+    )
+    writer.start()
+    time.sleep(0.2)
+    with open(index.get_index_path(), encoding="utf-8") as index_file:
+        assert "Other" not in index_file.read()
+    os.remove(lock_path)
+    writer.join(5)
+    assert [m["name"] for m in menus.list_menus()] == ["Menu", "Other"]
+    assert not os.path.exists(lock_path)
+
+    # A lock left by a crashed process is taken over
+    open(lock_path, "w").close()
+    os.utime(lock_path, (0, 0))
+    index.forget("Other", "FILES")
+    assert [m["name"] for m in menus.list_menus()] == ["Menu"]
+
+
+def test_shared_handlers_and_menus(monkeypatch, tmp_path):
+    calls = []
+    shared = menus.ContextMenu("Shared")
+    shared.add_items([
+        menus.ContextCommand("One", command="echo one"),
+        menus.ContextCommand("Two", command="echo two"),
+    ])
+    cm = menus.ContextMenu("Root", type="FILES")
+    cm.add_items([
+        menus.ContextCommand("Copy 1", command="echo one"),
+        shared,
+        menus.ContextMenu("Nested"),
+        menus.ContextCommand("Copy 2", command="echo one"),
+    ])
+    cm.sub_items[2].add_items([shared])
+
+    nm = linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type)
+    code = nm.build_script()
+
+    # One handler per command, the shared menu is built by a single method
+    assert len(nm.funcs) == 3
+    assert code.count("echo one") == 1
+    assert code.count("def build_menu") == 1
+    assert "".join(linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).iter_script()) == code
+
+    provider = load_extension(code, monkeypatch)
+    monkeypatch.setattr(os, "system", calls.append)
+    items = provider.get_file_items(None, [FakeFile("/tmp/a")])
+    shared_labels = ["Shared", ["One", "Two"]]
+    assert menu_labels(items[0]) == [
+        "Root",
+        ["Copy 1", shared_labels, ["Nested", [shared_labels]], "Copy 2"],
+    ]
+
+    items[0].submenu.items[3].activate()
+    items[0].submenu.items[2].submenu.items[0].submenu.items[1].activate()
+    assert calls == ["echo one", "echo two"]
+
+
+def test_table_backend(linux_platform, home, monkeypatch):
+    monkeypatch.delenv("XDG_DATA_HOME", raising=False)
+    calls = []
+    monkeypatch.setattr(os, "system", calls.append)
+    extensions = home / ".local/share/nautilus-python/extensions"
+    cm = build_nested_menu()
+    # Compiled to an extension first, replaced by the table
+    cm.compile()
+    cm.compile(table=True)
+    table = home / ".local/share/context_menu/tables/FooMenu.json"
+    assert table.exists()
+    assert sorted(os.listdir(extensions)) == ["ContextMenuTables.py", "__pycache__"]
+    assert menus.verify() == {"missing": [], "modified": [], "skipped": []}
+
+    provider = load_extension(linux_menus.build_tables_extension(), monkeypatch)
+    items = provider.get_file_items(None, [FakeFile("/tmp/a b")])
+    assert menu_labels(items[0]) == [
+        "Foo menu",
+        [
+            ["Foo Menu 2", ["Foo Three", ["Foo Menu 3", ["Foo One", "Foo Two"]]]],
+            "Foo Four",
+        ],
+    ]
+    items[0].submenu.items[0].submenu.items[1].submenu.items[1].activate()
+    assert calls == ["touch /tmp/a bx"]
+    assert provider.get_background_items(None, FakeFile("/tmp")) == []
+
+    # Unchanged tables aren't parsed again
+    loaded = linux_menus.menu_table._cache.tables[str(table)][1]
+    provider.get_file_items(None, [FakeFile("/tmp/a")])
+    assert linux_menus.menu_table._cache.tables[str(table)][1] is loaded
+
+    # A new deploy shows on the next right click
+    cm.sub_items[0].sub_items[1].add_items(
+        [menus.ContextCommand("Foo Five", command="echo five")]
+    )
+    cm.sub_items.append(cm.sub_items[0])
+    cm.compile(table=True)
+    items = provider.get_file_items(None, [FakeFile("/tmp/a")])
+    sub_menu = [
+        "Foo Menu 2",
+        ["Foo Three", ["Foo Menu 3", ["Foo One", "Foo Two", "Foo Five"]]],
+    ]
+    assert menu_labels(items[0]) == ["Foo menu", [sub_menu, "Foo Four", sub_menu]]
+    items[0].submenu.items[2].submenu.items[1].submenu.items[2].activate()
+    assert calls[-1] == "echo five"
+
+    menus.removeMenu("Foo menu", "FILES")
+    assert not table.exists()
+    assert provider.get_file_items(None, [FakeFile("/tmp/a")]) == []
+
+
+def test_bytecode(linux_platform, home):
+    import importlib.util
+
+    cm = build_nested_menu()
+    cm.compile()
+    extension = home / ".local/share/nautilus-python/extensions/FooMenu.py"
+    bytecode = importlib.util.cache_from_source(str(extension))
+    with open(bytecode, "rb") as bytecode_file:
+        header = bytecode_file.read(16)
+    # Checked hash based bytecode, matching the source
+    assert int.from_bytes(header[4:8], "little") == 0b11
+    assert header[8:16] == importlib.util.source_hash(extension.read_bytes())
+
+    # Invalid code fails the compilation and leaves the extension as it was
+    broken = menus.ContextMenu("Foo menu", type="FILES")
+    broken.add_items([menus.ContextCommand('Say "hi"', command="echo hi")])
+    with pytest.raises(SyntaxError):
+        broken.compile()
+    # Dry runs validate the code too
+    with pytest.raises(SyntaxError):
+        broken.compile(dry_run=True)
+    assert header[8:16] == importlib.util.source_hash(extension.read_bytes())
+    assert len(os.listdir(extension.parent)) == 2
+
+    menus.removeMenu("Foo menu", "FILES")
+    assert not os.path.exists(bytecode)
+
+
+def test_compile_report(linux_platform, home):
+    from context_menu import profiling
+
+    cm = build_nested_menu()
+    report = cm.compile(dry_run=True)
+    assert not (home / ".local").exists()
+    assert menus.list_menus() == []
+    assert report["dry_run"]
+    # The 6 items and the exits of the 2 sub menus, and the 2 functions
+    assert report["counters"]["nodes_visited"] == 8
+    assert report["counters"]["callbacks_resolved"] == 2
+    assert "write" in report["timings"] and "generate" in report["timings"]
+
+    phases = []
+    hook = lambda name, seconds: phases.append(name)
+    with profiling.CompileProfiler(hook) as profiler:
+        cm.compile(profiler=profiler)
+    extension = home / ".local/share/nautilus-python/extensions/FooMenu.py"
+    full_report = profiler.report()
+    assert full_report["counters"]["bytes_written"] == (
+        report["counters"]["bytes_written"]
+    )
+    assert full_report["counters"]["bytes_written"] == extension.stat().st_size
+    assert full_report["counters"]["files_written"] == 1
+    assert {"resolve", "generate", "validate", "write", "index"} <= set(phases)
+    assert full_report["wall"] >= sum(full_report["timings"].values()) * 0.99
+
+
+def test_memory_report(linux_platform, home, capsys):
+    from context_menu import __main__, memory_report
+
+    menus.FastCommand("Foo menu", type="FILES", command="echo hi").compile()
+    extensions = home / ".local/share/nautilus-python/extensions"
+    # Keeps about 100 KiB per right click
+    (extensions / "Leaky.py").write_text(
+        "from gi.repository import Nautilus, GObject\n"
+        "kept = []\n"
+        "class LeakyMenuProvider(GObject.GObject, Nautilus.MenuProvider):\n"
+        "\tdef get_file_items(self, window, files):\n"
+        "\t\tkept.append(bytearray(100 * 1024))\n"
+        "\t\treturn []\n"
+    )
+    (extensions / "Broken.py").write_text("import missing_module\n")
+
+    records = memory_report.build_report(budget=1024 * 1024, calls=20)
+    assert [record["name"] for record in records] == ["Leaky", "FooMenu", "Broken"]
+    leaky, foo, broken = records
+    assert leaky["over_budget"] and not foo["over_budget"]
+    assert leaky["per_call_bytes"] >= 100 * 1024
+    assert foo["per_call_bytes"] < 1024
+    assert foo["import_bytes"] > 0 and foo["peak_bytes"] >= foo["retained_bytes"]
+    assert "missing_module" in broken["error"]
+
+    assert __main__.main(["memory-report", "--budget", "1", "--calls", "20"]) == 1
+    assert "Leaky (over budget)" in capsys.readouterr().out
+    path = str(extensions / "FooMenu.py")
+    assert __main__.main(["memory-report", "--json", path]) == 0
+    assert json_names(capsys.readouterr().out) == ["FooMenu"]
+
+
+def json_names(output):
+    import json
+
+    return [record["name"] for record in json.loads(output)]
+
+
+def test_max_items_per_level(linux_platform, home, monkeypatch):
+    names = [f"Project {i:04}" for i in range(1998, 0, -1)]
+    shared = menus.ContextMenu("Shared")
+    shared.add_items([menus.ContextCommand(name, command="echo hi") for name in names[:5]])
+    cm = menus.ContextMenu("Projects", type="FILES", max_items_per_level=50)
+    cm.add_items([menus.ContextCommand(name, command="echo hi") for name in names])
+    cm.add_items([shared, shared])
+    cm.compile()
+
+    extension = home / ".local/share/nautilus-python/extensions/Projects.py"
+    provider = load_extension(extension.read_text(), monkeypatch)
+    (top_item,) = provider.get_file_items(None, [FakeFile("/tmp/a.txt")])
+    pages = menu_labels(top_item)[1]
+    assert len(pages) == 40
+    assert all(len(page[1]) == 50 for page in pages)
+    assert pages[0][0] == "Project 000–Project 0050"
+    assert pages[1][0] == "Project 0051–Project 0100"
+    assert pages[-1][0] == "Project 1951–S"
+    # Levels within the limit keep their order
+    shared_labels = ["Shared", names[:5]]
+    assert pages[-1][1][-2:] == [shared_labels, shared_labels]
+    leaves = [label for page in pages for label in page[1]]
+    assert leaves[:-2] == sorted(names)
+    # The items themselves aren't changed
+    assert len(cm.sub_items) == 2000
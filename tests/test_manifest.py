@@ -0,0 +1,158 @@
+import json
+import os
+import sys
+
+import pytest
+
+from context_menu import __main__, manifest, menus
+from conftest import FakeFile, load_extension, menu_labels
+
+MANIFEST = """
+version = 1
+
+[[menus]]
+name = "Images"
+type = "FILES"
+
+[[menus.items]]
+name = "Resize"
+python = "imagetools.resize:resize"
+single_instance = true
+
+[[menus.items]]
+name = "More"
+
+[[menus.items.items]]
+name = "Say hi"
+command = "echo hi"
+
+[[commands]]
+name = "Open terminal"
+type = "DIRECTORY_BACKGROUND"
+command = "gnome-terminal"
+"""
+
+# Importing it would leave a trace
+CALLBACK_MODULE = """
+open({marker!r}, "w").close()
+
+
+def resize(filenames, params):
+    pass
+"""
+
+
+@pytest.fixture
+def callbacks_dir(tmp_path, monkeypatch):
+    """A package of callbacks on sys.path, whose modules record being imported."""
+    package = tmp_path / "callbacks" / "imagetools"
+    package.mkdir(parents=True)
+    marker = str(tmp_path / "imported")
+    (package / "__init__.py").write_text(CALLBACK_MODULE.format(marker=marker))
+    (package / "resize.py").write_text(CALLBACK_MODULE.format(marker=marker))
+    monkeypatch.syspath_prepend(str(tmp_path / "callbacks"))
+    return tmp_path
+
+
+def test_deploy(linux_platform, home, callbacks_dir, monkeypatch, capsys):
+    path = callbacks_dir / "menus.toml"
+    path.write_text(MANIFEST)
+
+    assert __main__.main(["deploy", str(path), "--check"]) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        "create\tImages\tFILES\tok",
+        "create\tOpen terminal\tDIRECTORY_BACKGROUND\tok",
+        "Checked only, nothing was written.",
+    ]
+    assert menus.list_menus() == []
+
+    assert __main__.main(["deploy", str(path), "--json"]) == 0
+    assert [entry["action"] for entry in json.loads(capsys.readouterr().out)] == [
+        "create",
+        "create",
+    ]
+    assert [entry["name"] for entry in menus.list_menus()] == ["Open terminal", "Images"]
+    # The callbacks are referenced, never imported
+    assert not (callbacks_dir / "imported").exists()
+    assert "imagetools.resize" not in sys.modules
+
+    extension = home / ".local/share/nautilus-python/extensions/Images.py"
+    code = extension.read_text()
+    callback_dir = str(callbacks_dir / "callbacks").replace("\\", "/")
+    assert f"launcher.launch('imagetools.resize', 'resize', " in code
+    assert callback_dir in code
+    provider = load_extension(code, monkeypatch)
+    (item,) = provider.get_file_items(None, [FakeFile("/tmp/a.png")])
+    assert menu_labels(item) == ["Images", ["Resize", ["More", ["Say hi"]]]]
+
+    # The same manifest again updates the menus, also from JSON
+    json_path = callbacks_dir / "menus.json"
+    json_path.write_text(json.dumps(manifest.load_manifest(str(path))))
+    assert [action for action, _ in manifest.deploy(str(json_path))] == [
+        "update",
+        "update",
+    ]
+
+
+def test_invalid_manifest(callbacks_dir, capsys):
+    data = {
+        "version": 1,
+        "menus": [
+            {
+                "name": "Images",
+                "type": "FILES",
+                "items": [
+                    {"name": "Missing", "python": "imagetools.missing:resize"},
+                    {"name": "Both", "python": "imagetools.resize:resize", "command": "ls"},
+                    {"name": "Typo", "command": "ls", "singel_instance": True},
+                    {"name": "Sub", "items": [{"name": "Bad", "python": "not a reference"}]},
+                ],
+            },
+            {"name": "Images", "type": "FILES"},
+        ],
+        "commands": [{"name": "No type", "command": "ls"}],
+    }
+    with pytest.raises(manifest.ManifestError) as error:
+        manifest.build_items(data)
+    assert error.value.errors == [
+        "menus[0].items[0]: can't find the module 'imagetools.missing'",
+        "menus[0].items[1]: expected either 'command' or 'python'",
+        "menus[0].items[2]: unknown key 'singel_instance'",
+        "menus[0].items[3].items[0]: invalid python reference 'not a reference', expected 'module:function'",
+        "commands[0]: 'type' must be one of FILES, DIRECTORY, DIRECTORY_BACKGROUND, DRIVE or a file extension",
+        "'Images' (FILES) is defined more than once",
+    ]
+    assert not (callbacks_dir / "imported").exists()
+
+    path = callbacks_dir / "menus.json"
+    path.write_text(json.dumps(data))
+    assert __main__.main(["deploy", str(path)]) == 1
+    assert capsys.readouterr().err.startswith("error: menus[0].items[0]: ")
+
+    path = callbacks_dir / "menus.yaml"
+    path.write_text("")
+    with pytest.raises(manifest.ManifestError, match="unknown manifest format"):
+        manifest.load_manifest(str(path))
+
+
+def test_check_fails_on_invalid_code(linux_platform, home, callbacks_dir, capsys):
+    # A quote in the name of a command ends the string of its label in the generated code
+    path = callbacks_dir / "menus.json"
+    path.write_text(
+        json.dumps(
+            {
+                "menus": [
+                    {
+                        "name": "Quotes",
+                        "type": "FILES",
+                        "items": [{"name": 'Say "hi"', "command": "echo hi"}],
+                    }
+                ]
+            }
+        )
+    )
+    assert __main__.main(["deploy", str(path), "--check"]) == 1
+    assert capsys.readouterr().out.splitlines()[0].startswith(
+        "create\tQuotes\tFILES\tfailed: "
+    )
+    assert not (home / ".local").exists()
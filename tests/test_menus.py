@@ -1,6 +1,8 @@
 import os
 import sys
 
+import pytest
+
 # from context_menu import menus
 from context_menu import menus
 
@@ -17,3 +19,70 @@ def test_method_info():
     func_name, func_file_name, func_dir_path = cc.get_method_info()
     assert func_name == 'example_func' and func_file_name == 'test_menus' and get_last_path_item(
         func_dir_path) == 'tests'
+
+
+# Can't be imported, the menus have to be compiled without importing it
+HEAVY_MODULE = """
+import not_installed_dependency
+
+if not_installed_dependency.NEW_API:
+    def resize(filenames, params):
+        pass
+else:
+    from not_installed_dependency import resize_legacy as resize
+
+crop = not_installed_dependency.make_crop()
+"""
+
+
+def test_method_info_reference(tmp_path, monkeypatch):
+    package = tmp_path / "imagetools"
+    package.mkdir()
+    (package / "__init__.py").write_text("raise ImportError('never imported')\n")
+    (package / "heavy.py").write_text(HEAVY_MODULE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    # Imported by its full name from the directory of its package
+    root = str(tmp_path).replace("\\", "/")
+    for name in ("resize", "crop"):
+        cc = menus.ContextCommand('Test Command', python=f"imagetools.heavy:{name}")
+        assert cc.get_method_info() == (name, "imagetools.heavy", root)
+    fc = menus.FastCommand('Test Command', "FILES", python="imagetools.heavy:resize")
+    assert fc.get_method_info() == ("resize", "imagetools.heavy", root)
+    assert "imagetools" not in sys.modules
+
+    with pytest.raises(ValueError, match="has no function 'rotate'"):
+        menus.ContextCommand('Test Command', python="imagetools.heavy:rotate").get_method_info()
+    with pytest.raises(ValueError, match="can't find the module 'imagetools.missing'"):
+        menus.ContextCommand('Test Command', python="imagetools.missing:resize").get_method_info()
+    with pytest.raises(ValueError, match="'imagetools.heavy' isn't a package"):
+        menus.ContextCommand('Test Command', python="imagetools.heavy.sub:resize").get_method_info()
+    # The format is checked right away
+    with pytest.raises(ValueError, match="expected 'module:function'"):
+        menus.ContextCommand('Test Command', python="imagetools/heavy.py")
+
+
+
+def test_reference_relative_import(tmp_path, monkeypatch):
+    import importlib
+
+    package = tmp_path / "pkgtools"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "json.py").write_text("NAME = 'pkgtools.json'\n")
+    (package / "run.py").write_text(
+        "import json\nfrom . import json as own_json\n\n\n"
+        "def run(filenames, params):\n    return json.dumps(own_json.NAME)\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    func_name, module_name, root = menus.ContextCommand(
+        'Test Command', python="pkgtools.run:run"
+    ).get_method_info()
+    assert (module_name, root) == ("pkgtools.run", str(tmp_path).replace("\\", "/"))
+    # Imported as the generated code does, the stdlib json isn't shadowed by pkgtools/json.py
+    monkeypatch.syspath_prepend(root)
+    module = importlib.import_module(module_name)
+    assert getattr(module, func_name)([], "") == '"pkgtools.json"'
+    for name in ("pkgtools", "pkgtools.run", "pkgtools.json"):
+        monkeypatch.delitem(sys.modules, name)
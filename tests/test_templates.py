@@ -0,0 +1,127 @@
+from __future__ import annotations
+import os
+import sys
+
+import pytest
+
+from conftest import FakeFile, load_extension
+from context_menu import launcher, linux_menus, menus, templates, windows_menus
+
+
+def test_parse():
+    template = templates.CommandTemplate("cp {FILENAME} {dir}/{{backup}}")
+    assert template.tokens == [
+        (templates.LITERAL, "cp "),
+        (templates.VARIABLE, "FILENAME"),
+        (templates.LITERAL, " "),
+        (templates.VARIABLE, "DIR"),
+        (templates.LITERAL, "/{backup}"),
+    ]
+    assert template.variables == ["FILENAME", "DIR"]
+    assert (
+        template.render({"FILENAME": "a b", "DIR": "/tmp"}, templates.get_quote("Linux"))
+        == "cp 'a b' /tmp/{backup}"
+    )
+    assert (
+        template.render({"FILENAME": "a b", "DIR": "C:\\tmp"}, templates.get_quote("Windows"))
+        == 'cp ^"a b^" ^"C:\\tmp^"/{backup}'
+    )
+
+    for source in ("echo {NAME}", "echo {FILENAME", "echo }"):
+        with pytest.raises(ValueError):
+            templates.CommandTemplate(source)
+
+
+def test_legacy():
+    template = templates.CommandTemplate.from_legacy("echo {} ?x", ["filename"])
+    assert template.render({"FILENAME": "a b"}) == "echo {} a bx"
+
+    with pytest.raises(ValueError):
+        templates.CommandTemplate.from_legacy("echo ? ?", ["FILENAME"])
+    with pytest.raises(ValueError):
+        templates.CommandTemplate.from_legacy("echo ?", ["NAME"])
+
+
+def test_windows_command():
+    assert windows_menus.create_shell_command(
+        "echo {} ?", ["FILENAME"]
+    ) == '''"{}" -c "import os; import sys; os.system('echo {{}} ' + ' '.join(sys.argv[1:])  + '')" "%1"'''.format(
+        sys.executable
+    )
+    assert windows_menus.create_template_command(
+        templates.CommandTemplate("type {FILENAME}")
+    ) == '''"{}" -c "import os; import sys; sys.path.insert(0, '{}'); from context_menu import templates; os.system('type ' + templates.quote_cmd(' '.join(sys.argv[1:]) ) + '')" "%1"'''.format(
+        sys.executable, launcher.PACKAGE_PARENT_DIR
+    )
+
+    # The quotes of the template don't end the argument of -c
+    command = windows_menus.create_template_command(
+        templates.CommandTemplate('echo "{FILENAME}" done')
+    )
+    prefix = '"{}" -c "'.format(sys.executable)
+    assert command.startswith(prefix) and command.endswith('" "%1"')
+    argument = command[len(prefix) : -len('" "%1"')]
+    assert '"' not in argument.replace('\\"', "")
+    python_section = argument.replace('\\"', '"')
+    assert "os.system('echo \"' + " in python_section
+    compile(python_section, "<command>", "exec")
+
+
+def test_quote_cmd():
+    quote = templates.get_quote("Windows")
+    assert quote("a&calc.exe") == '^"a^&calc.exe^"'
+    assert quote("50%PATH%") == '^"50^%PATH^%^"'
+    assert quote('C:\\a b\\') == '^"C:\\a b\\\\^"'
+    assert quote('say "hi"') == '^"say \\^"hi\\^"^"'
+
+    # Neither runs calc.exe nor expands PATH
+    template = templates.CommandTemplate("type {FILENAME}")
+    assert template.render({"FILENAME": "x&calc.exe 50%PATH%"}, quote) == (
+        'type ^"x^&calc.exe 50^%PATH^%^"'
+    )
+
+
+@pytest.mark.skipif(sys.platform != "win32", reason="requires cmd.exe")
+def test_quote_cmd_round_trip(tmp_path):
+    import subprocess
+
+    for value in ("x&calc.exe", "50%PATH%", "a ^b (c) !d! <e> |f|", "C:\\a b\\"):
+        command = "{} -c {} {}".format(
+            templates.quote_cmd(sys.executable),
+            templates.quote_cmd("import sys; print(sys.argv[1])"),
+            templates.quote_cmd(value),
+        )
+        output = subprocess.run(command, shell=True, capture_output=True, text=True)
+        assert output.stdout.rstrip("\n") == value
+
+
+def test_run_command(monkeypatch):
+    calls = []
+    monkeypatch.setattr(os, "system", calls.append)
+    monkeypatch.setattr(templates.platform, "system", lambda: "Windows")
+    template = templates.CommandTemplate("start {FILENAME} --dir={DIR}")
+    templates.run_command(template, ["x&calc.exe", "50%PATH%"])
+    templates.run_command(template, [])
+
+    # Once for the whole selection, with the first file
+    assert calls == [
+        'start ^"x^&calc.exe^" --dir={}'.format(templates.quote_cmd(os.getcwd()))
+    ]
+
+
+def test_linux_handlers(monkeypatch):
+    calls = []
+    cm = menus.ContextMenu("Root", type="FILES")
+    cm.add_items([
+        menus.ContextCommand("Legacy", command="touch ?x {}", command_vars=["FILENAME"]),
+        menus.ContextCommand("Named", command=menus.CommandTemplate("touch {FILENAME}x")),
+    ])
+    code = linux_menus.NautilusMenu(cm.name, cm.sub_items, cm.type).build_script()
+
+    provider = load_extension(code, monkeypatch)
+    monkeypatch.setattr(os, "system", calls.append)
+    items = provider.get_file_items(None, [FakeFile("/tmp/a b"), FakeFile("/tmp/c")])
+    for item in items[0].submenu.items:
+        item.activate()
+    # Both run once, for the first file, and only the named variables are quoted
+    assert calls == ["touch /tmp/a bx {}", "touch '/tmp/a b'x"]
@@ -1,12 +1,13 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
+import copy
 import sys
 from pathlib import Path
 import pytest
 from unittest.mock import patch
 
 # from context_menu import menus
-from context_menu import menus
+from context_menu import menus, profiling, windows_menus
 
 if TYPE_CHECKING:
     from typing import Any
@@ -36,6 +37,8 @@ class MockedWinReg:
                 "get_key_value",
                 "list_keys",
                 "delete_key",
+                "delete_key_value",
+                "key_exists",
             ]
         ]
 
@@ -49,8 +52,11 @@ class MockedWinReg:
             patch.__exit__(*args, **kwargs)
 
     def create_key(self, path: str) -> None:
-        """Mocks creating a key."""
-        self._keys.setdefault(f"HKEY_CURRENT_USER\\{path}", {"": ""})
+        """Mocks creating a key, and its missing parents like winreg.CreateKey."""
+        key = f"HKEY_CURRENT_USER\\{path}"
+        while key not in self._keys and "\\" in key:
+            self._keys[key] = {"": ""}
+            key = key.rpartition("\\")[0]
 
     def set_key_value(self, key_path: str, subkey_name: str, value: str | int) -> None:
         """Mocks changing the value of a key."""
@@ -69,11 +75,20 @@ class MockedWinReg:
         return self._keys.get(f"HKEY_CURRENT_USER\\{path}", {}).keys()
 
     def delete_key(self, path: str) -> None:
-        """Mocks deleting a key."""
+        """Mocks deleting a key and its subkeys."""
         path = f"HKEY_CURRENT_USER\\{path}"
 
-        if path in self._keys:
-            del self._keys[path]
+        for key in list(self._keys):
+            if key == path or key.startswith(f"{path}\\"):
+                del self._keys[key]
+
+    def delete_key_value(self, key_path: str, subkey_name: str) -> None:
+        """Mocks deleting the value of a key."""
+        self._keys.get(f"HKEY_CURRENT_USER\\{key_path}", {}).pop(subkey_name, None)
+
+    def key_exists(self, path: str) -> bool:
+        """Mocks checking that a key exists."""
+        return f"HKEY_CURRENT_USER\\{path}" in self._keys
 
     def assert_context_menu(self, parent: str, name: str) -> None:
         """Asserts that keys for a ContextMenu are correctly set.
@@ -275,3 +290,354 @@ def test_fast_command(
         menus.FastCommand("Test", activation_type, **params).compile()
 
         mocked_winreg.assert_fast_command(expected_parent, "Test", expected_command)
+
+
+def test_context_menu_deep(windows_platform: None) -> None:
+    """Tests a cascade deeper than the recursion limit."""
+    depth = sys.getrecursionlimit() + 100
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Test", "FILES")
+        menu = cm
+        for _ in range(depth):
+            sub_menu = menus.ContextMenu("Sub")
+            menu.add_items([sub_menu])
+            menu = sub_menu
+        menu.add_items([menus.ContextCommand("Command", command="echo hello")])
+        cm.compile()
+
+        parent = "Software\\Classes\\*\\shell\\Test\\shell" + "\\Sub\\shell" * depth
+        mocked_winreg.assert_context_command(parent, "Command", "echo hello")
+
+
+def test_menu_index(windows_platform: None) -> None:
+    """Tests that compiled menus are recorded, removed and verified through the index."""
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Test", "FILES")
+        cm.add_items([menus.ContextCommand("Command", command="echo hello")])
+        cm.compile()
+        menus.FastCommand("Fast", ".txt", command="echo hello").compile()
+
+        assert [(m["name"], m["type"], m["location"]) for m in menus.list_menus()] == [
+            ("Fast", ".TXT", "Software\\Classes\\.txt\\shell\\Fast"),
+            ("Test", "FILES", "Software\\Classes\\*\\shell\\Test"),
+        ]
+        assert menus.is_installed("Test", "FILES")
+        assert not menus.is_installed("Test", "DIRECTORY")
+
+        menus.removeMenu("Test", "FILES")
+        assert not menus.is_installed("Test", "FILES")
+        assert not mocked_winreg.key_exists("Software\\Classes\\*\\shell\\Test")
+
+        mocked_winreg.delete_key("Software\\Classes\\.txt\\shell\\Fast")
+        report = menus.verify()
+        assert [m["name"] for m in report["missing"]] == ["Fast"]
+        assert menus.list_menus() == []
+
+
+def test_context_menu_shared_store(windows_platform: None) -> None:
+    """Tests that shared sub menus are written once and referenced with ExtendedSubCommandsKey."""
+    store = "Software\\Classes\\context_menu.store"
+    with MockedWinReg() as mocked_winreg:
+        shared = menus.ContextMenu("Shared")
+        shared.add_items([menus.ContextCommand("Command", command="echo hello")])
+        # Same items as shared, but another object
+        copy = menus.ContextMenu("Copy")
+        copy.add_items([menus.ContextCommand("Command", command="echo hello")])
+
+        store_sizes = []
+        for activation_type in ("FILES", "DIRECTORY"):
+            cm = menus.ContextMenu("Test", activation_type)
+            cm.add_items([shared, copy, menus.ContextMenu("Nested")])
+            cm.sub_items[2].add_items([shared])
+            cm.compile(shared_store=True)
+            store_keys = [key for key in mocked_winreg._keys if store in key]
+            store_sizes.append(len(store_keys))
+
+        files_key = "Software\\Classes\\*\\shell\\Test"
+        directory_key = "Software\\Classes\\Directory\\shell\\Test"
+        top_entry = mocked_winreg.get_key_value(files_key, "ExtendedSubCommandsKey")
+        assert top_entry == mocked_winreg.get_key_value(
+            directory_key, "ExtendedSubCommandsKey"
+        )
+        assert mocked_winreg.get_key_value(files_key, "MUIVerb") == "Test"
+        assert mocked_winreg.get_key_value(files_key, "subcommands") is None
+
+        top_shell = f"Software\\Classes\\{top_entry}\\shell"
+        shared_entry = mocked_winreg.get_key_value(
+            f"{top_shell}\\Shared", "ExtendedSubCommandsKey"
+        )
+        assert shared_entry == mocked_winreg.get_key_value(
+            f"{top_shell}\\Copy", "ExtendedSubCommandsKey"
+        )
+        mocked_winreg.assert_context_command(
+            f"Software\\Classes\\{shared_entry}\\shell", "Command", "echo hello"
+        )
+        # Three entries: top level, Shared (and Copy) and Nested
+        assert len([key for key in store_keys if key.endswith("\\shell")]) == 3
+        # Nothing new is written to the store for the second type
+        assert store_sizes[0] == store_sizes[1]
+
+        def store_entries() -> set[str]:
+            return {
+                key.split("\\")[4] for key in mocked_winreg._keys if f"{store}\\" in key
+            }
+
+        # Still referenced by the menu of the other type
+        menus.removeMenu("Test", "FILES")
+        assert len(store_entries()) == 3
+
+        # Recompiled without Nested, the entries only it referenced are deleted
+        cm = menus.ContextMenu("Test", "DIRECTORY")
+        cm.add_items([copy])
+        cm.compile(shared_store=True)
+        new_top_entry = mocked_winreg.get_key_value(directory_key, "ExtendedSubCommandsKey")
+        assert new_top_entry != top_entry
+        assert store_entries() == {
+            new_top_entry.split("\\")[1],
+            shared_entry.split("\\")[1],
+        }
+
+        menus.removeMenu("Test", "DIRECTORY")
+        assert store_entries() == set()
+
+
+def test_context_menu_workers(windows_platform: None) -> None:
+    """Tests that subtrees written concurrently give the same keys, and that errors are collected per subtree."""
+
+    def build_menu() -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", "FILES")
+        for i in range(8):
+            sub_menu = menus.ContextMenu(f"Sub {i}")
+            sub_menu.add_items(
+                [
+                    menus.ContextCommand(f"Command {j}", command="echo hello")
+                    for j in range(4)
+                ]
+            )
+            cm.add_items([sub_menu])
+        return cm
+
+    hashes = []
+    keys = []
+    for workers in (1, 4):
+        with MockedWinReg() as mocked_winreg:
+            build_menu().compile(workers=workers)
+            keys.append(mocked_winreg._keys)
+            hashes.append(menus.index.lookup("Test", "FILES")["hash"])
+    assert keys[0] == keys[1]
+    assert hashes[0] == hashes[1]
+
+    with MockedWinReg() as mocked_winreg:
+        cm = build_menu()
+        # Neither a command nor a python function
+        cm.sub_items[3].add_items([menus.ContextCommand("Broken")])
+        with pytest.raises(windows_menus.RegistryCompileError) as error:
+            cm.compile(workers=4)
+        assert [subtree for subtree, _ in error.value.errors] == ["Sub 3"]
+        mocked_winreg.assert_context_command(
+            "Software\\Classes\\*\\shell\\Test\\shell\\Sub 7\\shell",
+            "Command 3",
+            "echo hello",
+        )
+
+
+def test_transactional_compile(windows_platform: None) -> None:
+    """Tests that a failed transactional compilation is rolled back, and that the last deploy can be rolled back."""
+
+    def build_menu(command: str) -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", "FILES")
+        sub_menu = menus.ContextMenu("Sub")
+        sub_menu.add_items([menus.ContextCommand("Command", command=command)])
+        cm.add_items([sub_menu, menus.ContextCommand("Other", command=command)])
+        return cm
+
+    with MockedWinReg() as mocked_winreg:
+        build_menu("echo v1").compile()
+        v1_keys = copy.deepcopy(mocked_winreg._keys)
+        v1_entry = menus.index.lookup("Test", "FILES")
+
+        cm = build_menu("echo v2")
+        # Neither a command nor a python function
+        cm.sub_items[0].add_items([menus.ContextCommand("Broken")])
+        cm.sub_items.append(menus.ContextMenu("New"))
+        with pytest.raises(windows_menus.RegistryCompileError):
+            cm.compile(transactional=True)
+        assert mocked_winreg._keys == v1_keys
+
+        cm = build_menu("echo v2")
+        cm.sub_items.append(menus.ContextMenu("New"))
+        cm.compile(transactional=True)
+        mocked_winreg.assert_context_command(
+            "Software\\Classes\\*\\shell\\Test\\shell", "Other", "echo v2"
+        )
+        assert mocked_winreg.key_exists(
+            "Software\\Classes\\*\\shell\\Test\\shell\\New"
+        )
+
+        menus.rollback(menus.index.lookup("Test", "FILES"))
+        assert mocked_winreg._keys == v1_keys
+        assert menus.index.lookup("Test", "FILES") == v1_entry
+
+        # Without a previous deploy, everything is removed
+        menus.removeMenu("Test", "FILES")
+        build_menu("echo v3").compile(transactional=True)
+        menus.rollback(menus.index.lookup("Test", "FILES"))
+        assert not mocked_winreg.key_exists("Software\\Classes\\*\\shell\\Test")
+        assert not menus.is_installed("Test", "FILES")
+
+
+def test_multi_select_model(windows_platform: None) -> None:
+    """Tests that the MultiSelectModel is written, and that the python functions are launched once per selection."""
+    shell = "Software\\Classes\\*\\shell"
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Test", "FILES")
+        cm.add_items(
+            [
+                menus.ContextCommand(
+                    "Python", python=foo, multi_select_model="Document"
+                ),
+                menus.ContextCommand(
+                    "Command", command="echo hello", multi_select_model="Player"
+                ),
+                menus.ContextCommand("Default", python=foo),
+            ]
+        )
+        cm.compile()
+
+        path = f"{shell}\\Test\\shell"
+        assert (
+            mocked_winreg.get_key_value(f"{path}\\Python", "MultiSelectModel")
+            == "Document"
+        )
+        assert "single_instance=True" in mocked_winreg.get_key_value(
+            f"{path}\\Python\\command", ""
+        )
+        assert (
+            mocked_winreg.get_key_value(f"{path}\\Command", "MultiSelectModel")
+            == "Player"
+        )
+        mocked_winreg.assert_context_command(path, "Command", "echo hello")
+        assert (
+            mocked_winreg.get_key_value(f"{path}\\Default", "MultiSelectModel")
+            is None
+        )
+
+        menus.FastCommand(
+            "Fast", "FILES", python=foo, multi_select_model="Player"
+        ).compile()
+        assert (
+            mocked_winreg.get_key_value(f"{shell}\\Fast", "MultiSelectModel")
+            == "Player"
+        )
+        assert "single_instance=True" in mocked_winreg.get_key_value(
+            f"{shell}\\Fast\\command", ""
+        )
+
+    with pytest.raises(ValueError):
+        menus.ContextCommand("Test", python=foo, multi_select_model="Multiple")
+
+
+def test_compile_report(windows_platform: None) -> None:
+    """Tests that a dry run reports the same writes as a compilation, without changing the registry."""
+
+    def build_menu() -> menus.ContextMenu:
+        cm = menus.ContextMenu("Test", "FILES")
+        sub_menu = menus.ContextMenu("Sub")
+        sub_menu.add_items([menus.ContextCommand("Python", python=foo)])
+        cm.add_items([sub_menu, menus.ContextCommand("Command", command="echo hi")])
+        return cm
+
+    with MockedWinReg() as mocked_winreg:
+        report = build_menu().compile(workers=2, dry_run=True)
+        assert mocked_winreg._keys == {}
+        assert menus.list_menus() == []
+
+        profiler = profiling.CompileProfiler()
+        assert build_menu().compile(workers=2, profiler=profiler) == profiler.report()
+        full_report = profiler.report()
+        assert full_report["counters"] == report["counters"]
+        assert full_report["counters"]["keys_created"] == 8
+        assert full_report["counters"]["callbacks_resolved"] == 1
+        assert "registry" in full_report["timings"]
+        assert "registry" not in report["timings"]
+
+        report = menus.FastCommand("Fast", "FILES", python=foo).compile(dry_run=True)
+        assert report["counters"] == {
+            "nodes_visited": 1,
+            "keys_created": 2,
+            "values_set": 1,
+            "callbacks_resolved": 1,
+        }
+        assert not mocked_winreg.key_exists("Software\\Classes\\*\\shell\\Fast")
+
+
+def test_max_items_per_level(windows_platform: None) -> None:
+    """Tests that oversized levels are split into alphabetical sub menus, grouped again until they fit."""
+    shell = "Software\\Classes\\*\\shell\\Items\\shell"
+
+    def sub_keys(mocked_winreg: MockedWinReg, path: str) -> list[str]:
+        prefix = f"HKEY_CURRENT_USER\\{path}\\"
+        return sorted(
+            key[len(prefix) :]
+            for key in mocked_winreg._keys
+            if key.startswith(prefix) and "\\" not in key[len(prefix) :]
+        )
+
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Items", "FILES", max_items_per_level=3)
+        cm.add_items(
+            [menus.ContextCommand(f"Item {i:02}", command="echo hi") for i in range(20, 0, -1)]
+        )
+        cm.compile()
+
+        assert sub_keys(mocked_winreg, shell) == [
+            "Item 01–Item 09",
+            "Item 10–Item 18",
+            "Item 19–Item 2",
+        ]
+        mocked_winreg.assert_context_menu(shell, "Item 01–Item 09")
+        first = f"{shell}\\Item 01–Item 09\\shell"
+        assert sub_keys(mocked_winreg, first) == [
+            "Item 01–Item 03",
+            "Item 04–Item 06",
+            "Item 07–Item 09",
+        ]
+        mocked_winreg.assert_context_command(
+            f"{first}\\Item 01–Item 03\\shell", "Item 02", "echo hi"
+        )
+        mocked_winreg.assert_context_command(
+            f"{shell}\\Item 19–Item 2\\shell\\Item 19–Item 2\\shell", "Item 20", "echo hi"
+        )
+
+    with pytest.raises(ValueError):
+        menus.ContextMenu("Items", "FILES", max_items_per_level=1)
+
+    # Pages of items with the same name get distinct keys, so their commands aren't merged
+    with MockedWinReg() as mocked_winreg:
+        cm = menus.ContextMenu("Items", "FILES", max_items_per_level=3)
+        cm.add_items(
+            [menus.ContextCommand("open", command=f"echo {i}") for i in range(7)]
+            + [menus.ContextCommand("Paste", command="echo paste")]
+        )
+        cm.compile()
+
+        assert sub_keys(mocked_winreg, shell) == ["Open (1)", "Open (2)", "Open–P"]
+
+
+def test_python_reference(windows_platform: None) -> None:
+    """Tests that a 'module:function' reference gives the same commands as the function itself."""
+    shell = "Software\\Classes\\*\\shell"
+    keys = []
+    for python in (foo, "test_windows:foo"):
+        with MockedWinReg() as mocked_winreg:
+            menus.FastCommand("Fast", "FILES", python=python).compile()
+            cm = menus.ContextMenu("Test", "FILES")
+            cm.add_items(
+                [menus.ContextCommand("Launched", python=python, single_instance=True)]
+            )
+            cm.compile()
+            keys.append(mocked_winreg._keys)
+    assert keys[0] == keys[1]
+    assert "launcher.launch('test_windows', 'foo'" in keys[1][
+        f"HKEY_CURRENT_USER\\{shell}\\Test\\shell\\Launched\\command"
+    ][""]
@@ -0,0 +1,210 @@
+from __future__ import annotations
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from context_menu import linux_menus, menus, zygote
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+CALLBACK = """
+def write(filenames, params):
+    with open(params, "a") as out:
+        out.write("{}:" + ",".join(filenames) + "\\n")
+"""
+
+
+def wait_for(predicate, timeout: float = 5.0) -> None:
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_zygote_forks_and_reloads(tmp_path: Path) -> None:
+    (tmp_path / "zygote_callback.py").write_text(CALLBACK.format("v1"))
+    socket_path = str(tmp_path / "zygote.sock")
+    log_path = tmp_path / "zygote.log"
+    out_path = tmp_path / "out.txt"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "context_menu.zygote",
+            "--socket",
+            socket_path,
+            "--log",
+            str(log_path),
+            "--idle-timeout",
+            "2",
+            "--preload",
+            f"zygote_callback={tmp_path}",
+        ],
+        cwd=str(Path(__file__).parent.parent),
+    )
+    try:
+        wait_for(lambda: os.path.exists(socket_path))
+        request = {
+            "func_file_name": "zygote_callback",
+            "func_name": "write",
+            "func_dir_path": str(tmp_path),
+            "filenames": ["a", "b"],
+            "params": str(out_path),
+        }
+        pid = zygote.send_request(request, socket_path)
+        wait_for(lambda: out_path.exists())
+
+        # The parent must pick up the new version of the callback
+        time.sleep(0.05)
+        (tmp_path / "zygote_callback.py").write_text(CALLBACK.format("version2"))
+        zygote.send_request(request, socket_path)
+        wait_for(lambda: len(out_path.read_text().splitlines()) == 2)
+        wait_for(lambda: log_path.exists() and len(log_path.read_text().splitlines()) == 2)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    assert out_path.read_text().splitlines() == ["v1:a,b", "version2:a,b"]
+    records = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert records[0]["pid"] == pid
+    assert all(record["exit_code"] == 0 for record in records)
+
+
+def foo(filenames, params):
+    pass
+
+
+def test_zygote_linux_handler() -> None:
+    item = menus.ContextCommand("Test", python=foo, zygote=True)
+    code = linux_menus.NautilusMenu("Test", [item], "FILES").build_script()
+
+    assert "import context_menu.zygote" in code
+    assert "context_menu.zygote.submit(" in code
+    compile(code, "TestMenu.py", "exec")
+
+
+TOOLS = """
+import os
+
+
+def write(filenames, params):
+    with open(params, "a") as out:
+        out.write("{}:" + os.getcwd() + "\\n")
+"""
+
+
+def test_zygote_same_module_names(tmp_path: Path) -> None:
+    for name in ("first", "second"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "zygote_tools.py").write_text(TOOLS.format(name))
+    socket_path = str(tmp_path / "zygote.sock")
+    out_path = tmp_path / "out.txt"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "context_menu.zygote",
+            "--socket",
+            socket_path,
+            "--log",
+            str(tmp_path / "zygote.log"),
+            "--idle-timeout",
+            "2",
+        ],
+        cwd=str(Path(__file__).parent.parent),
+    )
+    try:
+        wait_for(lambda: os.path.exists(socket_path))
+        for count, name in enumerate(["first", "second", "first"], 1):
+            zygote.send_request(
+                {
+                    "func_file_name": "zygote_tools",
+                    "func_name": "write",
+                    "func_dir_path": str(tmp_path / name),
+                    "filenames": [],
+                    "params": str(out_path),
+                    "cwd": str(tmp_path / name),
+                },
+                socket_path,
+            )
+            wait_for(
+                lambda: out_path.exists()
+                and len(out_path.read_text().splitlines()) == count
+            )
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    assert out_path.read_text().splitlines() == [
+        f"first:{tmp_path / 'first'}",
+        f"second:{tmp_path / 'second'}",
+        f"first:{tmp_path / 'first'}",
+    ]
+
+
+def test_zygote_server_error_falls_back(monkeypatch: pytest.MonkeyPatch) -> None:
+    def read_reply(client, timeout=None):
+        client.close()
+        raise RuntimeError("ModuleNotFoundError('missing')")
+
+    spawned = []
+    monkeypatch.setattr(zygote, "deliver", lambda request: socket.socket())
+    monkeypatch.setattr(zygote, "read_reply", read_reply)
+    monkeypatch.setattr(zygote, "start_server", lambda *args: pytest.fail("started"))
+    monkeypatch.setattr(
+        zygote.launcher, "spawn", lambda *args, **kwargs: spawned.append(args)
+    )
+    zygote.submit(sys.executable, "missing", "foo", "/nowhere", ["a"], "").join(5)
+
+    assert len(spawned) == 1
+    assert spawned[0][0] == sys.executable
+    assert spawned[0][2] == ["a"]
+
+
+def test_zygote_late_reply_runs_once(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    socket_path = str(tmp_path / "zygote.sock")
+    received = []
+
+    # A server slow to import the callback, replying after the client gave up
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+
+    def serve() -> None:
+        connection, _ = server.accept()
+        with connection:
+            received.append(json.loads(connection.makefile("r").readline()))
+            time.sleep(0.5)
+            try:
+                connection.sendall(b'{"pid": 1}\n')
+            except BrokenPipeError:
+                # The client stopped waiting
+                pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    spawned = []
+    monkeypatch.setattr(zygote, "ZYGOTE_REPLY_TIMEOUT", 0.1)
+    monkeypatch.setattr(zygote, "get_socket_path", lambda: socket_path)
+    monkeypatch.setattr(zygote, "start_server", lambda *args: pytest.fail("started"))
+    monkeypatch.setattr(
+        zygote.launcher, "spawn", lambda *args, **kwargs: spawned.append(args)
+    )
+    try:
+        zygote.submit(sys.executable, "tools", "foo", str(tmp_path), ["a"], "").join(5)
+        thread.join(5)
+    finally:
+        server.close()
+
+    assert [request["filenames"] for request in received] == [["a"]]
+    assert received[0]["cwd"] == os.getcwd()
+    assert spawned == []